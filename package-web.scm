@@ -4,6 +4,7 @@
 	(guix build-system python)
 	(gnu packages python-web)
 	(gnu packages python-crypto)
+	(gnu packages check)
 	(gnu packages tls))
 
 (package
@@ -11,7 +12,8 @@
 	(version "0.0")
 	(inputs
 		(list python-passlib python-flask-wtf))
-	(native-inputs '())
+	(native-inputs
+		(list python-pytest))
 	(propagated-inputs
 		(list python-flask gunicorn openssl (load "./package-ldap.scm")))
 	(source (local-file "./src-web" #:recursive? #t))
@@ -20,7 +22,7 @@
 		(modify-phases %standard-phases
 			(replace 'check
 				(lambda _
-					(invoke "python3" "-m" "unittest" "discover" "-v"))))))
+					(invoke "python3" "-m" "pytest" "-v" "tests"))))))
 	(synopsis "Daniel-Authenticator: simple LDAP authenticator for home-servesr")
 	(description
 		"Daniel-Authenticator allows you to manage user authentication for all services over LDAP.")
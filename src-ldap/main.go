@@ -5,6 +5,7 @@ import (
 	"net"
 	"sync"
 	"crypto/sha256"
+	"crypto/tls"
 	"fmt"
 	"net/http"
 	"net/url"
@@ -40,7 +41,11 @@ func main() {
 		
 		listen := "0.0.0.0:3389"
 		log.Printf("Starting LDAP server on %s", listen)
-		if err := s.ListenAndServe(listen); err != nil {
+		ln, err := net.Listen("tcp", listen)
+		if err != nil {
+			log.Fatalf("LDAP Server Failed: %s", err.Error())
+		}
+		if err := s.Serve(controlListener{ln}); err != nil {
 			log.Fatalf("LDAP Server Failed: %s", err.Error())
 		}
 	}()
@@ -56,9 +61,124 @@ func main() {
 	
 	listen_tls := "0.0.0.0:6636"
 	log.Printf("Starting LDAPS server on %s", listen_tls)
-	if err := s.ListenAndServeTLS(listen_tls, "./data/certificate.pem", "./data/key.pem"); err != nil {
+	cert, err := tls.LoadX509KeyPair("./data/certificate.pem", "./data/key.pem")
+	if err != nil {
+		log.Fatalf("LDAPS Server Failed: %s", err.Error())
+	}
+	ln, err := tls.Listen("tcp", listen_tls, &tls.Config{Certificates: []tls.Certificate{cert}, ServerName: "localhost"})
+	if err != nil {
 		log.Fatalf("LDAPS Server Failed: %s", err.Error())
 	}
+	if err := s.Serve(controlListener{ln}); err != nil {
+		log.Fatalf("LDAPS Server Failed: %s", err.Error())
+	}
+}
+
+// the ldap library writes every search result itself and has no way to return response controls with it, so
+// each client connection is wrapped to add the controls a search asks for to the SearchResultDone it ends with
+type controlListener struct {
+	net.Listener
+}
+
+func (l controlListener) Accept() (net.Conn, error) {
+	conn, err := l.Listener.Accept()
+	if err != nil {
+		return nil, err
+	}
+	return &controlConn{Conn: conn, lock: &sync.Mutex{}}, nil
+}
+
+type controlConn struct {
+	net.Conn
+	lock         *sync.Mutex
+	doneControls []ldap.Control
+}
+
+func (c *controlConn) setDoneControls(controls []ldap.Control) {
+	c.lock.Lock()
+	defer c.lock.Unlock()
+	c.doneControls = controls
+}
+
+// the library writes one whole LDAPMessage per Write
+func (c *controlConn) Write(packet []byte) (int, error) {
+	c.lock.Lock()
+	controls := c.doneControls
+	if len(controls) > 0 && isSearchResultDone(packet) {
+		c.doneControls = nil
+	} else {
+		controls = nil
+	}
+	c.lock.Unlock()
+	
+	if controls == nil {
+		return c.Conn.Write(packet)
+	}
+	if _, err := c.Conn.Write(appendControls(packet, controls)); err != nil {
+		return 0, err
+	}
+	return len(packet), nil
+}
+
+// the length of the BER element whose length starts at offset and where its contents start, or -1 if it is malformed
+func readBerLength(packet []byte, offset int) (int, int) {
+	if offset >= len(packet) {
+		return -1, -1
+	}
+	first := int(packet[offset])
+	if first < 0x80 {
+		return first, offset + 1
+	}
+	count := first & 0x7f
+	if count == 0 || count > 4 || offset+1+count > len(packet) {
+		return -1, -1
+	}
+	length := 0
+	for _, b := range packet[offset+1 : offset+1+count] {
+		length = length<<8 | int(b)
+	}
+	return length, offset + 1 + count
+}
+
+func encodeBerLength(length int) []byte {
+	if length < 0x80 {
+		return []byte{byte(length)}
+	}
+	bytes := []byte{}
+	for ; length > 0; length >>= 8 {
+		bytes = append([]byte{byte(length)}, bytes...)
+	}
+	return append([]byte{0x80 | byte(len(bytes))}, bytes...)
+}
+
+// an LDAPMessage is a sequence of the message id, the operation, and optionally the controls, [0]
+func isSearchResultDone(packet []byte) bool {
+	if len(packet) < 2 || packet[0] != 0x30 {
+		return false
+	}
+	length, start := readBerLength(packet, 1)
+	if length < 0 || start+length != len(packet) || start >= len(packet) || packet[start] != 0x02 {
+		return false
+	}
+	idLength, idStart := readBerLength(packet, start+1)
+	if idLength < 0 || idStart+idLength >= len(packet) {
+		return false
+	}
+	// [APPLICATION 5] SearchResultDone
+	return packet[idStart+idLength] == 0x65
+}
+
+func appendControls(packet []byte, controls []ldap.Control) []byte {
+	_, start := readBerLength(packet, 1)
+	encoded := []byte{}
+	for _, control := range controls {
+		encoded = append(encoded, control.Encode().Bytes()...)
+	}
+	contents := append([]byte{}, packet[start:]...)
+	contents = append(contents, 0xa0)
+	contents = append(contents, encodeBerLength(len(encoded))...)
+	contents = append(contents, encoded...)
+	return append(append([]byte{0x30}, encodeBerLength(len(contents))...), contents...)
 }
 
 type ldapHandler struct {
@@ -72,21 +192,19 @@ type session struct {
 	conn 		net.Conn
 	number	 int
 	boundDN  *string
-	strand  *string
 }
 
 func (h ldapHandler) getSession(conn net.Conn) (session, error) {
 	id := connID(conn)
 	s, ok := h.sessions[id]
 	if !ok {
-		s = session{id: id, conn: conn, number: *h.nextSessionNumber, boundDN: new(string), strand: new(string)}
+		s = session{id: id, conn: conn, number: *h.nextSessionNumber, boundDN: new(string)}
 		*s.boundDN = ""
 		if *h.nextSessionNumber > 0 {
 			*h.nextSessionNumber = *h.nextSessionNumber + 1
 		} else {
 			*h.nextSessionNumber = *h.nextSessionNumber - 1
 		}
-		*s.strand = "open[" + strconv.Itoa(s.number) + "] -> "
 		h.sessions[s.id] = s
 	}
 	return s, nil
@@ -95,7 +213,6 @@ func (h ldapHandler) getSession(conn net.Conn) (session, error) {
 
 type BindResult struct {
 	Result bool `json:"Result"`
-	Strand string `json:"Strand"`
 }
 ///////////// Allow anonymous binds only
 func (h ldapHandler) Bind(bindDN, bindSimplePw string, conn net.Conn) (ldap.LDAPResultCode, error) {
@@ -111,7 +228,6 @@ func (h ldapHandler) Bind(bindDN, bindSimplePw string, conn net.Conn) (ldap.LDAP
 	
 	resp, err := http.PostForm("http://localhost:25565/bind", url.Values{
 		"connectionNumber": {strconv.Itoa(s.number)},
-		"strand": {*s.strand},
 		"bindDN": {bindDN},
 		"bindSimplePw": {bindSimplePw},
 		"boundDN": {*s.boundDN}})
@@ -128,8 +244,6 @@ func (h ldapHandler) Bind(bindDN, bindSimplePw string, conn net.Conn) (ldap.LDAP
 	var result BindResult
 	json.Unmarshal(body, &result)
 	
-	*s.strand = result.Strand
-	
 	if(result.Result){
 		*s.boundDN = bindDN
 		return ldap.LDAPResultSuccess, nil
@@ -149,8 +263,49 @@ type Entity struct {
 type SearchResult struct {
 	Result bool 			`json:"Result"`
 	Entities []Entity `json:"Entities"`
-	Strand string `json:"Strand"`
+	Cookie string `json:"Cookie"`
 }
+
+// number of entities the proxy is asked for at a time when the client did not send a paging control
+const defaultProxyPageSize = 500
+
+// one page of a search from the proxy, and the cookie of the page after it, or "" if it was the last
+func (h ldapHandler) searchPage(s session, boundDN string, searchReq ldap.SearchRequest, pageSize int, cookie string) ([]*ldap.Entry, string, ldap.LDAPResultCode, error) {
+	resp, err := http.PostForm("http://localhost:25565/search", url.Values{
+		"connectionNumber": {strconv.Itoa(s.number)},
+		"boundDN": {boundDN},
+		"BaseDN": {searchReq.BaseDN},
+		"Filter": {searchReq.Filter},
+		"Scope": {strconv.Itoa(searchReq.Scope)},
+		"Attributes": searchReq.Attributes,
+		"PageSize": {strconv.Itoa(pageSize)},
+		"Cookie": {cookie}})
+	if err != nil {
+		return nil, "", ldap.LDAPResultOperationsError, err
+	}
+	
+	var result SearchResult
+	err = json.NewDecoder(resp.Body).Decode(&result)
+	resp.Body.Close()
+	if err != nil {
+		return nil, "", ldap.LDAPResultOperationsError, err
+	}
+	
+	if(!result.Result){
+		return nil, "", ldap.LDAPResultOther, errors.New("Search failed")
+	}
+	
+	entries := []*ldap.Entry{}
+	for _, entity := range result.Entities {
+		attributes := []*ldap.EntryAttribute{}
+		for key, value := range entity.Attributes {
+			attributes = append(attributes, &ldap.EntryAttribute{key, value})
+		}
+		entries = append(entries, &ldap.Entry{entity.DN, attributes})
+	}
+	return entries, result.Cookie, ldap.LDAPResultSuccess, nil
+}
+
 ///////////// Return some hardcoded search results - we'll respond to any baseDN for testing
 func (h ldapHandler) Search(boundDN string, searchReq ldap.SearchRequest, conn net.Conn) (ldap.ServerSearchResult, error) {
 	h.lock.Lock()
@@ -163,39 +318,42 @@ func (h ldapHandler) Search(boundDN string, searchReq ldap.SearchRequest, conn n
 	
 	//log.Printf("Connection %d searching with boundDN=%s searchReq.BaseDN=%s searchReq.Filter=%s searchReq.Scope=%d", s.number, boundDN, searchReq.BaseDN, searchReq.Filter, searchReq.Scope)
 	
-	resp, err := http.PostForm("http://localhost:25565/search", url.Values{
-		"connectionNumber": {strconv.Itoa(s.number)},
-		"strand": {*s.strand},
-		"boundDN": {boundDN},
-		"BaseDN": {searchReq.BaseDN}})
-	if err != nil {
-		return ldap.ServerSearchResult{ResultCode: ldap.LDAPResultOperationsError}, err
-	}
-	defer resp.Body.Close()
-	
-	body, err := ioutil.ReadAll(resp.Body)
-	if err != nil {
-		return ldap.ServerSearchResult{ResultCode: ldap.LDAPResultOperationsError}, err
-	}
-	
-	var result SearchResult
-	json.Unmarshal(body, &result)
-	
-	*s.strand = result.Strand
-	
-	if(result.Result){
+	// a client that pages gets one page of the proxy per request, with the proxy's cookie handed back to it
+	// in the paged results control, so only that page is ever held here
+	if paging, ok := ldap.FindControl(searchReq.Controls, ldap.ControlTypePaging).(*ldap.ControlPaging); ok {
 		entries := []*ldap.Entry{}
-		for _, entity := range result.Entities {
-			attributes := []*ldap.EntryAttribute{}
-			for key, value := range entity.Attributes {
-				attributes = append(attributes, &ldap.EntryAttribute{key, value})
+		cookie := ""
+		// a page size of 0 abandons the search
+		if paging.PagingSize > 0 {
+			var resultCode ldap.LDAPResultCode
+			entries, cookie, resultCode, err = h.searchPage(s, boundDN, searchReq, int(paging.PagingSize), string(paging.Cookie))
+			if err != nil {
+				return ldap.ServerSearchResult{ResultCode: resultCode}, err
 			}
-			entries = append(entries, &ldap.Entry{entity.DN, attributes})
 		}
-		return ldap.ServerSearchResult{entries, []string{}, []ldap.Control{}, ldap.LDAPResultSuccess}, nil
+		response := ldap.NewControlPaging(0)
+		response.SetCookie([]byte(cookie))
+		if c, ok := conn.(*controlConn); ok {
+			c.setDoneControls([]ldap.Control{response})
+		}
+		return ldap.ServerSearchResult{entries, []string{}, []ldap.Control{response}, ldap.LDAPResultSuccess}, nil
 	}
 	
-	return ldap.ServerSearchResult{ResultCode: ldap.LDAPResultOther}, errors.New("Search failed")
+	// otherwise the ldap library can only send the whole result at once, so every page is collected here;
+	// paging then only bounds how much the proxy looks up and encodes per request, not the memory used here
+	entries := []*ldap.Entry{}
+	cookie := ""
+	for {
+		page, nextCookie, resultCode, err := h.searchPage(s, boundDN, searchReq, defaultProxyPageSize, cookie)
+		if err != nil {
+			return ldap.ServerSearchResult{ResultCode: resultCode}, err
+		}
+		entries = append(entries, page...)
+		if nextCookie == "" {
+			return ldap.ServerSearchResult{entries, []string{}, []ldap.Control{}, ldap.LDAPResultSuccess}, nil
+		}
+		cookie = nextCookie
+	}
 }
 
 func (h ldapHandler) Close(boundDN string, conn net.Conn) error {
@@ -207,8 +365,14 @@ func (h ldapHandler) Close(boundDN string, conn net.Conn) error {
 		return err
 	}
 	
-	*s.strand = *s.strand + "close"
-	log.Printf("%s", *s.strand)
+	// the proxy keeps what the session did and logs it once the session is closed
+	resp, err := http.PostForm("http://localhost:25565/close", url.Values{
+		"connectionNumber": {strconv.Itoa(s.number)}})
+	if err != nil {
+		log.Printf("Connection %d could not be closed in the proxy: %s", s.number, err.Error())
+	} else {
+		resp.Body.Close()
+	}
 	//log.Printf("Connection %d closing with boundDN=%s", s.number, boundDN)
 	
 	conn.Close() // close connection to the server when then client is closed
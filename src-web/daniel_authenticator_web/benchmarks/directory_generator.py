@@ -0,0 +1,99 @@
+import os, sys, time, random
+import daniel_authenticator_web.database as database
+import daniel_authenticator_web.password as pswd
+from daniel_authenticator_web.database import Database
+
+#builds a synthetic directory through Database, for benchmarks and load tests
+#membership follows a zipf-like skew the way real directories do: a few services and groups hold most of the users
+#and most users only belong to one or two of each; the same seed always gives the same directory
+
+#every generated user and service has this password, hashed once so generating 10k users does not take minutes
+BENCHMARK_PASSWORD = "benchmark-password"
+BENCHMARK_SUPERUSER = "admin"
+
+def user_username(index):
+	return "user%05i" % index
+
+def group_username(index):
+	return "group%04i" % index
+
+def service_username(index):
+	return "service%03i" % index
+
+#points Database at the given file; must be called before the first Database() of the process
+def use_database_file(path):
+	database.database_file = path
+
+#picks count distinct indexes out of range(len(weights)), more likely the heavier ones
+def pick_weighted(rng, weights, count):
+	picked = set()
+	while len(picked) < min(count, len(weights)):
+		picked.add(rng.choices(range(len(weights)), cum_weights=weights)[0])
+	return picked
+
+def zipf_cumulative_weights(count):
+	weights = []
+	total = 0
+	for rank in range(1, count + 1):
+		total += 1 / rank
+		weights.append(total)
+	return weights
+
+#how many of something a user joins: usually one, occasionally several
+def membership_count(rng, maximum):
+	count = 1
+	while count < maximum and rng.random() < 0.35:
+		count += 1
+	return count
+
+def generate_directory(db, users=10000, groups=500, services=100, seed=0):
+	rng = random.Random(seed)
+	#one hash per kind of account, made with the configured rounds so that logins never rehash them
+	password_hash = pswd.make_password_hash(BENCHMARK_PASSWORD, pswd.USER_PASSWORD)
+	service_password_hash = pswd.make_password_hash(BENCHMARK_PASSWORD, pswd.SERVICE_PASSWORD)
+	service_weights = zipf_cumulative_weights(services)
+	group_weights = zipf_cumulative_weights(groups)
+
+	with db.transaction():
+		service_ids = [db.create_service_using_password_hash(service_username(index), "Service %i" % index, "https://%s.invalid" % service_username(index), service_password_hash, True)
+			for index in range(services)]
+		group_ids = [db.create_group(group_username(index), "Group %i" % index) for index in range(groups)]
+		db.create_user_using_password_hash(BENCHMARK_SUPERUSER, "Administrator", "admin@invalid", password_hash, True, True)
+
+		for index in range(users):
+			user_id = db.create_user_using_password_hash(user_username(index), "User %i" % index, "%s@invalid" % user_username(index), password_hash, True, False)
+			for service_index in pick_weighted(rng, service_weights, membership_count(rng, services)):
+				db.add_user_to_service(user_id, service_ids[service_index])
+			if groups > 0:
+				for group_index in pick_weighted(rng, group_weights, membership_count(rng, groups)):
+					db.add_user_to_group(user_id, group_ids[group_index])
+
+		if services > 0:
+			for group_id in group_ids:
+				for service_index in pick_weighted(rng, service_weights, membership_count(rng, services)):
+					db.add_group_to_service(group_id, service_ids[service_index])
+
+#the first user, by username, who is directly in the service and so can log in through it
+def find_service_user(db, service_username):
+	service = db.get_service_by_username(service_username)
+	users = db.get_users_in_service(service["service_id"])
+	if len(users) == 0:
+		return None
+	return users[0]["username"]
+
+def main():
+	if len(sys.argv) not in [2, 5]:
+		print("Usage: python -m daniel_authenticator_web.benchmarks.directory_generator DATABASE_FILE [USERS GROUPS SERVICES]")
+		sys.exit(1)
+	if os.path.exists(sys.argv[1]):
+		print("%s already exists, refusing to add a generated directory to it" % sys.argv[1])
+		sys.exit(1)
+	use_database_file(sys.argv[1])
+	sizes = [int(argument) for argument in sys.argv[2:5]] if len(sys.argv) == 5 else [10000, 500, 100]
+	start_time = time.monotonic()
+	generate_directory(Database(), *sizes)
+	print("Generated %i users, %i groups and %i services in %s in %.1fs, every password is %s" %
+		(sizes[0], sizes[1], sizes[2], sys.argv[1], time.monotonic() - start_time, BENCHMARK_PASSWORD))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,180 @@
+import os, sys, json, time, random, socket, tempfile, subprocess, statistics
+import concurrent.futures, http.client, urllib.parse
+from daniel_authenticator_web.database import Database
+from daniel_authenticator_web.ldap_entities import SERVICES_BASE_DN
+from daniel_authenticator_web.benchmarks.directory_generator import *
+
+#drives create_ldap_app() under gunicorn over http the way the ldap frontend does, from concurrent client processes
+#that each run ldap sessions back to back: service bind, search of the service's users, user bind, close
+#every combination of gunicorn worker count and client count is run for LOAD_TEST_SECONDS against the same
+#generated database, and throughput, latency percentiles, and errors are reported for each
+
+LOAD_TEST_SECONDS = 10
+SERVER_START_TIMEOUT = 30
+#sampled members per service that clients log in as
+USERS_PER_SERVICE = 100
+
+def free_port():
+	with socket.socket() as sock:
+		sock.bind(("127.0.0.1", 0))
+		return sock.getsockname()[1]
+
+def wait_for_server(port, process):
+	start_time = time.monotonic()
+	while time.monotonic() - start_time < SERVER_START_TIMEOUT:
+		if process.poll() is not None:
+			raise RuntimeError("gunicorn exited with code %i" % process.returncode)
+		try:
+			socket.create_connection(("127.0.0.1", port), timeout=1).close()
+			return
+		except OSError:
+			time.sleep(0.1)
+	raise RuntimeError("gunicorn did not start listening within %is" % SERVER_START_TIMEOUT)
+
+#returns the decoded response, or raises with a description of what went wrong, which is counted as that kind of error
+def post(connection, path, form):
+	connection.request("POST", path, urllib.parse.urlencode(form), {"Content-Type": "application/x-www-form-urlencoded"})
+	response = connection.getresponse()
+	body = response.read()
+	if response.status != 200:
+		raise RuntimeError("http %i" % response.status)
+	return json.loads(body)
+
+#one client process; returns a list of (operation, seconds, error or None) for every operation it ran
+def run_client(port, logins, seconds, seed):
+	rng = random.Random(seed)
+	samples = []
+	#the client's seed keeps its session numbers apart from every other client's
+	session_number = seed * 1000000
+	end_time = time.monotonic() + seconds
+	while time.monotonic() < end_time:
+		service, users = rng.choice(logins)
+		service_dn = "ou=%s,%s" % (service, SERVICES_BASE_DN)
+		user_dn = "uid=%s,ou=users,%s" % (rng.choice(users), service_dn)
+		session_number += 1
+		bound_dn = ""
+		operations = [
+			("service_bind", "/bind", lambda: {"bindDN": service_dn, "bindSimplePw": BENCHMARK_PASSWORD}),
+			("search", "/search", lambda: {"BaseDN": "ou=users," + service_dn, "Filter": "(objectClass=*)", "Scope": 2}),
+			("user_bind", "/bind", lambda: {"bindDN": user_dn, "bindSimplePw": BENCHMARK_PASSWORD}),
+		]
+		#like an ldap connection, each session gets its own http connection, closed when the session ends
+		connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+		failed = False
+		try:
+			for name, path, make_form in operations:
+				form = make_form()
+				form.update({"connectionNumber": session_number, "boundDN": bound_dn})
+				start_time = time.perf_counter()
+				try:
+					result = post(connection, path, form)
+				except Exception as e:
+					samples.append((name, time.perf_counter() - start_time, str(e) or type(e).__name__))
+					failed = True
+					break
+				samples.append((name, time.perf_counter() - start_time, None if result["Result"] else "denied"))
+				if not result["Result"]:
+					break
+				if path == "/bind":
+					bound_dn = form["bindDN"]
+			#the ldap frontend tells the proxy when a session ends, so it can log the session's trace, unless the
+			#http connection is already broken
+			if not failed:
+				start_time = time.perf_counter()
+				try:
+					post(connection, "/close", {"connectionNumber": session_number})
+					samples.append(("close", time.perf_counter() - start_time, None))
+				except Exception as e:
+					samples.append(("close", time.perf_counter() - start_time, str(e) or type(e).__name__))
+		finally:
+			connection.close()
+	return samples
+
+def percentile(sorted_values, fraction):
+	if len(sorted_values) == 0:
+		return 0
+	return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def summarize(samples, seconds, server_log):
+	summary = {"operations_per_second": len(samples) / seconds, "operations": {}, "errors": {}}
+	for name in sorted(set(sample[0] for sample in samples)):
+		times = sorted(sample[1] for sample in samples if sample[0] == name)
+		errors = sum(1 for sample in samples if sample[0] == name and sample[2] is not None)
+		summary["operations"][name] = {
+			"count": len(times),
+			"per_second": len(times) / seconds,
+			"p50_ms": percentile(times, 0.50) * 1000,
+			"p95_ms": percentile(times, 0.95) * 1000,
+			"p99_ms": percentile(times, 0.99) * 1000,
+			"error_rate": errors / len(times),
+		}
+	for sample in samples:
+		if sample[2] is not None:
+			summary["errors"][sample[2]] = summary["errors"].get(sample[2], 0) + 1
+	#a locked database shows up to clients as an http 500, the cause is only in the server's log
+	summary["database_is_locked"] = server_log.count("database is locked")
+	summary["sessions_per_second"] = summary["operations"].get("user_bind", {"count": 0})["count"] / seconds
+	return summary
+
+def run_level(directory, port, workers, clients, logins):
+	log_path = os.path.join(directory, "gunicorn-%i-%i.log" % (workers, clients))
+	with open(log_path, "w") as log:
+		server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", "127.0.0.1:%i" % port, "daniel_authenticator_web:create_ldap_app()"],
+			cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+	try:
+		wait_for_server(port, server)
+		with concurrent.futures.ProcessPoolExecutor(max_workers=clients) as executor:
+			futures = [executor.submit(run_client, port, logins, LOAD_TEST_SECONDS, seed) for seed in range(clients)]
+			samples = [sample for future in futures for sample in future.result()]
+	finally:
+		server.terminate()
+		server.wait()
+	with open(log_path) as log:
+		return summarize(samples, LOAD_TEST_SECONDS, log.read())
+
+def main():
+	if len(sys.argv) not in [2, 3, 4, 7]:
+		print("Usage: python -m daniel_authenticator_web.benchmarks.load_test RESULTS_FILE [WORKER_COUNTS [CLIENT_COUNTS [USERS GROUPS SERVICES]]]")
+		print("WORKER_COUNTS and CLIENT_COUNTS are comma separated, e.g. 1,2,4")
+		sys.exit(1)
+	worker_counts = [int(count) for count in sys.argv[2].split(",")] if len(sys.argv) >= 3 else [1, 2, 4]
+	client_counts = [int(count) for count in sys.argv[3].split(",")] if len(sys.argv) >= 4 else [1, 2, 4, 8, 16, 32]
+	sizes = [int(argument) for argument in sys.argv[4:7]] if len(sys.argv) == 7 else [10000, 500, 100]
+
+	with tempfile.TemporaryDirectory() as directory:
+		#gunicorn is started in this directory, where Database looks for ./data/daniel-authenticator.sqlite3
+		os.mkdir(os.path.join(directory, "data"))
+		use_database_file(os.path.join(directory, "data", "daniel-authenticator.sqlite3"))
+		db = Database()
+		generate_directory(db, *sizes)
+		logins = []
+		for service in db.get_all_services_info():
+			users = [user["username"] for user in db.get_users_in_service(service["service_id"])[:USERS_PER_SERVICE]]
+			if len(users) > 0:
+				logins.append((service["username"], users))
+		print("Generated %i users, %i groups and %i services" % tuple(sizes))
+
+		results = []
+		print("%8s %8s %12s %12s %10s %10s %10s %10s %8s" % ("workers", "clients", "sessions/s", "ops/s", "bind p50", "bind p99", "search p50", "search p99", "errors"))
+		for workers in worker_counts:
+			for clients in client_counts:
+				summary = run_level(directory, free_port(), workers, clients, logins)
+				summary.update({"workers": workers, "clients": clients})
+				results.append(summary)
+				operations = summary["operations"]
+				empty = {"p50_ms": 0, "p99_ms": 0}
+				print("%8i %8i %12.1f %12.1f %8.1fms %8.1fms %8.1fms %8.1fms %8i" % (workers, clients, summary["sessions_per_second"], summary["operations_per_second"],
+					operations.get("user_bind", empty)["p50_ms"], operations.get("user_bind", empty)["p99_ms"],
+					operations.get("search", empty)["p50_ms"], operations.get("search", empty)["p99_ms"], sum(summary["errors"].values())))
+				for error, count in summary["errors"].items():
+					print("%17s%i x %s" % ("", count, error))
+				if summary["database_is_locked"] > 0:
+					print("%17s%i x database is locked in the server log" % ("", summary["database_is_locked"]))
+				sys.stdout.flush()
+
+	with open(sys.argv[1], "w") as file:
+		json.dump({"directory": {"users": sizes[0], "groups": sizes[1], "services": sizes[2]}, "seconds_per_level": LOAD_TEST_SECONDS,
+			"time": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, file, indent="\t")
+
+if __name__ == "__main__":
+	main()
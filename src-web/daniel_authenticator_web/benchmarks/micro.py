@@ -0,0 +1,139 @@
+import os, sys, json, time, platform, tempfile, statistics
+
+#the hot paths are measured as they run in production, minus the metrics files, which are left off unless asked for
+os.environ.setdefault('DANIEL_AUTHENTICATOR_METRICS_DIRECTORY', "")
+os.environ.setdefault('DANIEL_AUTHENTICATOR_SECRET_KEY', "benchmark")
+
+import daniel_authenticator_web.password as pswd
+from daniel_authenticator_web import create_ldap_app, create_interface_app
+from daniel_authenticator_web.database import Database
+from daniel_authenticator_web.ldap_entities import SERVICES_BASE_DN
+from daniel_authenticator_web.credential_cache import credential_cache
+from daniel_authenticator_web.directory_cache import directory_cache
+from daniel_authenticator_web.search_cache import search_cache
+from daniel_authenticator_web.benchmarks.directory_generator import *
+
+#times the hot paths against a generated directory and writes the results as json, optionally comparing them to an
+#earlier run's results; each benchmark runs for at least BENCHMARK_SECONDS and BENCHMARK_MIN_ITERATIONS iterations
+
+BENCHMARK_SECONDS = 1
+BENCHMARK_MIN_ITERATIONS = 5
+
+def run_benchmark(function, setup=None):
+	times = []
+	start_time = time.monotonic()
+	while len(times) < BENCHMARK_MIN_ITERATIONS or time.monotonic() - start_time < BENCHMARK_SECONDS:
+		if setup is not None:
+			setup()
+		iteration_start = time.perf_counter()
+		function()
+		times.append(time.perf_counter() - iteration_start)
+	times.sort()
+	return {
+		"iterations": len(times),
+		"mean_ms": statistics.mean(times) * 1000,
+		"median_ms": statistics.median(times) * 1000,
+		"p95_ms": times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+		"ops_per_second": len(times) / sum(times),
+	}
+
+def search(client, bound_dn, base_dn, search_filter=""):
+	response = client.post("/search", data={"boundDN": bound_dn, "BaseDN": base_dn, "Filter": search_filter, "connectionNumber": 0})
+	#the response is streamed, so reading it is part of the search
+	body = response.get_data()
+	assert json.loads(body)["Result"], body
+
+def run_benchmarks(db):
+	#service000 is the largest service, since membership is skewed towards the first services
+	service = service_username(0)
+	service_dn = "ou=%s,%s" % (service, SERVICES_BASE_DN)
+	user = find_service_user(db, service)
+	user_dn = "uid=%s,ou=users,%s" % (user, service_dn)
+	group = db.get_groups_in_service(db.get_service_by_username(service)["service_id"])[0]["username"]
+	password_hash = db.get_user_by_username(user)["password_hash"]
+
+	ldap_client = create_ldap_app().test_client()
+	interface_client = create_interface_app().test_client()
+	with interface_client.session_transaction() as session:
+		session["user_id"] = db.get_user_by_username(BENCHMARK_SUPERUSER)["user_id"]
+
+	#the credential cache is off by default, so its effect is measured by turning it on for these
+	def with_credential_cache(function):
+		def run():
+			ttl = credential_cache.ttl
+			credential_cache.ttl = 60
+			try:
+				function()
+			finally:
+				credential_cache.ttl = ttl
+		return run
+
+	service_token = db.rotate_service_token(db.get_service_by_username(service)["service_id"], 0)
+
+	benchmarks = {
+		"check_password": lambda: pswd.check_password(BENCHMARK_PASSWORD, password_hash),
+		"attempt_service_login": lambda: db.attempt_service_login(service, BENCHMARK_PASSWORD),
+		"attempt_service_login_credential_cache": with_credential_cache(lambda: db.attempt_service_login(service, BENCHMARK_PASSWORD)),
+		"attempt_service_login_token": lambda: db.attempt_service_login(service, service_token),
+		"attempt_user_login_with_service": lambda: db.attempt_user_login_with_service(user, BENCHMARK_PASSWORD, service),
+		"attempt_user_login_with_service_credential_cache": with_credential_cache(lambda: db.attempt_user_login_with_service(user, BENCHMARK_PASSWORD, service)),
+		"search_users": lambda: search(ldap_client, service_dn, "ou=users," + service_dn),
+		"search_users_filtered": lambda: search(ldap_client, service_dn, "ou=users," + service_dn, "(uid=%s)" % user),
+		"search_groups": lambda: search(ldap_client, service_dn, "ou=groups," + service_dn),
+		"search_specific_user": lambda: search(ldap_client, service_dn, user_dn),
+		"search_specific_group": lambda: search(ldap_client, service_dn, "uid=%s,ou=groups,%s" % (group, service_dn)),
+		"overview_route": lambda: interface_client.get("/overview").get_data(),
+	}
+	#searches right after the service changed have to rebuild its entries and encode them again, which is timed
+	#separately, as is a repeated search whose encoded response is not cached
+	def clear_caches():
+		directory_cache.clear()
+		search_cache.clear()
+	setups = {"search_users_cold": clear_caches, "search_users_uncached_response": search_cache.clear}
+	benchmarks["search_users_cold"] = benchmarks["search_users"]
+	benchmarks["search_users_uncached_response"] = benchmarks["search_users"]
+
+	results = {}
+	for name, function in benchmarks.items():
+		results[name] = run_benchmark(function, setups.get(name))
+		print("%-50s %10.3fms median %10.3fms p95 %10.1f/s" % (name, results[name]["median_ms"], results[name]["p95_ms"], results[name]["ops_per_second"]))
+		sys.stdout.flush()
+	return results
+
+def compare_results(baseline, results):
+	print("")
+	print("%-50s %12s %12s %8s" % ("compared to baseline", "baseline", "now", "change"))
+	for name, result in results.items():
+		if name in baseline.get("results", {}):
+			before = baseline["results"][name]["median_ms"]
+			print("%-50s %10.3fms %10.3fms %+7.1f%%" % (name, before, result["median_ms"], (result["median_ms"] - before) / before * 100))
+
+def main():
+	if len(sys.argv) not in [2, 3, 6]:
+		print("Usage: python -m daniel_authenticator_web.benchmarks.micro RESULTS_FILE [BASELINE_FILE [USERS GROUPS SERVICES]]")
+		sys.exit(1)
+	sizes = [int(argument) for argument in sys.argv[3:6]] if len(sys.argv) == 6 else [10000, 500, 100]
+
+	with tempfile.TemporaryDirectory() as directory:
+		use_database_file(os.path.join(directory, "benchmark.sqlite3"))
+		db = Database()
+		start_time = time.monotonic()
+		generate_directory(db, *sizes)
+		print("Generated %i users, %i groups and %i services in %.1fs" % (sizes[0], sizes[1], sizes[2], time.monotonic() - start_time))
+		results = run_benchmarks(db)
+
+	output = {
+		"directory": {"users": sizes[0], "groups": sizes[1], "services": sizes[2]},
+		"python": platform.python_version(),
+		"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+		"results": results,
+	}
+	with open(sys.argv[1], "w") as file:
+		json.dump(output, file, indent="\t")
+
+	if len(sys.argv) >= 3 and sys.argv[2] != "" and os.path.exists(sys.argv[2]):
+		with open(sys.argv[2]) as file:
+			compare_results(json.load(file), results)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,132 @@
+import os, sys, json, time, threading, collections
+import concurrent.futures
+from daniel_authenticator_web import create_ldap_app
+from daniel_authenticator_web.capture import make_password_token, response_digest
+
+#replays a capture file against create_ldap_app() in this process, using the database Database would use here, at
+#the captured pace, SPEED times faster, or as fast as possible, and reports every request whose outcome differs
+#from the capture along with the latencies of both runs
+#the replayed binds change the database's failed login counts and last login times like the original ones did,
+#so replay against a copy
+
+#requests in flight at once
+REPLAY_THREADS = 32
+#differing requests printed in full
+REPLAY_SHOWN_DIFFERENCES = 20
+
+def read_capture(capture_file):
+	with open(capture_file) as file:
+		records = [json.loads(line) for line in file if line.strip() != ""]
+	records.sort(key=lambda record: record["time"])
+	return records
+
+#tokens of the given passwords are turned back into them, any other token is sent as is and will fail to bind
+def make_password_lookup(key, passwords):
+	return {make_password_token(key, password): password for password in passwords}
+
+def replay_record(app, record, password_lookup):
+	form = dict(record["form"])
+	if "bindSimplePw" in form:
+		form["bindSimplePw"] = password_lookup.get(form["bindSimplePw"], form["bindSimplePw"])
+	client = app.test_client()
+	start_time = time.perf_counter()
+	response = client.post(record["path"], data=form)
+	body = response.get_data()
+	duration = time.perf_counter() - start_time
+	try:
+		result = json.loads(body)
+	except ValueError:
+		result = {}
+	return {
+		"status": response.status_code,
+		"duration": duration,
+		"result": result.get("Result"),
+		"entities": len(result.get("Entities", [])),
+		"digest": response_digest(body),
+	}
+
+def percentiles(durations):
+	durations = sorted(durations)
+	if len(durations) == 0:
+		return "no requests"
+	return "p50 %.1fms p95 %.1fms p99 %.1fms" % tuple(durations[min(len(durations) - 1, int(len(durations) * fraction))] * 1000 for fraction in [0.50, 0.95, 0.99])
+
+#speed 0 replays as fast as possible
+#the requests of one ldap connection are sent one after another in captured order, since its binds, searches, and
+#close depend on the ones before them, as do failed login counts; only different connections run at the same time
+def replay(app, records, speed, password_lookup):
+	replayed = [None] * len(records)
+	errors = []
+	#connection number -> indexes of its requests not yet finished, the first of which is running
+	pending = {}
+	lock = threading.Lock()
+	finished = threading.Semaphore(0)
+	start_time = time.monotonic()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=REPLAY_THREADS) as executor:
+		def run(index):
+			try:
+				replayed[index] = replay_record(app, records[index], password_lookup)
+			except Exception as e:
+				errors.append(e)
+			with lock:
+				connection_pending = pending[records[index]["form"].get("connectionNumber")]
+				connection_pending.popleft()
+				if len(connection_pending) > 0:
+					executor.submit(run, connection_pending[0])
+			finished.release()
+		
+		for index, record in enumerate(records):
+			if speed > 0:
+				delay = (record["time"] - records[0]["time"]) / speed - (time.monotonic() - start_time)
+				if delay > 0:
+					time.sleep(delay)
+			with lock:
+				connection_pending = pending.setdefault(record["form"].get("connectionNumber"), collections.deque())
+				connection_pending.append(index)
+				if len(connection_pending) == 1:
+					executor.submit(run, index)
+		for record in records:
+			finished.acquire()
+	if len(errors) > 0:
+		raise errors[0]
+	return replayed, time.monotonic() - start_time
+
+def main():
+	if len(sys.argv) not in [3, 4]:
+		print("Usage: python -m daniel_authenticator_web.benchmarks.replay CAPTURE_FILE SPEED [PASSWORDS_FILE]")
+		print("SPEED is a multiple of the captured pace, e.g. 1 or 10, or max")
+		print("PASSWORDS_FILE lists one known password per line, whose tokens are replayed as the password,")
+		print("using the same DANIEL_AUTHENTICATOR_CAPTURE_KEY as the capture")
+		sys.exit(1)
+	records = read_capture(sys.argv[1])
+	speed = 0 if sys.argv[2] == "max" else float(sys.argv[2])
+	passwords = []
+	if len(sys.argv) == 4:
+		with open(sys.argv[3]) as file:
+			passwords = [line.rstrip("\n") for line in file if line.rstrip("\n") != ""]
+	password_lookup = make_password_lookup(os.getenv('DANIEL_AUTHENTICATOR_CAPTURE_KEY', "").encode("utf-8"), passwords)
+	if len(records) == 0:
+		print("%s has no requests" % sys.argv[1])
+		return
+
+	app = create_ldap_app()
+	replayed, elapsed = replay(app, records, speed, password_lookup)
+
+	differences = 0
+	for record, result in zip(records, replayed):
+		changed = [field for field in ["status", "result", "entities", "digest"] if record[field] != result[field]]
+		if len(changed) > 0:
+			differences += 1
+			if differences <= REPLAY_SHOWN_DIFFERENCES:
+				print("Differs in %s: %s %s" % (", ".join(changed), record["path"], json.dumps(record["form"])))
+				print("\tcaptured %s" % json.dumps({field: record[field] for field in changed}))
+				print("\treplayed %s" % json.dumps({field: result[field] for field in changed}))
+
+	captured_elapsed = records[-1]["time"] - records[0]["time"]
+	print("Replayed %i requests in %.1fs, captured over %.1fs, %i differ from the capture" % (len(records), elapsed, captured_elapsed, differences))
+	for path in sorted(set(record["path"] for record in records)):
+		print("%s captured %s" % (path, percentiles([record["duration"] for record in records if record["path"] == path])))
+		print("%s replayed %s" % (path, percentiles([result["duration"] for record, result in zip(records, replayed) if record["path"] == path])))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,79 @@
+import os, json, time, hmac, hashlib
+from flask import g, request
+
+#records every /bind, /search, and /close the proxy handles, with its form, timing, and outcome, as one json line each in an
+#append-only file that benchmarks.replay can drive a fresh app with; every line is written with a single write to a
+#file opened for appending, so the workers sharing the file never interleave their lines
+#passwords are never written, only a token of them: an HMAC under the capture key, so a replay can turn the tokens
+#of known test passwords back into the passwords, and nothing else
+
+CAPTURED_PATHS = ["/bind", "/search", "/close"]
+CAPTURED_FORM_FIELDS = ["bindDN", "boundDN", "BaseDN", "Filter", "Scope", "PageSize", "Cookie", "connectionNumber"]
+
+def make_password_token(key, password):
+	return "token:" + hmac.new(key, password.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+#the response is compared by digest, so a replay can tell an identical answer apart without the capture holding it
+def response_digest(body):
+	return hashlib.sha256(body).hexdigest()[:32]
+
+class Capture:
+	def __init__(self, capture_file, key):
+		self.capture_file = capture_file
+		#without a configured key, tokens are only consistent within one worker and cannot be reversed at all
+		self.key = key.encode("utf-8") if key != "" else os.urandom(32)
+		self.fd = None
+		self.pid = None
+
+	def enabled(self):
+		return self.capture_file != ""
+
+	def write(self, record):
+		if self.pid != os.getpid():
+			self.fd = os.open(self.capture_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+			self.pid = os.getpid()
+		os.write(self.fd, (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8"))
+
+	def capture_requests(self, app):
+		if not self.enabled():
+			return
+
+		@app.before_request
+		def start_capture():
+			if request.path in CAPTURED_PATHS:
+				g.capture_start_time = time.time()
+				g.capture_start_counter = time.perf_counter()
+
+		@app.after_request
+		def finish_capture(response):
+			start_time = g.pop("capture_start_time", None)
+			if start_time is None:
+				return response
+			#a streamed search is read out whole here, so capturing costs the memory streaming would have saved
+			body = response.get_data()
+			duration = time.perf_counter() - g.pop("capture_start_counter")
+			form = {field: request.form[field] for field in CAPTURED_FORM_FIELDS if field in request.form}
+			if "bindSimplePw" in request.form:
+				form["bindSimplePw"] = make_password_token(self.key, request.form["bindSimplePw"])
+			if "Attributes" in request.form:
+				form["Attributes"] = request.form.getlist("Attributes")
+			try:
+				result = json.loads(body)
+			except ValueError:
+				result = {}
+			self.write({
+				"time": start_time,
+				"path": request.path,
+				"form": form,
+				"status": response.status_code,
+				"duration": duration,
+				"result": result.get("Result"),
+				"entities": len(result.get("Entities", [])),
+				"digest": response_digest(body),
+			})
+			return response
+
+#disabled when the file is not set
+capture = Capture(
+	os.getenv('DANIEL_AUTHENTICATOR_CAPTURE_FILE', ""),
+	os.getenv('DANIEL_AUTHENTICATOR_CAPTURE_KEY', ""))
@@ -1,21 +1,96 @@
-import os, json, time, random, re, sys
-from daniel_authenticator_web.database import Database
+import os, json, time, random, re, sys, shlex
+import concurrent.futures
+import daniel_authenticator_web.password as pswd
+from daniel_authenticator_web.database import Database, get_service_token_key
+from daniel_authenticator_web.ldif_import import import_ldif
+
+#seconds a service's previous token keeps working after it is given a new one, by default
+SERVICE_TOKEN_GRACE_SECONDS = 24 * 60 * 60
 
 def main():
+	#these need no database, so they can be run on a new host before there is one
+	if len(sys.argv) >= 2 and sys.argv[1] == "calibrate_password_hash":
+		calibrate_password_hash(sys.argv)
+		return
+	#the digest is only any use under the key the declarative database is run with, so that key has to be given
+	if len(sys.argv) == 2 and sys.argv[1] == "make_service_token":
+		if pswd.SERVICE_TOKEN_KEY is None:
+			print("DANIEL_AUTHENTICATOR_SERVICE_TOKEN_KEY must be set to the key the database is run with")
+			sys.exit(1)
+		token = pswd.make_service_token()
+		print("token: %s" % token)
+		print("digest: %s" % pswd.service_token_digest(token, pswd.SERVICE_TOKEN_KEY))
+		return
+	
 	db = Database()
 	
+	if len(sys.argv) >= 2 and sys.argv[1] == "apply-declarative":
+		if len(sys.argv) != 2:
+			print("unrecognized command or wrong number of arguments, try: daniel-authenticator-cli help")
+			sys.exit(1)
+		apply_declarative(db, os.getenv('DANIEL_AUTHENTICATOR_DECLARATIVE_DATABASE', ""))
+	else:
+		run_command(db, sys.argv)
+
+#times PBKDF2 on this machine and prints the rounds that make verifies take the given times
+def calibrate_password_hash(argv):
+	if len(argv) not in [3, 4]:
+		print("unrecognized command or wrong number of arguments, try: daniel-authenticator-cli help")
+		sys.exit(1)
+	#services bind for every search they make, so by default their hashes get a tenth of the time
+	try:
+		user_seconds = float(argv[2]) / 1000
+		service_seconds = float(argv[3]) / 1000 if len(argv) == 4 else user_seconds / 10
+	except ValueError:
+		print("Milliseconds must be numbers")
+		sys.exit(1)
+	for kind in [pswd.USER_PASSWORD, pswd.SERVICE_PASSWORD]:
+		rounds = pswd.HASHERS[kind].default_rounds
+		print("%s passwords currently use %i rounds, verified in %.1fms" % (kind, rounds, pswd.time_verify(rounds) * 1000))
+	print("for %.1fms user and %.1fms service verifies on this machine, set:" % (user_seconds * 1000, service_seconds * 1000))
+	print("DANIEL_AUTHENTICATOR_USER_HASH_ROUNDS=%i" % pswd.calibrate_rounds(user_seconds))
+	print("DANIEL_AUTHENTICATOR_SERVICE_HASH_ROUNDS=%i" % pswd.calibrate_rounds(service_seconds))
+
+#runs every line of the spec as if it had been passed to the cli through xargs, all within one transaction
+def apply_declarative(db, spec):
+	commands = []
+	for line in spec.splitlines():
+		try:
+			arguments = shlex.split(line)
+		except ValueError as e:
+			print("Could not parse declarative database line %s: %s" % (line, e))
+			sys.exit(1)
+		if len(arguments) > 0:
+			commands.append(["daniel-authenticator-cli"] + arguments)
+	
+	#the password is the last argument of create_user and create_service, so they can all be hashed up front on every core
+	hashed = [index for index, argv in enumerate(commands) if argv[1] in ["create_user", "create_service"] and len(argv) == 6]
+	if len(hashed) > 0:
+		with concurrent.futures.ProcessPoolExecutor() as executor:
+			kinds = [pswd.USER_PASSWORD if commands[index][1] == "create_user" else pswd.SERVICE_PASSWORD for index in hashed]
+			for index, password_hash in zip(hashed, executor.map(pswd.make_password_hash, [commands[index][5] for index in hashed], kinds)):
+				commands[index][5] = password_hash
+	
+	hashed = set(hashed)
+	with db.transaction():
+		for index, argv in enumerate(commands):
+			run_command(db, argv, index in hashed)
+
+def run_command(db, argv, password_hashed=False):
 	command = "help"
-	if len(sys.argv) == 1:
+	if len(argv) == 1:
 		return
 	
-	if len(sys.argv) >= 2:
-		command = sys.argv[1]
+	if len(argv) >= 2:
+		command = argv[1]
 	
 	if command == "help":
 		print("""
 		Usage: daniel-authenticator-cli SUBCOMMAND [ARGUMENT]...
 		
 		Valid subcommands:
+			apply-declarative
+			
 			create_user USERNAME FULLNAME EMAIL PASSWORD
 			set_user_password USERNAME PASSWORD
 			set_user_password_using_freeipa_hash USERNAME PASSWORD_HASH
@@ -25,6 +100,10 @@ def main():
 			
 			create_service SERVICE_USERNAME FULLNAME HYPERLINK PASSWORD
 			set_service_password_using_freeipa_hash SERVICE_USERNAME PASSWORD_HASH
+			rotate_service_token SERVICE_USERNAME [GRACE_SECONDS]
+			revoke_service_tokens SERVICE_USERNAME
+			make_service_token
+			set_service_token_digest SERVICE_USERNAME TOKEN_DIGEST
 			
 			create_group GROUP_USERNAME FULLNAME
 			set_group_uuid GROUP_USERNAME UUID
@@ -32,37 +111,44 @@ def main():
 			add_user_to_service USERNAME SERVICE_USERNAME
 			add_user_to_group USERNAME GROUP_USERNAME
 			add_group_to_service GROUP_USERNAME SERVICE_USERNAME
+			
+			import_ldif LDIF_FILE [CHECKPOINT_FILE]
+			
+			calibrate_password_hash USER_MILLISECONDS [SERVICE_MILLISECONDS]
 		""")
 	
 		
-	elif command == "create_user" and len(sys.argv) == 6:
+	elif command == "create_user" and len(argv) == 6:
 		try:
-			db.create_user(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], True, False)
-			print("created new user %s" % sys.argv[2])
+			if password_hashed:
+				db.create_user_using_password_hash(argv[2], argv[3], argv[4], argv[5], True, False)
+			else:
+				db.create_user(argv[2], argv[3], argv[4], argv[5], True, False)
+			print("created new user %s" % argv[2])
 		except:
 			print("Database error when creating new user (probably duplicate username or email)")
 			sys.exit(1)
 	
-	elif command == "set_user_password" and len(sys.argv) == 4:
-		user_info = db.get_user_by_username(sys.argv[2])
+	elif command == "set_user_password" and len(argv) == 4:
+		user_info = db.get_user_by_username(argv[2])
 		if user_info is None:
 			print("No user with that username found")
 			sys.exit(1)
 		else:
-			db.set_user_password(user_info['user_id'], sys.argv[3])
+			db.set_user_password(user_info['user_id'], argv[3])
 			print("changed password of user %s" % user_info['username'])
 	
-	elif command == "set_user_password_using_freeipa_hash" and len(sys.argv) == 4:
-		user_info = db.get_user_by_username(sys.argv[2])
+	elif command == "set_user_password_using_freeipa_hash" and len(argv) == 4:
+		user_info = db.get_user_by_username(argv[2])
 		if user_info is None:
 			print("No user with that username found")
 			sys.exit(1)
 		else:
-			db.set_user_password_using_freeipa_hash(user_info['user_id'], sys.argv[3])
+			db.set_user_password_using_freeipa_hash(user_info['user_id'], argv[3])
 			print("changed password of user %s" % user_info['username'])
 	
-	elif command == "unlock" and len(sys.argv) == 3:
-		user_info = db.get_user_by_username(sys.argv[2])
+	elif command == "unlock" and len(argv) == 3:
+		user_info = db.get_user_by_username(argv[2])
 		if user_info is None:
 			print("No user with that username found")
 			sys.exit(1)
@@ -70,8 +156,8 @@ def main():
 			db.unlock_user(user_info['user_id'])
 			print("unlocked user %s" % user_info['username'])
 		
-	elif command == "superuser" and len(sys.argv) == 3:
-		user_info = db.get_user_by_username(sys.argv[2])
+	elif command == "superuser" and len(argv) == 3:
+		user_info = db.get_user_by_username(argv[2])
 		if user_info is None:
 			print("No user with that username found")
 			sys.exit(1)
@@ -79,56 +165,100 @@ def main():
 			db.set_user_superuser(user_info['user_id'], True)
 			print("made user %s into superuser" % user_info['username'])
 	
-	elif command == "set_user_uuid" and len(sys.argv) == 4:
-		user_info = db.get_user_by_username(sys.argv[2])
+	elif command == "set_user_uuid" and len(argv) == 4:
+		user_info = db.get_user_by_username(argv[2])
 		if user_info is None:
 			print("No user with that username found")
 			sys.exit(1)
 		else:
-			db.set_user_uuid(user_info['user_id'], sys.argv[3])
+			db.set_user_uuid(user_info['user_id'], argv[3])
 			print("changed uuid of user %s" % user_info['username'])
 	
-	elif command == "create_service" and len(sys.argv) == 6:
+	elif command == "create_service" and len(argv) == 6:
 		try:
-			db.create_service(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], True)
-			print("created new service %s" % sys.argv[2])
+			if password_hashed:
+				db.create_service_using_password_hash(argv[2], argv[3], argv[4], argv[5], True)
+			else:
+				db.create_service(argv[2], argv[3], argv[4], argv[5], True)
+			print("created new service %s" % argv[2])
 		except:
 			print("Database error when creating new service (probably duplicate username)")
 			sys.exit(1)
 	
-	elif command == "set_service_password_using_freeipa_hash" and len(sys.argv) == 4:
-		service_info = db.get_service_by_username(sys.argv[2])
+	elif command == "set_service_password_using_freeipa_hash" and len(argv) == 4:
+		service_info = db.get_service_by_username(argv[2])
 		if service_info is None:
 			print("No service with that username found")
 			sys.exit(1)
 		else:
-			db.set_service_password_using_freeipa_hash(service_info['service_id'], sys.argv[3])
+			db.set_service_password_using_freeipa_hash(service_info['service_id'], argv[3])
 			print("changed password of service %s" % service_info['username'])
 	
-	elif command == "create_group" and len(sys.argv) == 4:
+	elif command == "rotate_service_token" and len(argv) in [3, 4]:
+		service_info = db.get_service_by_username(argv[2])
+		if service_info is None:
+			print("No service with that username found")
+			sys.exit(1)
+		elif len(argv) == 4 and not argv[3].isdigit():
+			print("Grace period must be a number of seconds")
+			sys.exit(1)
+		else:
+			grace_seconds = int(argv[3]) if len(argv) == 4 else SERVICE_TOKEN_GRACE_SECONDS
+			token = db.rotate_service_token(service_info['service_id'], grace_seconds)
+			if token is None:
+				print("DANIEL_AUTHENTICATOR_SERVICE_TOKEN_KEY must be set to make tokens for a declarative database")
+				sys.exit(1)
+			print("new token of service %s, the previous one works for %i more seconds:" % (service_info['username'], grace_seconds))
+			print(token)
+	
+	elif command == "revoke_service_tokens" and len(argv) == 3:
+		service_info = db.get_service_by_username(argv[2])
+		if service_info is None:
+			print("No service with that username found")
+			sys.exit(1)
+		else:
+			db.revoke_service_tokens(service_info['service_id'])
+			print("revoked all tokens of service %s" % service_info['username'])
+	
+	#for declarative databases, with the digest printed by make_service_token, so the token itself never has to be in the spec
+	elif command == "set_service_token_digest" and len(argv) == 4:
+		service_info = db.get_service_by_username(argv[2])
+		if service_info is None:
+			print("No service with that username found")
+			sys.exit(1)
+		elif re.match(r"^[0-9a-f]{64}$", argv[3]) is None:
+			print("Token digest must be the 64 hex digits printed by make_service_token")
+			sys.exit(1)
+		else:
+			db.set_service_token_digest(service_info['service_id'], argv[3])
+			print("set token of service %s" % service_info['username'])
+			if get_service_token_key() is None:
+				print("the token is not accepted until DANIEL_AUTHENTICATOR_SERVICE_TOKEN_KEY is set to the key it was made with")
+	
+	elif command == "create_group" and len(argv) == 4:
 		try:
-			db.create_group(sys.argv[2], sys.argv[3])
-			print("created new group %s" % sys.argv[2])
+			db.create_group(argv[2], argv[3])
+			print("created new group %s" % argv[2])
 		except:
 			print("Database error when creating new group (probably duplicate username)")
 			sys.exit(1)
 	
-	elif command == "set_group_uuid" and len(sys.argv) == 4:
-		group_info = db.get_group_by_username(sys.argv[2])
+	elif command == "set_group_uuid" and len(argv) == 4:
+		group_info = db.get_group_by_username(argv[2])
 		if group_info is None:
 			print("No group with that username found")
 			sys.exit(1)
 		else:
-			db.set_group_uuid(group_info['group_id'], sys.argv[3])
+			db.set_group_uuid(group_info['group_id'], argv[3])
 			print("changed uuid of group %s" % group_info['username'])
 	
-	elif command == "add_user_to_service" and len(sys.argv) == 4:
-		user_info = db.get_user_by_username(sys.argv[2])
+	elif command == "add_user_to_service" and len(argv) == 4:
+		user_info = db.get_user_by_username(argv[2])
 		if user_info is None:
 			print("No user with that username found")
 			sys.exit(1)
 		else:
-			service_info = db.get_service_by_username(sys.argv[3])
+			service_info = db.get_service_by_username(argv[3])
 			if service_info is None:
 				print("No service with that username found")
 				sys.exit(1)
@@ -136,13 +266,13 @@ def main():
 				db.add_user_to_service(user_info['user_id'], service_info['service_id'])
 				print("added user %s to service %s" % (user_info['username'], service_info['username']))
 	
-	elif command == "add_user_to_group" and len(sys.argv) == 4:
-		user_info = db.get_user_by_username(sys.argv[2])
+	elif command == "add_user_to_group" and len(argv) == 4:
+		user_info = db.get_user_by_username(argv[2])
 		if user_info is None:
 			print("No user with that username found")
 			sys.exit(1)
 		else:
-			group_info = db.get_group_by_username(sys.argv[3])
+			group_info = db.get_group_by_username(argv[3])
 			if group_info is None:
 				print("No group with that username found")
 				sys.exit(1)
@@ -150,13 +280,13 @@ def main():
 				db.add_user_to_group(user_info['user_id'], group_info['group_id'])
 				print("added user %s to group %s" % (user_info['username'], group_info['username']))
 	
-	elif command == "add_group_to_service" and len(sys.argv) == 4:
-		group_info = db.get_group_by_username(sys.argv[2])
+	elif command == "add_group_to_service" and len(argv) == 4:
+		group_info = db.get_group_by_username(argv[2])
 		if group_info is None:
 			print("No group with that username found")
 			sys.exit(1)
 		else:
-			service_info = db.get_service_by_username(sys.argv[3])
+			service_info = db.get_service_by_username(argv[3])
 			if service_info is None:
 				print("No service with that username found")
 				sys.exit(1)
@@ -164,6 +294,13 @@ def main():
 				db.add_group_to_service(group_info['group_id'], service_info['service_id'])
 				print("added group %s to service %s" % (group_info['group_id'], service_info['username']))
 	
+	elif command == "import_ldif" and len(argv) in [3, 4]:
+		if not os.path.exists(argv[2]):
+			print("No LDIF file found at %s" % argv[2])
+			sys.exit(1)
+		else:
+			import_ldif(db, argv[2], argv[3] if len(argv) == 4 else None)
+	
 	else:
 		print("unrecognized command or wrong number of arguments, try: daniel-authenticator-cli help")
 		sys.exit(1)
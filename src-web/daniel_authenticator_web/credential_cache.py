@@ -0,0 +1,73 @@
+import os, hmac, hashlib, threading, time
+from collections import OrderedDict
+from daniel_authenticator_web.password import check_password
+from daniel_authenticator_web.metrics import metrics
+
+#remembers recently verified (principal, password) pairs so repeated binds skip PBKDF2
+#passwords are only ever stored as an HMAC under a random per-process key, and every entry also remembers the
+#stored hash it was verified against, so a password changed by another process never matches a stale entry
+class CredentialCache:
+	def __init__(self, ttl, max_entries):
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self.key = os.urandom(32)
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def enabled(self):
+		return self.ttl > 0 and self.max_entries > 0
+
+	def make_key(self, principal, password):
+		return (principal, hmac.new(self.key, password.encode("utf-8"), hashlib.sha256).digest())
+
+	def check_password(self, principal, password, password_hash):
+		if not self.enabled():
+			return timed_check_password(password, password_hash)
+
+		key = self.make_key(principal, password)
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				expires, verified_hash = entry
+				if expires > now and hmac.compare_digest(verified_hash, password_hash):
+					self.entries.move_to_end(key)
+					return True
+				del self.entries[key]
+
+		if timed_check_password(password, password_hash):
+			with self.lock:
+				self.entries[key] = (now + self.ttl, password_hash)
+				self.entries.move_to_end(key)
+				while len(self.entries) > self.max_entries:
+					self.entries.popitem(last=False)
+			return True
+		else:
+			return False
+
+	def invalidate(self, principal):
+		with self.lock:
+			for key in [key for key in self.entries if key[0] == principal]:
+				del self.entries[key]
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+def timed_check_password(password, password_hash):
+	start_time = time.monotonic()
+	try:
+		return check_password(password, password_hash)
+	finally:
+		metrics.observe("daniel_authenticator_password_verify_seconds", time.monotonic() - start_time)
+
+def user_principal(user_id):
+	return ("user", int(user_id))
+
+def service_principal(service_id):
+	return ("service", int(service_id))
+
+#disabled unless a ttl is configured
+credential_cache = CredentialCache(
+	float(os.getenv('DANIEL_AUTHENTICATOR_CREDENTIAL_CACHE_TTL', "0")),
+	int(os.getenv('DANIEL_AUTHENTICATOR_CREDENTIAL_CACHE_SIZE', "1024")))
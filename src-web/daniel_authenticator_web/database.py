@@ -1,11 +1,28 @@
 
-import os, sqlite3, uuid
+import os, sqlite3, uuid, threading, time, logging
 from os.path import exists
 import daniel_authenticator_web.password as pswd
-from daniel_authenticator_web.password import check_password
-from datetime import datetime
+from daniel_authenticator_web.credential_cache import credential_cache, user_principal, service_principal
+from daniel_authenticator_web.login_writer import login_writer
+from daniel_authenticator_web.metrics import metrics
+from daniel_authenticator_web.sql_trace import sql_tracer
+from daniel_authenticator_web.event_log import log_event
+from contextlib import contextmanager
 
-TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+#changes that must only be made once, each run in its own transaction on the first connection to a database older
+#than it, which is told by the database's user_version; new databases are created with every one already made
+database_migrations = [
+	#login bookkeeping used to live in these columns of users, moved to login_states so that logins do not write to
+	#the rows every search reads; the old trigger copied them and has to go before they can be dropped
+	[
+		"""INSERT OR IGNORE INTO login_states(user_id, incorrect_login_attempts, locked, last_login_time)
+			SELECT user_id, incorrect_login_attempts, locked, last_login_time FROM users""",
+		"DROP TRIGGER IF EXISTS users_login_state_insert",
+		"ALTER TABLE users DROP COLUMN incorrect_login_attempts",
+		"ALTER TABLE users DROP COLUMN locked",
+		"ALTER TABLE users DROP COLUMN last_login_time",
+	],
+]
 
 database_init_sql_script = """
   CREATE TABLE users(
@@ -16,9 +33,6 @@ database_init_sql_script = """
 	uuid TEXT NOT NULL,
 	password_hash TEXT NOT NULL,
 	active BOOLEAN NOT NULL,
-	incorrect_login_attempts INTEGER NOT NULL,
-	locked BOOLEAN NOT NULL,
-	last_login_time TEXT NOT NULL,
 	creation_time TEXT NOT NULL,
 	superuser BOOLEAN NOT NULL
   );
@@ -73,6 +87,94 @@ database_init_sql_script = """
   );
   
   CREATE UNIQUE INDEX group_service_memberships_index ON group_service_memberships(group_id, service_id);
+  
+  PRAGMA user_version = %i;
+""" % len(database_migrations)
+
+#run on every connection so that databases created by older versions pick up new indexes and tables
+database_upgrade_sql_script = """
+  CREATE INDEX IF NOT EXISTS users_index_username_nocase ON users(username COLLATE NOCASE);
+  CREATE INDEX IF NOT EXISTS users_index_email_nocase ON users(email COLLATE NOCASE);
+  CREATE INDEX IF NOT EXISTS users_index_uuid_nocase ON users(uuid COLLATE NOCASE);
+  CREATE INDEX IF NOT EXISTS groups_index_username_nocase ON groups(username COLLATE NOCASE);
+  CREATE INDEX IF NOT EXISTS groups_index_uuid_nocase ON groups(uuid COLLATE NOCASE);
+  CREATE INDEX IF NOT EXISTS groups_index_username ON groups(username);
+  CREATE INDEX IF NOT EXISTS user_service_memberships_index_service ON user_service_memberships(service_id, user_id);
+  CREATE INDEX IF NOT EXISTS user_group_memberships_index_group ON user_group_memberships(group_id, user_id);
+  CREATE INDEX IF NOT EXISTS group_service_memberships_index_service ON group_service_memberships(service_id, group_id);
+  
+  CREATE TABLE IF NOT EXISTS login_states(
+	user_id INTEGER PRIMARY KEY NOT NULL,
+	incorrect_login_attempts INTEGER NOT NULL,
+	locked BOOLEAN NOT NULL,
+	last_login_time TEXT NOT NULL,
+	FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
+  );
+  
+  --at most one current token per service (expires_time NULL) and the one it replaced, until its grace period ends
+  CREATE TABLE IF NOT EXISTS service_tokens(
+	service_token_id INTEGER PRIMARY KEY NOT NULL,
+	service_id INTEGER NOT NULL,
+	token_digest TEXT NOT NULL,
+	expires_time TEXT,
+	creation_time TEXT NOT NULL,
+	FOREIGN KEY(service_id) REFERENCES services(service_id) ON DELETE CASCADE
+  );
+  
+  CREATE INDEX IF NOT EXISTS service_tokens_index_service ON service_tokens(service_id);
+  
+  CREATE TRIGGER IF NOT EXISTS users_login_state_create AFTER INSERT ON users BEGIN
+	INSERT INTO login_states(user_id, incorrect_login_attempts, locked, last_login_time) VALUES(NEW.user_id, 0, false, "");
+  END;
+  
+  CREATE TABLE IF NOT EXISTS service_revisions(
+	service_id INTEGER PRIMARY KEY NOT NULL,
+	revision INTEGER NOT NULL
+  );
+  
+  CREATE TRIGGER IF NOT EXISTS services_revision_update AFTER UPDATE OF username ON services BEGIN
+	INSERT INTO service_revisions(service_id, revision) VALUES(NEW.service_id, 1) ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
+  
+  CREATE TRIGGER IF NOT EXISTS services_revision_delete AFTER DELETE ON services BEGIN
+	INSERT INTO service_revisions(service_id, revision) VALUES(OLD.service_id, 1) ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
+  
+  CREATE TRIGGER IF NOT EXISTS users_revision_update AFTER UPDATE OF username, fullname, email, uuid ON users BEGIN
+	INSERT INTO service_revisions(service_id, revision) SELECT service_id, 1 FROM user_service_memberships WHERE user_id = NEW.user_id
+		ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
+  
+  CREATE TRIGGER IF NOT EXISTS groups_revision_update AFTER UPDATE OF username, fullname, uuid ON groups BEGIN
+	INSERT INTO service_revisions(service_id, revision) SELECT service_id, 1 FROM group_service_memberships WHERE group_id = NEW.group_id
+		ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
+  
+  CREATE TRIGGER IF NOT EXISTS user_service_memberships_revision_insert AFTER INSERT ON user_service_memberships BEGIN
+	INSERT INTO service_revisions(service_id, revision) VALUES(NEW.service_id, 1) ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
+  
+  CREATE TRIGGER IF NOT EXISTS user_service_memberships_revision_delete AFTER DELETE ON user_service_memberships BEGIN
+	INSERT INTO service_revisions(service_id, revision) VALUES(OLD.service_id, 1) ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
+  
+  CREATE TRIGGER IF NOT EXISTS group_service_memberships_revision_insert AFTER INSERT ON group_service_memberships BEGIN
+	INSERT INTO service_revisions(service_id, revision) VALUES(NEW.service_id, 1) ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
+  
+  CREATE TRIGGER IF NOT EXISTS group_service_memberships_revision_delete AFTER DELETE ON group_service_memberships BEGIN
+	INSERT INTO service_revisions(service_id, revision) VALUES(OLD.service_id, 1) ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
+  
+  CREATE TRIGGER IF NOT EXISTS user_group_memberships_revision_insert AFTER INSERT ON user_group_memberships BEGIN
+	INSERT INTO service_revisions(service_id, revision) SELECT service_id, 1 FROM group_service_memberships WHERE group_id = NEW.group_id
+		ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
+  
+  CREATE TRIGGER IF NOT EXISTS user_group_memberships_revision_delete AFTER DELETE ON user_group_memberships BEGIN
+	INSERT INTO service_revisions(service_id, revision) SELECT service_id, 1 FROM group_service_memberships WHERE group_id = OLD.group_id
+		ON CONFLICT(service_id) DO UPDATE SET revision = revision + 1;
+  END;
 """
 
 declarative = os.getenv('DANIEL_AUTHENTICATOR_DECLARATIVE_DATABASE') is not None
@@ -81,126 +183,324 @@ if declarative:
 else:
 	database_file = "./data/daniel-authenticator.sqlite3"
 
+#the key service tokens are stored under; without DANIEL_AUTHENTICATOR_SERVICE_TOKEN_KEY, a random one is made the
+#first time it is needed and kept in a file next to the database, except for declarative databases, which are remade
+#from their spec on every start, so tokens are neither made nor accepted for them until the key is set
+service_token_keys = {}
+service_token_keys_lock = threading.Lock()
+
+def get_service_token_key():
+	if pswd.SERVICE_TOKEN_KEY is not None:
+		return pswd.SERVICE_TOKEN_KEY
+	if declarative:
+		return None
+	path = os.path.join(os.path.dirname(database_file), "daniel-authenticator-service-token-key")
+	with service_token_keys_lock:
+		if path not in service_token_keys:
+			if not exists(path):
+				#linked into place so no worker can read it half written, and only the first one made is kept
+				temporary_path = "%s.%i" % (path, os.getpid())
+				with open(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+					file.write(os.urandom(32).hex())
+				try:
+					os.link(temporary_path, path)
+				except FileExistsError:
+					pass
+				finally:
+					os.unlink(temporary_path)
+			with open(path) as file:
+				service_token_keys[path] = file.read().strip().encode("utf-8")
+		return service_token_keys[path]
+
 def sort_by_username(input):
 	return sorted(input, key=lambda x: x['username'])
 
+#seconds a connection waits on another worker's write lock before giving up with "database is locked"
+DATABASE_BUSY_TIMEOUT = 30
+#comfortably more than the number of distinct sql strings used by Database, so each one is only prepared once
+DATABASE_CACHED_STATEMENTS = 512
+
+connections = threading.local()
+
+def dict_factory(cursor, row):
+	d = {}
+	for idx, col in enumerate(cursor.description):
+		d[col[0]] = row[idx]
+	return d
+
+def open_connection():
+	if(exists(database_file)):
+		conn = sqlite3.connect(database_file, timeout=DATABASE_BUSY_TIMEOUT, cached_statements=DATABASE_CACHED_STATEMENTS, factory=sql_tracer.connection_factory())
+	else:
+		conn = sqlite3.connect(database_file, timeout=DATABASE_BUSY_TIMEOUT, cached_statements=DATABASE_CACHED_STATEMENTS, factory=sql_tracer.connection_factory())
+		conn.executescript(database_init_sql_script)
+		conn.commit()
+	conn.executescript(database_upgrade_sql_script)
+	migrate_database(conn)
+	
+	if metrics.enabled() or sql_tracer.enabled():
+		conn.set_trace_callback(sql_tracer.trace_callback)
+	
+	#WAL lets readers keep going while another worker writes, and NORMAL sync is safe in WAL mode
+	conn.execute('PRAGMA journal_mode = WAL')
+	conn.execute('PRAGMA synchronous = NORMAL')
+	conn.execute('PRAGMA foreign_keys = ON')
+	conn.commit()
+	
+	#conn.row_factory = sqlite3.Row
+	conn.row_factory = dict_factory
+	return conn
+
+def migrate_database(conn):
+	if conn.execute('PRAGMA user_version').fetchone()[0] >= len(database_migrations):
+		return
+	#taking the write lock first means that of several workers starting at once, only the first one migrates
+	conn.execute('BEGIN IMMEDIATE')
+	try:
+		version = conn.execute('PRAGMA user_version').fetchone()[0]
+		for migration in database_migrations[version:]:
+			for statement in migration:
+				conn.execute(statement)
+		conn.execute('PRAGMA user_version = %i' % len(database_migrations))
+		conn.commit()
+	except BaseException:
+		conn.rollback()
+		raise
+
+#one long-lived connection per thread, reopened if we are in a forked child of the process that opened it
+def get_connection():
+	if getattr(connections, "pid", None) != os.getpid():
+		connections.conn = open_connection()
+		connections.pid = os.getpid()
+	return connections.conn
+
+#called at the end of every request so a failed write never keeps the database locked between requests
+def release_connection():
+	if getattr(connections, "pid", None) == os.getpid() and connections.conn.in_transaction:
+		connections.conn.rollback()
+	connections.batched = False
+
+ACCOUNT_LOCKED_MESSAGE = "Account is locked due to too many failed login attempts; Please contact an administrator"
+
+#failed logins in a row before an account is locked
+MAX_INCORRECT_LOGIN_ATTEMPTS = 15
+
+#the writer thread has no request teardown, so a failed write is rolled back here
+def write_last_login_times(last_login_times):
+	try:
+		Database().set_last_login_times(last_login_times)
+	finally:
+		release_connection()
+
+login_writer.set_write_function(write_last_login_times)
+
+#every Database of a thread shares its connection, and so whether writes on it are being batched; a transaction left
+#open by a failed request is rolled back by release_connection, never by making another Database
 class Database:
 	def __init__(self):
-		
-		if(exists(database_file)):
-			self.conn = sqlite3.connect(database_file)
-		else:
-			self.conn = sqlite3.connect(database_file)
-			self.conn.executescript(database_init_sql_script)
+		self.conn = get_connection()
+	
+	def commit(self):
+		if not getattr(connections, "batched", False):
 			self.conn.commit()
-				
-		def dict_factory(cursor, row):
-			d = {}
-			for idx, col in enumerate(cursor.description):
-				d[col[0]] = row[idx]
-			return d
-		
-		#self.conn.row_factory = sqlite3.Row
-		self.conn.row_factory = dict_factory
-		self.conn.execute('PRAGMA foreign_keys = ON')
-		self.conn.commit()
+	
+	#every write made inside the with block, through any Database of this thread, is committed together at the end,
+	#or rolled back if the block raises; a transaction started inside another one is part of the outer one
+	@contextmanager
+	def transaction(self):
+		if getattr(connections, "batched", False):
+			yield
+			return
+		connections.batched = True
+		try:
+			yield
+			self.conn.commit()
+		except BaseException:
+			self.conn.rollback()
+			raise
+		finally:
+			connections.batched = False
 	
 	def create_user(self, username, fullname, email, password, active, superuser):
+		return self.create_user_using_password_hash(username, fullname, email, pswd.make_password_hash(password), active, superuser)
+	
+	def create_user_using_password_hash(self, username, fullname, email, password_hash, active, superuser):
 		cursor = self.conn.cursor()
-		cursor.execute("""INSERT INTO users(username, fullname, email, uuid, password_hash, active, incorrect_login_attempts, locked, last_login_time, creation_time, superuser)
-						VALUES(?, ?, ?, ?, ?, ?, 0, false, "", datetime(), ?)""",
-						(username, fullname, email, str(uuid.uuid4()), pswd.make_password_hash(password), active, superuser))
+		cursor.execute("""INSERT INTO users(username, fullname, email, uuid, password_hash, active, creation_time, superuser)
+						VALUES(?, ?, ?, ?, ?, ?, datetime(), ?)""",
+						(username, fullname, email, str(uuid.uuid4()), password_hash, active, superuser))
 		user_id = cursor.lastrowid
 		cursor.close()
-		self.conn.commit()
+		self.commit()
 		return user_id
 	
-	def update_user_successful_login(self, user_id):
-		self.conn.execute('UPDATE users SET incorrect_login_attempts=0, last_login_time=datetime() WHERE user_id=?',
-							(user_id,))
-		self.conn.commit()
+	def update_user_successful_login(self, user_id, reset_attempts=True):
+		#the counter is only ever reset right away, and only when there were failed attempts to reset
+		if reset_attempts:
+			self.conn.execute('UPDATE login_states SET incorrect_login_attempts=0 WHERE user_id=?',
+								(user_id,))
+			self.commit()
+		if login_writer.enabled():
+			login_writer.record_successful_login(user_id)
+		else:
+			self.conn.execute('UPDATE login_states SET last_login_time=datetime() WHERE user_id=?',
+								(user_id,))
+			self.commit()
+	
+	def set_last_login_times(self, last_login_times):
+		self.conn.executemany('UPDATE login_states SET last_login_time=? WHERE user_id=?',
+								[(last_login_time, user_id) for user_id, last_login_time in last_login_times.items()])
+		self.commit()
 	
 	def update_user_unsuccessful_login(self, user_id):
-		result = self.conn.execute("SELECT incorrect_login_attempts FROM users WHERE user_id = ?",
+		#counting the attempt and deciding the lockout in one statement keeps the limit exact across workers
+		self.conn.execute("""UPDATE login_states SET incorrect_login_attempts = incorrect_login_attempts + 1,
+							locked = (locked OR incorrect_login_attempts + 1 >= ?) WHERE user_id=?""",
+							(MAX_INCORRECT_LOGIN_ATTEMPTS, user_id))
+		result = self.conn.execute("SELECT locked FROM login_states WHERE user_id = ?",
 									(user_id, )).fetchone()
-		incorrect_login_attempts = result["incorrect_login_attempts"] + 1
-		self.conn.execute('UPDATE users SET incorrect_login_attempts=? WHERE user_id=?',
-							(incorrect_login_attempts, user_id))
-		self.conn.commit()
+		self.commit()
 		
-		if incorrect_login_attempts >= 15:
-			self.conn.execute('UPDATE users SET locked=1 WHERE user_id=?',
-							(user_id,))
-			self.conn.commit()
+		if result is not None and result["locked"]:
+			credential_cache.invalidate(user_principal(user_id))
 	
 	def attempt_user_login(self, username, password, suppress_successful_log=False):
+		start_time = time.monotonic()
 		user = self.get_user_by_username(username)
 		if user is None:
-			print("%s Login by user %s failed, user does not exist" % (datetime.now().strftime(TIME_FORMAT), username))
+			log_event("user_login", "denied", username, duration=time.monotonic() - start_time, level=logging.WARNING, reason="user does not exist")
 			return None, "Invalid Username or Password"
 		elif user["active"] == False:
-			print("%s Login by user %s failed, user does not exist" % (datetime.now().strftime(TIME_FORMAT), username))
+			log_event("user_login", "inactive", username, duration=time.monotonic() - start_time, level=logging.WARNING, reason="user was set inactive")
 			return None, "Account was set inactive by an administrator"
 		elif user["locked"]:
-			print("%s Login by user %s failed, user does not exist" % (datetime.now().strftime(TIME_FORMAT), username))
-			return None, "Account is locked due to too many failed login attempts; Please contact an administrator"
+			log_event("user_login", "locked", username, duration=time.monotonic() - start_time, level=logging.WARNING, reason="user is locked")
+			return None, ACCOUNT_LOCKED_MESSAGE
 		else:
-			if check_password(password, user["password_hash"]):
+			if credential_cache.check_password(user_principal(user["user_id"]), password, user["password_hash"]):
 				if not suppress_successful_log:
-					print("%s Login by user %s succeeded" % (datetime.now().strftime(TIME_FORMAT), username))
-				self.update_user_successful_login(user["user_id"])
+					log_event("user_login", "allowed", username, duration=time.monotonic() - start_time)
+				self.update_user_successful_login(user["user_id"], user["incorrect_login_attempts"] != 0)
+				if pswd.needs_rehash(user["password_hash"], pswd.USER_PASSWORD):
+					self.rehash_password("users", "user_id", user, password, pswd.USER_PASSWORD)
 				return user, "Login Successful"
 			else:
-				print("%s Login by user %s failed, incorrect password" % (datetime.now().strftime(TIME_FORMAT), username))
+				log_event("user_login", "denied", username, duration=time.monotonic() - start_time, level=logging.WARNING, reason="incorrect password")
 				self.update_user_unsuccessful_login(user["user_id"])
 				return None, "Invalid Username or Password"
 	
+	#replaces a just verified hash whose rounds are below, or when asked for above, those configured now, unless the
+	#password was changed in the meantime; entries in the credential cache are checked against the new hash on their next use
+	def rehash_password(self, table, id_column, row, password, kind):
+		cursor = self.conn.execute('UPDATE %s SET password_hash=? WHERE %s=? AND password_hash=?' % (table, id_column),
+									(pswd.make_password_hash(password, kind), row[id_column], row["password_hash"]))
+		self.commit()
+		if cursor.rowcount > 0:
+			log_event("password_rehash", "rehashed", row["username"], kind=kind, old_rounds=pswd.hash_rounds(row["password_hash"]), new_rounds=pswd.HASH_ROUNDS[kind])
+	
 	def attempt_user_login_with_service(self, username, password, service_username):
-		user = self.get_user_by_username(username)
-		
+		start_time = time.monotonic()
 		user_info, message = self.attempt_user_login(username, password, suppress_successful_log=True)
 		if user_info is None:
 			return None, message
 		
 		service_info = self.get_service_by_username(service_username)
 		if service_info is None:
-			print("%s Login by user %s failed because service %s does not exist" % (datetime.now().strftime(TIME_FORMAT), username, service_username))
+			log_event("user_login", "denied", username, service_username, time.monotonic() - start_time, logging.WARNING, reason="service does not exist")
 			return None, "Invalid Username or Password"
 		
 		service_memberships = self.get_user_service_memberships(user_info['user_id'])
 		if service_info in service_memberships:
-			print("%s Login by user %s through service %s succeeded" % (datetime.now().strftime(TIME_FORMAT), username, service_username))
+			log_event("user_login", "allowed", username, service_username, time.monotonic() - start_time)
 			return user_info, message
 		else:
-			print("%s Login by user %s failed because they are not a member of service %s" % (datetime.now().strftime(TIME_FORMAT), username, service_username))
+			log_event("user_login", "denied", username, service_username, time.monotonic() - start_time, logging.WARNING, reason="user is not a member of the service")
 			return None, "Invalid Username or Password"
 	
 	def attempt_service_login(self, username, password):
+		start_time = time.monotonic()
 		service = self.get_service_by_username(username)
 		if service is not None and service["active"]:
-			if check_password(password, service["password_hash"]):
+			allowed = False
+			credential = "password"
+			if pswd.is_service_token(password):
+				credential = "token"
+				key = get_service_token_key()
+				if key is not None:
+					allowed = pswd.check_service_token(password, self.get_service_token_digests(service["service_id"]), key)
+			#a password that only looks like a token still works as the password it was set as
+			if not allowed and credential_cache.check_password(service_principal(service["service_id"]), password, service["password_hash"]):
+				credential = "password"
+				allowed = True
+			if allowed:
+				#services bind for every search they make, so these are only logged when asked for
+				log_event("service_login", "allowed", username, username, time.monotonic() - start_time, logging.DEBUG, credential=credential)
+				if credential == "password" and pswd.needs_rehash(service["password_hash"], pswd.SERVICE_PASSWORD):
+					self.rehash_password("services", "service_id", service, password, pswd.SERVICE_PASSWORD)
 				return service
 			else:
-				print("%s Login by service %s failed, incorrect password" % (datetime.now().strftime(TIME_FORMAT), username))
+				log_event("service_login", "denied", username, username, time.monotonic() - start_time, logging.WARNING, reason="incorrect " + credential, credential=credential)
 				return None
 		else:
-			print("%s Login by service %s failed, services does not exist" % (datetime.now().strftime(TIME_FORMAT), username))
+			log_event("service_login", "denied", username, username, time.monotonic() - start_time, logging.WARNING, reason="service does not exist or is inactive")
+			return None
+	
+	def get_service_token_digests(self, service_id):
+		result = self.conn.execute("""SELECT token_digest FROM service_tokens
+									WHERE service_id = ? AND (expires_time IS NULL OR expires_time > datetime())""",
+									(service_id, )).fetchall()
+		return [row["token_digest"] for row in result]
+	
+	def get_service_tokens(self, service_id):
+		result = self.conn.execute("""SELECT creation_time, expires_time FROM service_tokens
+									WHERE service_id = ? AND (expires_time IS NULL OR expires_time > datetime()) ORDER BY service_token_id DESC""",
+									(service_id, )).fetchall()
+		return result
+	
+	#makes a new token for the service to bind with and returns it, it is only ever stored as a digest; the token it
+	#replaces keeps working for grace_seconds more so the service can be moved over without failed binds, and any
+	#older one stops working right away; returns None and changes nothing when there is no key to store it under
+	def rotate_service_token(self, service_id, grace_seconds):
+		key = get_service_token_key()
+		if key is None:
 			return None
+		token = pswd.make_service_token()
+		self.conn.execute('DELETE FROM service_tokens WHERE service_id=? AND expires_time IS NOT NULL',
+							(service_id,))
+		self.conn.execute("UPDATE service_tokens SET expires_time=datetime('now', ?) WHERE service_id=? AND expires_time IS NULL",
+							("+%i seconds" % grace_seconds, service_id))
+		self.conn.execute('INSERT INTO service_tokens(service_id, token_digest, expires_time, creation_time) VALUES(?, ?, NULL, datetime())',
+							(service_id, pswd.service_token_digest(token, key)))
+		self.commit()
+		return token
+	
+	def set_service_token_digest(self, service_id, token_digest):
+		self.conn.execute('DELETE FROM service_tokens WHERE service_id=?',
+							(service_id,))
+		self.conn.execute('INSERT INTO service_tokens(service_id, token_digest, expires_time, creation_time) VALUES(?, ?, NULL, datetime())',
+							(service_id, token_digest))
+		self.commit()
+	
+	def revoke_service_tokens(self, service_id):
+		self.conn.execute('DELETE FROM service_tokens WHERE service_id=?',
+							(service_id,))
+		self.commit()
 	
 	def delete_user(self, user_id):
 		self.conn.execute('DELETE FROM users WHERE user_id=?',
 							(user_id,))
-		self.conn.commit()
+		self.commit()
+		credential_cache.invalidate(user_principal(user_id))
 	
 	def get_user_info(self, user_id):
 		result = self.conn.execute("""SELECT user_id, username, fullname, email, uuid, password_hash,
-									active, incorrect_login_attempts, locked, last_login_time, creation_time, superuser FROM users WHERE user_id = ?""",
+									active, login_states.incorrect_login_attempts, login_states.locked, login_states.last_login_time, creation_time, superuser FROM users INNER JOIN login_states USING (user_id) WHERE user_id = ?""",
 									(user_id, )).fetchone()
 		return result
 	
 	def get_user_by_username(self, username):
 		result = self.conn.execute("""SELECT user_id, username, fullname, email, uuid, password_hash,
-									active, incorrect_login_attempts, locked, last_login_time, creation_time, superuser FROM users WHERE username = ?""",
+									active, login_states.incorrect_login_attempts, login_states.locked, login_states.last_login_time, creation_time, superuser FROM users INNER JOIN login_states USING (user_id) WHERE username = ?""",
 									(username, )).fetchall()
 		if len(result) == 1:
 			return result[0]
@@ -209,7 +509,7 @@ class Database:
 	
 	def get_user_by_email(self, email):
 		result = self.conn.execute("""SELECT user_id, username, fullname, email, uuid, password_hash,
-									active, incorrect_login_attempts, locked, last_login_time, creation_time, superuser FROM users WHERE email = ?""",
+									active, login_states.incorrect_login_attempts, login_states.locked, login_states.last_login_time, creation_time, superuser FROM users INNER JOIN login_states USING (user_id) WHERE email = ?""",
 									(email, )).fetchall()
 		if len(result) == 1:
 			return result[0]
@@ -218,22 +518,26 @@ class Database:
 	
 	def get_all_users_info(self):
 		result = self.conn.execute("""SELECT user_id, username, fullname, email, uuid, password_hash,
-									active, incorrect_login_attempts, locked, last_login_time, creation_time, superuser FROM users""").fetchall()
+									active, login_states.incorrect_login_attempts, login_states.locked, login_states.last_login_time, creation_time, superuser FROM users INNER JOIN login_states USING (user_id)""").fetchall()
 		return sort_by_username(result)
 	
 	def create_service(self, username, fullname, hyperlink, password, active):
+		return self.create_service_using_password_hash(username, fullname, hyperlink, pswd.make_password_hash(password, pswd.SERVICE_PASSWORD), active)
+	
+	def create_service_using_password_hash(self, username, fullname, hyperlink, password_hash, active):
 		cursor = self.conn.cursor()
 		cursor.execute('INSERT INTO services(username, fullname, hyperlink, password_hash, active) VALUES(?, ?, ?, ?, ?)',
-						(username, fullname, hyperlink, pswd.make_password_hash(password), active))
+						(username, fullname, hyperlink, password_hash, active))
 		service_id = cursor.lastrowid
 		cursor.close()
-		self.conn.commit()
+		self.commit()
 		return service_id
 	
 	def delete_service(self, service_id):
 		self.conn.execute('DELETE FROM services WHERE service_id=?',
 							(service_id,))
-		self.conn.commit()
+		self.commit()
+		credential_cache.invalidate(service_principal(service_id))
 	
 	def get_service_info(self, service_id):
 		result = self.conn.execute('SELECT service_id, username, fullname, hyperlink, password_hash, active FROM services WHERE service_id = ?',
@@ -258,13 +562,13 @@ class Database:
 						(username, fullname, str(uuid.uuid4())))
 		group_id = cursor.lastrowid
 		cursor.close()
-		self.conn.commit()
+		self.commit()
 		return group_id
 	
 	def delete_group(self, group_id):
 		self.conn.execute('DELETE FROM groups WHERE group_id=?',
 							(group_id,))
-		self.conn.commit()
+		self.commit()
 	
 	def get_group_info(self, group_id):
 		result = self.conn.execute('SELECT group_id, username, fullname, uuid FROM groups WHERE group_id = ?',
@@ -286,51 +590,57 @@ class Database:
 	def add_user_to_service(self, user_id, service_id):
 		self.conn.execute('INSERT INTO user_service_memberships(user_id, service_id) VALUES(?, ?) ON CONFLICT DO NOTHING',
 							(user_id, service_id))
-		self.conn.commit()
+		self.commit()
 	
 	def remove_user_from_service(self, user_id, service_id):
 		self.conn.execute('DELETE FROM user_service_memberships WHERE user_id=? AND service_id=?',
 							(user_id, service_id))
-		self.conn.commit()
+		self.commit()
 	
 	def add_user_to_group(self, user_id, group_id):
 		self.conn.execute('INSERT INTO user_group_memberships(user_id, group_id) VALUES(?, ?) ON CONFLICT DO NOTHING',
 							(user_id, group_id))
-		self.conn.commit()
+		self.commit()
 	
 	def remove_user_from_group(self, user_id, group_id):
 		self.conn.execute('DELETE FROM user_group_memberships WHERE user_id=? AND group_id=?',
 							(user_id, group_id))
-		self.conn.commit()
+		self.commit()
 	
 	def add_group_to_service(self, group_id, service_id):
 		self.conn.execute('INSERT INTO group_service_memberships(group_id, service_id) VALUES(?, ?) ON CONFLICT DO NOTHING',
 							(group_id, service_id))
-		self.conn.commit()
+		self.commit()
 		
 	def remove_group_from_service(self, group_id, service_id):
 		self.conn.execute('DELETE FROM group_service_memberships WHERE group_id=? AND service_id=?',
 							(group_id, service_id))
-		self.conn.commit()
+		self.commit()
 	
 	def get_users_in_service(self, service_id):
 		result = self.conn.execute("""SELECT user_id, username, fullname, email, uuid, password_hash,
-										active, incorrect_login_attempts, locked, last_login_time, creation_time, superuser
-										FROM users INNER JOIN user_service_memberships USING (user_id) WHERE service_id=?""",
+										active, login_states.incorrect_login_attempts, login_states.locked, login_states.last_login_time, creation_time, superuser
+										FROM users INNER JOIN login_states USING (user_id) INNER JOIN user_service_memberships USING (user_id) WHERE service_id=?""",
 									(service_id,)).fetchall()
 		return sort_by_username(result)
 	
+	def user_matches(self, user_id, condition):
+		condition_sql, condition_parameters = condition
+		result = self.conn.execute("SELECT user_id FROM users WHERE user_id=? AND (%s)" % condition_sql,
+									[user_id] + condition_parameters).fetchone()
+		return result is not None
+	
 	def get_users_in_group(self, group_id):
 		result = self.conn.execute("""SELECT user_id, username, fullname, email, uuid, password_hash,
-										active, incorrect_login_attempts, locked, last_login_time, creation_time, superuser
-										FROM users INNER JOIN user_group_memberships USING (user_id) WHERE group_id=?""",
+										active, login_states.incorrect_login_attempts, login_states.locked, login_states.last_login_time, creation_time, superuser
+										FROM users INNER JOIN login_states USING (user_id) INNER JOIN user_group_memberships USING (user_id) WHERE group_id=?""",
 									(group_id,)).fetchall()
 		return sort_by_username(result)
 	
 	def get_users_in_group_for_service(self, group_id, service_id):
 		result = self.conn.execute("""SELECT user_id, username, fullname, email, uuid, password_hash,
-										active, incorrect_login_attempts, locked, last_login_time, creation_time, superuser
-										FROM users INNER JOIN user_group_memberships USING (user_id)
+										active, login_states.incorrect_login_attempts, login_states.locked, login_states.last_login_time, creation_time, superuser
+										FROM users INNER JOIN login_states USING (user_id) INNER JOIN user_group_memberships USING (user_id)
 										INNER JOIN user_service_memberships USING (user_id) WHERE group_id=? AND service_id=?""",
 									(group_id,service_id)).fetchall()
 		return sort_by_username(result)
@@ -341,6 +651,12 @@ class Database:
 									(service_id,)).fetchall()
 		return sort_by_username(result)
 	
+	def group_matches(self, group_id, condition):
+		condition_sql, condition_parameters = condition
+		result = self.conn.execute("SELECT group_id FROM groups WHERE group_id=? AND (%s)" % condition_sql,
+									[group_id] + condition_parameters).fetchone()
+		return result is not None
+	
 	def get_user_service_memberships(self, user_id):
 		result = self.conn.execute("""SELECT service_id, username, fullname, hyperlink, password_hash, active
 										FROM services INNER JOIN user_service_memberships USING (service_id) WHERE user_id=?""",
@@ -360,6 +676,150 @@ class Database:
 									(user_id,service_id)).fetchall()
 		return sort_by_username(result)
 	
+	#every user-group membership where both the user and the group are part of the service
+	def get_user_group_memberships_in_service(self, service_id):
+		result = self.conn.execute("""SELECT user_group_memberships.user_id, user_group_memberships.group_id,
+										users.username AS user_username, groups.username AS group_username
+										FROM user_group_memberships
+										INNER JOIN user_service_memberships ON user_service_memberships.user_id = user_group_memberships.user_id
+										INNER JOIN group_service_memberships ON group_service_memberships.group_id = user_group_memberships.group_id
+										INNER JOIN users ON users.user_id = user_group_memberships.user_id
+										INNER JOIN groups ON groups.group_id = user_group_memberships.group_id
+										WHERE user_service_memberships.service_id=? AND group_service_memberships.service_id=?""",
+									(service_id, service_id)).fetchall()
+		return result
+	
+	#bumped by triggers whenever anything visible through the service's ldap view changes
+	def get_service_revision(self, service_id):
+		result = self.conn.execute('SELECT revision FROM service_revisions WHERE service_id = ?',
+									(service_id,)).fetchone()
+		if result is None:
+			return 0
+		else:
+			return result["revision"]
+	
+	#everything needed to build a service's ldap view, read in one transaction so it is consistent with the revision
+	def get_service_directory(self, service_id, memberships=True):
+		#inside an open transaction the reads are already consistent, and it must not be rolled back here
+		own_transaction = not self.conn.in_transaction
+		if own_transaction:
+			self.conn.execute('BEGIN')
+		try:
+			return {
+				"revision": self.get_service_revision(service_id),
+				"users": self.get_users_in_service(service_id),
+				"groups": self.get_groups_in_service(service_id),
+				"memberships": self.get_user_group_memberships_in_service(service_id) if memberships else []
+			}
+		finally:
+			if own_transaction:
+				self.conn.rollback()
+	
+	#the part of a service's ldap view that one of its users or groups needs, in the same shape as get_service_directory,
+	#so a search for a single entry costs a few small queries instead of reading the whole service
+	def get_service_directory_entry(self, service_id, entity_type, username, memberships=True):
+		own_transaction = not self.conn.in_transaction
+		if own_transaction:
+			self.conn.execute('BEGIN')
+		try:
+			directory = {"revision": self.get_service_revision(service_id), "users": [], "groups": [], "memberships": []}
+			if entity_type == "user":
+				directory["users"] = self.conn.execute("""SELECT user_id, username, fullname, email, uuid
+										FROM users INNER JOIN user_service_memberships USING (user_id) WHERE service_id=? AND username=?""",
+									(service_id, username)).fetchall()
+				#usernames are unique, so there is at most one
+				if memberships and len(directory["users"]) > 0:
+					user = directory["users"][0]
+					directory["memberships"] = [{"user_id": user["user_id"], "group_id": group["group_id"], "user_username": user["username"], "group_username": group["username"]}
+												for group in self.get_user_group_memberships_for_service(user["user_id"], service_id)]
+			else:
+				directory["groups"] = self.conn.execute("""SELECT group_id, username, fullname, uuid
+										FROM groups INNER JOIN group_service_memberships USING (group_id) WHERE service_id=? AND username=?""",
+									(service_id, username)).fetchall()
+				if memberships and len(directory["groups"]) > 0:
+					group = directory["groups"][0]
+					directory["memberships"] = [{"user_id": user["user_id"], "group_id": group["group_id"], "user_username": user["username"], "group_username": group["username"]}
+												for user in self.get_users_in_group_for_service(group["group_id"], service_id)]
+			return directory
+		finally:
+			if own_transaction:
+				self.conn.rollback()
+	
+	#the ids of the service's users matching the condition in username order, page_size of them after the given username
+	#(all of them if page_size is 0), and the username the next page starts after, or "" if this page is the last
+	def get_user_ids_in_service_matching(self, service_id, condition, after="", page_size=0):
+		condition_sql, condition_parameters = condition
+		return self.get_id_page("""SELECT user_id, username FROM users INNER JOIN user_service_memberships USING (user_id)
+									WHERE service_id=? AND (%s)""" % condition_sql,
+								[service_id] + condition_parameters, "user_id", after, page_size)
+	
+	def get_group_ids_in_service_matching(self, service_id, condition, after="", page_size=0):
+		condition_sql, condition_parameters = condition
+		return self.get_id_page("""SELECT group_id, username FROM groups INNER JOIN group_service_memberships USING (group_id)
+									WHERE service_id=? AND (%s)""" % condition_sql,
+								[service_id] + condition_parameters, "group_id", after, page_size)
+	
+	def get_id_page(self, sql, parameters, id_column, after, page_size):
+		if page_size > 0:
+			result, next_username = self.get_page(sql, parameters, after, page_size)
+		else:
+			result = self.conn.execute(sql + " AND username > ? ORDER BY username", parameters + [after]).fetchall()
+			next_username = None
+		return [row[id_column] for row in result], next_username or ""
+	
+	#every membership edge as an id pair, for building whole membership matrices without a query per row
+	def get_all_user_service_memberships(self):
+		result = self.conn.execute('SELECT user_id, service_id FROM user_service_memberships').fetchall()
+		return result
+	
+	def get_all_user_group_memberships(self):
+		result = self.conn.execute('SELECT user_id, group_id FROM user_group_memberships').fetchall()
+		return result
+	
+	def get_all_group_service_memberships(self):
+		result = self.conn.execute('SELECT group_id, service_id FROM group_service_memberships').fetchall()
+		return result
+	
+	#one page of rows in username order after the given username, and the username the next page starts after,
+	#or None if this is the last page; sql must end in a WHERE clause that the username condition is added to
+	def get_page(self, sql, parameters, after, limit):
+		result = self.conn.execute(sql + " AND username > ? ORDER BY username LIMIT ?",
+									parameters + [after, limit + 1]).fetchall()
+		if len(result) > limit:
+			return result[:limit], result[limit - 1]["username"]
+		else:
+			return result, None
+	
+	def get_services_page_without_user(self, user_id, after, limit):
+		return self.get_page("""SELECT service_id, username FROM services
+								WHERE service_id NOT IN (SELECT service_id FROM user_service_memberships WHERE user_id=?)""",
+								[user_id], after, limit)
+	
+	def get_groups_page_without_user(self, user_id, after, limit):
+		return self.get_page("""SELECT group_id, username FROM groups
+								WHERE group_id NOT IN (SELECT group_id FROM user_group_memberships WHERE user_id=?)""",
+								[user_id], after, limit)
+	
+	def get_services_page_without_group(self, group_id, after, limit):
+		return self.get_page("""SELECT service_id, username FROM services
+								WHERE service_id NOT IN (SELECT service_id FROM group_service_memberships WHERE group_id=?)""",
+								[group_id], after, limit)
+	
+	def get_users_page_not_in_group(self, group_id, after, limit):
+		return self.get_page("""SELECT user_id, username FROM users
+								WHERE user_id NOT IN (SELECT user_id FROM user_group_memberships WHERE group_id=?)""",
+								[group_id], after, limit)
+	
+	def get_users_page_not_in_service(self, service_id, after, limit):
+		return self.get_page("""SELECT user_id, username FROM users
+								WHERE user_id NOT IN (SELECT user_id FROM user_service_memberships WHERE service_id=?)""",
+								[service_id], after, limit)
+	
+	def get_groups_page_not_in_service(self, service_id, after, limit):
+		return self.get_page("""SELECT group_id, username FROM groups
+								WHERE group_id NOT IN (SELECT group_id FROM group_service_memberships WHERE service_id=?)""",
+								[service_id], after, limit)
+	
 	def get_group_service_memberships(self, group_id):
 		result = self.conn.execute("""SELECT service_id, username, fullname, hyperlink, password_hash, active
 										FROM services INNER JOIN group_service_memberships USING (service_id) WHERE group_id=?""",
@@ -369,76 +829,82 @@ class Database:
 	def set_user_fullname(self, user_id, fullname):
 		self.conn.execute('UPDATE users SET fullname=? WHERE user_id=?',
 							(fullname, user_id))
-		self.conn.commit()
+		self.commit()
 	
 	def set_group_fullname(self, group_id, fullname):
 		self.conn.execute('UPDATE groups SET fullname=? WHERE group_id=?',
 							(fullname, group_id))
-		self.conn.commit()
+		self.commit()
 	
 	def set_service_fullname(self, service_id, fullname):
 		self.conn.execute('UPDATE services SET fullname=? WHERE service_id=?',
 							(fullname, service_id))
-		self.conn.commit()
+		self.commit()
 	
 	def set_user_password(self, user_id, password):
 		self.conn.execute('UPDATE users SET password_hash=? WHERE user_id=?',
 							(pswd.make_password_hash(password), user_id))
-		self.conn.commit()
+		self.commit()
+		credential_cache.invalidate(user_principal(user_id))
 	
 	def set_user_password_using_freeipa_hash(self, user_id, password_hash):
 		self.conn.execute('UPDATE users SET password_hash=? WHERE user_id=?',
 							(pswd.decode_freeipa(password_hash), user_id))
-		self.conn.commit()
+		self.commit()
+		credential_cache.invalidate(user_principal(user_id))
 	
 	def set_service_password_using_freeipa_hash(self, service_id, password_hash):
 		self.conn.execute('UPDATE services SET password_hash=? WHERE service_id=?',
 							(pswd.decode_freeipa(password_hash), service_id))
-		self.conn.commit()
+		self.commit()
+		credential_cache.invalidate(service_principal(service_id))
 	
 	def set_service_password(self, service_id, password):
 		self.conn.execute('UPDATE services SET password_hash=? WHERE service_id=?',
-							(pswd.make_password_hash(password), service_id))
-		self.conn.commit()
+							(pswd.make_password_hash(password, pswd.SERVICE_PASSWORD), service_id))
+		self.commit()
+		credential_cache.invalidate(service_principal(service_id))
 	
 	def set_user_email(self, user_id, email):
 		self.conn.execute('UPDATE users SET email=? WHERE user_id=?',
 							(email, user_id))
-		self.conn.commit()
+		self.commit()
 	
 	def set_service_hyperlink(self, service_id, hyperlink):
 		self.conn.execute('UPDATE services SET hyperlink=? WHERE service_id=?',
 							(hyperlink, service_id))
-		self.conn.commit()
+		self.commit()
 	
 	def set_user_active(self, user_id, active):
 		self.conn.execute('UPDATE users SET active=? WHERE user_id=?',
 							(active, user_id))
-		self.conn.commit()
+		self.commit()
+		credential_cache.invalidate(user_principal(user_id))
 	
 	def set_user_superuser(self, user_id, superuser):
 		self.conn.execute('UPDATE users SET superuser=? WHERE user_id=?',
 							(superuser, user_id))
-		self.conn.commit()
+		self.commit()
 	
 	def set_service_active(self, service_id, active):
 		self.conn.execute('UPDATE services SET active=? WHERE service_id=?',
 							(active, service_id))
-		self.conn.commit()
+		self.commit()
+		credential_cache.invalidate(service_principal(service_id))
 	
 	def unlock_user(self, user_id):
-		self.conn.execute('UPDATE users SET locked=0, incorrect_login_attempts=0 WHERE user_id=?',
+		self.conn.execute('UPDATE login_states SET locked=0, incorrect_login_attempts=0 WHERE user_id=?',
 							(user_id,))
-		self.conn.commit()
+		self.commit()
 		
 	def set_user_uuid(self, user_id, uuid):
 		self.conn.execute('UPDATE users SET uuid=? WHERE user_id=?',
 							(uuid, user_id))
-		self.conn.commit()
+		self.commit()
 		
 	def set_group_uuid(self, group_id, uuid):
 		self.conn.execute('UPDATE groups SET uuid=? WHERE group_id=?',
 							(uuid, group_id))
-		self.conn.commit()
+		self.commit()
 		
 	
@@ -0,0 +1,115 @@
+import os, threading
+from bisect import bisect_right
+from collections import OrderedDict
+from daniel_authenticator_web.ldap_entities import new_make_entity_from_user_info, new_make_entity_from_group_info
+
+#a service's whole ldap view with every entity already rendered, valid for exactly one revision of the service
+class ServiceSnapshot:
+	def __init__(self, service_info, directory):
+		self.revision = directory["revision"]
+		self.service_username = service_info["username"]
+
+		group_usernames = {}
+		user_usernames = {}
+		for membership in directory["memberships"]:
+			group_usernames.setdefault(membership["user_id"], []).append(membership["group_username"])
+			user_usernames.setdefault(membership["group_id"], []).append(membership["user_username"])
+
+		#users and groups arrive sorted by username, so these dicts keep the order searches return them in
+		self.users = OrderedDict()
+		self.user_ids = {}
+		self.user_ids_by_username = {}
+		for user in directory["users"]:
+			self.users[user["username"]] = new_make_entity_from_user_info(service_info, user, sorted(group_usernames.get(user["user_id"], [])))
+			self.user_ids[user["user_id"]] = user["username"]
+			self.user_ids_by_username[user["username"]] = user["user_id"]
+		self.user_usernames = list(self.users)
+
+		self.groups = OrderedDict()
+		self.group_ids = {}
+		self.group_ids_by_username = {}
+		for group in directory["groups"]:
+			self.groups[group["username"]] = new_make_entity_from_group_info(service_info, group, sorted(user_usernames.get(group["group_id"], [])))
+			self.group_ids[group["group_id"]] = group["username"]
+			self.group_ids_by_username[group["username"]] = group["group_id"]
+		self.group_usernames = list(self.groups)
+
+	def size(self):
+		return len(self.users) + len(self.groups)
+
+	def get_users(self, after="", page_size=0):
+		return page_entities(self.users, self.user_usernames, after, page_size)
+
+	def get_groups(self, after="", page_size=0):
+		return page_entities(self.groups, self.group_usernames, after, page_size)
+
+	#the entities of the given ids in the order given, which for a filtered search is the page the database picked;
+	#ids the snapshot does not have yet, of entries added since it was read, are left out
+	def get_users_by_id(self, user_ids):
+		return [self.users[self.user_ids[user_id]] for user_id in user_ids if user_id in self.user_ids]
+
+	def get_groups_by_id(self, group_ids):
+		return [self.groups[self.group_ids[group_id]] for group_id in group_ids if group_id in self.group_ids]
+
+#returns up to page_size entities (all of them if page_size is 0) whose usernames come after the given one, in username
+#order, and the username to continue after if there are more, or "" if this page is the last
+def page_entities(entities, usernames, after, page_size):
+	start = bisect_right(usernames, after) if after != "" else 0
+	end = len(usernames) if page_size == 0 else min(start + page_size, len(usernames))
+	page = [entities[username] for username in usernames[start:end]]
+	return page, usernames[end - 1] if end < len(usernames) else ""
+
+#keeps recently searched services' snapshots resident, evicting the least recently used ones once the total
+#number of cached entities goes over the limit; a snapshot is only rebuilt when the service's revision moves
+class DirectoryCache:
+	def __init__(self, max_entities):
+		self.max_entities = max_entities
+		self.snapshots = OrderedDict()
+		self.total_entities = 0
+		self.lock = threading.Lock()
+
+	def enabled(self):
+		return self.max_entities > 0
+
+	#memberships can only be left out when the snapshot is not cached, since a cached snapshot has to serve every search
+	#a search for one entry, given as entity_type ("user" or "group") and username, that finds no current snapshot
+	#gets one holding just that entry, which is never cached
+	def get_snapshot(self, db, service_info, memberships=True, entity_type=None, username=None):
+		service_id = service_info["service_id"]
+		if self.enabled():
+			revision = db.get_service_revision(service_id)
+			with self.lock:
+				snapshot = self.snapshots.get(service_id)
+				if snapshot is not None and snapshot.revision == revision and snapshot.service_username == service_info["username"]:
+					self.snapshots.move_to_end(service_id)
+					return snapshot
+
+		if entity_type is not None:
+			return ServiceSnapshot(service_info, db.get_service_directory_entry(service_id, entity_type, username, memberships))
+		if not self.enabled():
+			return ServiceSnapshot(service_info, db.get_service_directory(service_id, memberships))
+
+		snapshot = ServiceSnapshot(service_info, db.get_service_directory(service_id))
+		with self.lock:
+			old_snapshot = self.snapshots.pop(service_id, None)
+			if old_snapshot is not None:
+				self.total_entities -= old_snapshot.size()
+			#a snapshot that was read concurrently at a newer revision wins over ours
+			if old_snapshot is not None and old_snapshot.revision > snapshot.revision:
+				snapshot = old_snapshot
+			self.snapshots[service_id] = snapshot
+			self.total_entities += snapshot.size()
+			#the snapshot being returned is always kept, even if it is over the limit on its own
+			while self.total_entities > self.max_entities and len(self.snapshots) > 1:
+				evicted_id, evicted = self.snapshots.popitem(last=False)
+				self.total_entities -= evicted.size()
+		return snapshot
+
+	def clear(self):
+		with self.lock:
+			self.snapshots.clear()
+			self.total_entities = 0
+
+#shared by every thread of a worker process
+directory_cache = DirectoryCache(
+	int(os.getenv('DANIEL_AUTHENTICATOR_DIRECTORY_CACHE_SIZE', "50000")))
@@ -0,0 +1,98 @@
+import os, sys, json, queue, random, threading, logging, logging.handlers, atexit
+from datetime import datetime, timezone
+
+#structured events, written as one json object per line to stdout by a background thread, so a slow disk or a full
+#pipe behind stdout never holds up a request; when the queue is full events are dropped and counted instead
+#every event has the same fields: time, level, event, outcome, principal, service, duration (in seconds), plus any
+#extra ones it was logged with; sampling is set per event or per event and outcome, e.g. user_login.allowed=0.1
+
+#events waiting to be written before new ones are dropped
+EVENT_LOG_QUEUE_SIZE = 10000
+
+EVENT_FIELDS = ["event", "outcome", "principal", "service", "duration"]
+
+class JsonFormatter(logging.Formatter):
+	def format(self, record):
+		entry = {
+			"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+			"level": record.levelname.lower(),
+		}
+		for field in EVENT_FIELDS:
+			entry[field] = getattr(record, field, None)
+		entry.update(getattr(record, "fields", {}))
+		if record.msg != "":
+			entry["message"] = record.getMessage()
+		if getattr(record, "dropped", 0) > 0:
+			entry["dropped"] = record.dropped
+		return json.dumps(entry)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+	def __init__(self, event_queue):
+		super().__init__(event_queue)
+		self.dropped = 0
+
+	#the count of events dropped since the last one that made it goes out with the next one that does
+	def enqueue(self, record):
+		record.dropped = self.dropped
+		try:
+			self.queue.put_nowait(record)
+			self.dropped = 0
+		except queue.Full:
+			self.dropped += 1
+
+class EventListener(logging.handlers.QueueListener):
+	#at exit, waiting for room in a full queue is what lets everything already queued be written
+	def enqueue_sentinel(self):
+		self.queue.put(self._sentinel)
+
+class EventLog:
+	def __init__(self, level, sampling):
+		self.logger = logging.getLogger("daniel_authenticator")
+		self.logger.setLevel(level)
+		self.logger.propagate = False
+		self.sampling = sampling
+		self.pid = None
+		self.lock = threading.Lock()
+
+	#the listener thread is started lazily so that every forked worker gets its own
+	def start(self):
+		if self.pid == os.getpid():
+			return
+		with self.lock:
+			if self.pid == os.getpid():
+				return
+			event_queue = queue.Queue(EVENT_LOG_QUEUE_SIZE)
+			stream_handler = logging.StreamHandler(sys.stdout)
+			stream_handler.setFormatter(JsonFormatter())
+			listener = EventListener(event_queue, stream_handler)
+			self.logger.handlers = [DroppingQueueHandler(event_queue)]
+			listener.start()
+			atexit.register(listener.stop)
+			self.pid = os.getpid()
+
+	def sampled(self, event, outcome):
+		rate = self.sampling.get("%s.%s" % (event, outcome), self.sampling.get(event, 1))
+		return rate >= 1 or random.random() < rate
+
+	def log(self, event, outcome, principal=None, service=None, duration=None, level=logging.INFO, message="", **fields):
+		if not self.logger.isEnabledFor(level) or not self.sampled(event, outcome):
+			return
+		self.start()
+		self.logger.log(level, message, extra={"event": event, "outcome": outcome, "principal": principal,
+			"service": service, "duration": duration, "fields": fields})
+
+#"event=rate,event.outcome=rate,..."
+def parse_sampling(sampling):
+	rates = {}
+	for entry in sampling.split(","):
+		if entry.strip() != "":
+			name, rate = entry.split("=", 1)
+			rates[name.strip()] = float(rate)
+	return rates
+
+event_log = EventLog(
+	os.getenv('DANIEL_AUTHENTICATOR_LOG_LEVEL', "INFO").upper(),
+	parse_sampling(os.getenv('DANIEL_AUTHENTICATOR_LOG_SAMPLING', "")))
+
+def log_event(event, outcome, principal=None, service=None, duration=None, level=logging.INFO, message="", **fields):
+	event_log.log(event, outcome, principal, service, duration, level, message, **fields)
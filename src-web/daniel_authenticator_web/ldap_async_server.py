@@ -0,0 +1,124 @@
+import os, sys, json, time, asyncio, logging, urllib.parse
+import concurrent.futures
+from werkzeug.datastructures import MultiDict
+from daniel_authenticator_web.database import Database, release_connection
+from daniel_authenticator_web.metrics import metrics
+from daniel_authenticator_web.event_log import log_event
+from daniel_authenticator_web.ldap_proxy_connector import handle_bind_form, handle_search_form, handle_close_form, encode_search_response
+
+#the ldap proxy's /bind, /search, and /close in one asyncio process, in place of gunicorn's sync workers, which can only run as
+#many binds at a time as there are workers and leave every search waiting behind them
+#each http connection from the ldap frontend is a coroutine, binds run on a thread pool sized to the machine's cores,
+#where the PBKDF2 that dominates them runs in parallel since hashlib releases the GIL, and searches run on a separate
+#pool, so a burst of binds never holds up the cheap searches; each pool thread keeps its own database connection
+#only what the ldap frontend sends is understood: http/1.1 POSTs with a Content-Length and a form body
+
+#largest request body read, no real bind or search comes anywhere near this
+MAX_REQUEST_BODY = 1024 * 1024
+
+def run_bind(form):
+	try:
+		result = handle_bind_form(Database(), form)
+	finally:
+		release_connection()
+	return json.dumps({"Result": result}).encode("utf-8")
+
+def run_search(form):
+	try:
+		result, entities, next_cookie, attribute_names, body = handle_search_form(Database(), form, True)
+		if body is None:
+			body = encode_search_response(result, entities, next_cookie, attribute_names)
+		return body
+	finally:
+		release_connection()
+
+def run_close(form):
+	handle_close_form(form)
+	return json.dumps({"Result": True}).encode("utf-8")
+
+class LdapAsyncServer:
+	def __init__(self, hash_threads, database_threads):
+		self.hash_executor = concurrent.futures.ThreadPoolExecutor(hash_threads, thread_name_prefix="hash")
+		self.database_executor = concurrent.futures.ThreadPoolExecutor(database_threads, thread_name_prefix="database")
+		self.routes = {"/bind": (run_bind, self.hash_executor), "/search": (run_search, self.database_executor),
+			"/close": (run_close, self.database_executor)}
+
+	async def handle_connection(self, reader, writer):
+		try:
+			while await self.handle_request(reader, writer):
+				pass
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			writer.close()
+
+	#returns whether the connection stays open for another request
+	async def handle_request(self, reader, writer):
+		try:
+			head = await reader.readuntil(b"\r\n\r\n")
+		except asyncio.IncompleteReadError as e:
+			if len(e.partial) == 0:
+				return False
+			raise
+		lines = head.decode("latin-1").split("\r\n")
+		request_line = lines[0].split(" ")
+		headers = {}
+		for line in lines[1:]:
+			if ":" in line:
+				name, value = line.split(":", 1)
+				headers[name.strip().lower()] = value.strip()
+		keep_alive = headers.get("connection", "").lower() != "close" and (len(request_line) < 3 or request_line[2] != "HTTP/1.0")
+
+		if len(request_line) != 3 or request_line[0] != "POST" or request_line[1] not in self.routes:
+			await self.respond(writer, 404, b"404", False)
+			return False
+		if "content-length" not in headers or not headers["content-length"].isdigit() or int(headers["content-length"]) > MAX_REQUEST_BODY:
+			await self.respond(writer, 411, b"411", False)
+			return False
+		body = await reader.readexactly(int(headers["content-length"]))
+
+		try:
+			form = MultiDict(urllib.parse.parse_qsl(body.decode("utf-8"), keep_blank_values=True, strict_parsing=True, errors="strict"))
+		except ValueError:
+			#not utf-8 or not a form, which the ldap frontend never sends; the body has been read, so the connection can go on
+			await self.respond(writer, 400, b"400", keep_alive)
+			return keep_alive
+		
+		start_time = time.monotonic()
+		handler, executor = self.routes[request_line[1]]
+		try:
+			response = await asyncio.get_running_loop().run_in_executor(executor, handler, form)
+			status = 200
+		except Exception as e:
+			log_event("ldap_async_request", "failed", level=logging.ERROR, path=request_line[1], error="%s: %s" % (type(e).__name__, e))
+			response = b"500"
+			status = 500
+		metrics.observe("daniel_authenticator_request_seconds", time.monotonic() - start_time, {"app": "ldap_async", "route": request_line[1]})
+		await self.respond(writer, status, response, keep_alive)
+		return keep_alive
+
+	async def respond(self, writer, status, body, keep_alive):
+		reasons = {200: "OK", 400: "BAD REQUEST", 404: "NOT FOUND", 411: "LENGTH REQUIRED", 500: "INTERNAL SERVER ERROR"}
+		writer.write(("HTTP/1.1 %i %s\r\nContent-Type: application/json\r\nContent-Length: %i\r\nConnection: %s\r\n\r\n" %
+			(status, reasons[status], len(body), "keep-alive" if keep_alive else "close")).encode("latin-1") + body)
+		await writer.drain()
+
+	async def serve(self, host, port):
+		server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_REQUEST_BODY)
+		print("LDAP proxy listening on %s:%i" % (host, port))
+		sys.stdout.flush()
+		async with server:
+			await server.serve_forever()
+
+def main():
+	if len(sys.argv) > 2:
+		print("Usage: daniel-authenticator-ldap-async [HOST:PORT]")
+		sys.exit(1)
+	host, port = (sys.argv[1] if len(sys.argv) == 2 else "127.0.0.1:25565").rsplit(":", 1)
+	server = LdapAsyncServer(
+		int(os.getenv('DANIEL_AUTHENTICATOR_HASH_THREADS', str(os.cpu_count() or 4))),
+		int(os.getenv('DANIEL_AUTHENTICATOR_DATABASE_THREADS', "4")))
+	asyncio.run(server.serve(host, int(port)))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,124 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+from daniel_authenticator_web.ldap_entities import SERVICES_BASE_DN
+
+#parses and classifies the DNs the proxy is given, e.g. uid=alice,ou=users,ou=wiki,ou=services,dc=daniel-authenticator
+#each rdn is split on unescaped separators and its escapes decoded as in RFC 4514, attribute types and the fixed parts
+#of our DNs (ou=users, ou=services, ...) are matched regardless of case and surrounding spaces, and usernames and
+#service names are kept exactly as given, since they are looked up as is in the database
+
+DN_ROOT = "root"
+DN_SERVICE = "service"
+DN_USERS_BASE = "users_base"
+DN_GROUPS_BASE = "groups_base"
+DN_USER = "user"
+DN_GROUP = "group"
+#under a service, but not any entry we have
+DN_IN_SERVICE = "in_service"
+DN_INVALID = "invalid"
+
+#service is set for every DN under a service, username for users and groups
+ParsedDn = namedtuple("ParsedDn", ["kind", "service", "username"])
+
+#the same handful of DNs, every service's bind DN and search bases, come up over and over
+DN_CACHE_SIZE = 4096
+
+NAME_REGEX = re.compile(r"^[a-zA-Z0-9_\-.@]+$")
+HEX_DIGITS = "0123456789abcdefABCDEF"
+
+#splits on separators that are not escaped with a backslash, keeping the escapes in the parts
+def split_unescaped(string, separator):
+	parts = []
+	start = 0
+	index = 0
+	while index < len(string):
+		if string[index] == "\\":
+			index += 2
+			continue
+		if string[index] == separator:
+			parts.append(string[start:index])
+			start = index + 1
+		index += 1
+	parts.append(string[start:])
+	return parts
+
+#decodes the escapes of an attribute value, dropping the spaces around it that are not escaped; None if it is malformed
+def unescape_value(value):
+	value = value.lstrip(" ")
+	#a trailing space preceded by an odd number of backslashes is escaped and stays
+	while value.endswith(" ") and (len(value) - len(value[:-1].rstrip("\\")) - 1) % 2 == 0:
+		value = value[:-1]
+	if value.startswith("#") or value.startswith('"'):
+		#hex encoded and quoted values are not used in any DN we hand out
+		return None
+	decoded = bytearray()
+	index = 0
+	while index < len(value):
+		character = value[index]
+		if character != "\\":
+			decoded += character.encode("utf-8")
+			index += 1
+		elif len(value[index + 1:index + 3]) == 2 and all(digit in HEX_DIGITS for digit in value[index + 1:index + 3]):
+			#\XX is a byte of the value's utf-8
+			decoded.append(int(value[index + 1:index + 3], 16))
+			index += 3
+		elif index + 1 < len(value):
+			decoded += value[index + 1].encode("utf-8")
+			index += 2
+		else:
+			return None
+	try:
+		return decoded.decode("utf-8")
+	except UnicodeDecodeError:
+		return None
+
+#a list of (lowercased attribute type, value) pairs, or None if any rdn is malformed or multi-valued
+def parse_rdns(dn):
+	rdns = []
+	for rdn in split_unescaped(dn, ","):
+		if len(split_unescaped(rdn, "+")) != 1:
+			return None
+		attribute_and_value = split_unescaped(rdn, "=")
+		if len(attribute_and_value) < 2:
+			return None
+		attribute = attribute_and_value[0].strip().lower()
+		#an unescaped = inside a value is tolerated, as other servers do
+		value = unescape_value("=".join(attribute_and_value[1:]))
+		if attribute == "" or value is None:
+			return None
+		rdns.append((attribute, value))
+	return rdns
+
+def is_rdn(rdn, attribute, value):
+	return rdn[0] == attribute and rdn[1].lower() == value
+
+SERVICES_BASE_RDNS = [(attribute, value.lower()) for attribute, value in parse_rdns(SERVICES_BASE_DN)]
+
+@lru_cache(maxsize=DN_CACHE_SIZE)
+def parse_dn(dn):
+	if dn.strip() == "":
+		return ParsedDn(DN_ROOT, None, None)
+	rdns = parse_rdns(dn)
+	base_length = len(SERVICES_BASE_RDNS)
+	if rdns is None or len(rdns) <= base_length or not all(is_rdn(rdn, *base_rdn) for rdn, base_rdn in zip(rdns[-base_length:], SERVICES_BASE_RDNS)):
+		return ParsedDn(DN_INVALID, None, None)
+
+	service_rdn = rdns[-base_length - 1]
+	if service_rdn[0] != "ou" or not NAME_REGEX.match(service_rdn[1]):
+		return ParsedDn(DN_INVALID, None, None)
+	service = service_rdn[1]
+
+	prefix = rdns[:-base_length - 1]
+	if len(prefix) == 0:
+		return ParsedDn(DN_SERVICE, service, None)
+	elif len(prefix) == 1 and is_rdn(prefix[0], "ou", "users"):
+		return ParsedDn(DN_USERS_BASE, service, None)
+	elif len(prefix) == 1 and is_rdn(prefix[0], "ou", "groups"):
+		return ParsedDn(DN_GROUPS_BASE, service, None)
+	elif len(prefix) == 2 and prefix[0][0] == "uid" and NAME_REGEX.match(prefix[0][1]) and is_rdn(prefix[1], "ou", "users"):
+		return ParsedDn(DN_USER, service, prefix[0][1])
+	elif len(prefix) == 2 and prefix[0][0] == "uid" and NAME_REGEX.match(prefix[0][1]) and is_rdn(prefix[1], "ou", "groups"):
+		return ParsedDn(DN_GROUP, service, prefix[0][1])
+	else:
+		return ParsedDn(DN_IN_SERVICE, service, None)
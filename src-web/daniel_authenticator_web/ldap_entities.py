@@ -0,0 +1,66 @@
+BASE_DN = "dc=daniel-authenticator"
+
+SERVICES_BASE_DN = "ou=services," + BASE_DN
+
+def make_null_entity():
+	return {
+		"DN": "",
+		"Attributes": {
+			"objectClass": ["top"],
+			"vendorName": ["Daniel Authenticator"],
+			"namingContexts": [BASE_DN],
+			"defaultnamingcontext": [BASE_DN] 
+		}
+	}
+
+def new_make_user_dn(service_info, username):
+	return "uid=%s,ou=users,ou=%s,%s" % (username, service_info['username'], SERVICES_BASE_DN)
+
+def new_make_group_dn(service_info, username):
+	return "uid=%s,ou=groups,ou=%s,%s" % (username, service_info['username'], SERVICES_BASE_DN)
+
+def new_make_entity_from_user_info(service_info, user_info, group_usernames):
+	return {
+		"DN": new_make_user_dn(service_info, user_info["username"]),
+		"Attributes": {
+			"uid": [user_info["username"]],
+			"cn": [user_info["fullname"]],
+			"displayName": [user_info["fullname"]],
+			"givenName": [user_info["fullname"]],
+			"sn": [""],
+			"mail": [user_info["email"]],
+			"ipaUniqueID": [user_info["uuid"]],
+			"objectClass": ["user"],
+			"memberOf": [new_make_group_dn(service_info, group_username) for group_username in group_usernames]
+		}
+	}
+
+def new_make_entity_from_group_info(service_info, group_info, user_usernames):
+	return {
+		"DN": new_make_group_dn(service_info, group_info["username"]),
+		"Attributes": {
+			"uid": [group_info["username"]],
+			"cn": [group_info["fullname"]],
+			"dsplayName": [group_info["fullname"]],
+			"ipaUniqueID": [group_info["uuid"]],
+			"objectClass": ["group"],
+			"member": [new_make_user_dn(service_info, user_username) for user_username in user_usernames]
+		}
+	}
+
+#lowercased names of the attributes a search has to return, or None for all of them
+#the frontend re-applies the filter to what is returned, so attributes the filter uses are always kept
+def select_attribute_names(requested_attributes, search_filter_attributes):
+	requested_attributes = [attribute.lower() for attribute in requested_attributes if attribute != ""]
+	if len(requested_attributes) == 0 or "*" in requested_attributes or search_filter_attributes is None:
+		return None
+	#1.1 asks for no attributes at all and is ignored when listed together with others
+	return set(attribute for attribute in requested_attributes if attribute != "1.1") | search_filter_attributes
+
+def select_attributes(entity, attribute_names):
+	if attribute_names is None:
+		return entity
+	return {
+		"DN": entity["DN"],
+		"Attributes": {key: value for key, value in entity["Attributes"].items() if key.lower() in attribute_names}
+	}
@@ -0,0 +1,248 @@
+#parses RFC 4515 search filters and compiles them into sql conditions against the users and groups tables
+#the go frontend re-applies every filter to the returned entities, so a compiled condition only ever has to
+#select a superset of the matching rows; anything that cannot be translated exactly is simply left out
+
+SCOPE_BASE_OBJECT = 0
+SCOPE_SINGLE_LEVEL = 1
+SCOPE_WHOLE_SUBTREE = 2
+
+#lowercased attribute name -> users/groups column; every other attribute of the entity is not compilable
+FILTER_COLUMNS = {
+	"user": {
+		"uid": "username",
+		"cn": "fullname",
+		"displayname": "fullname",
+		"givenname": "fullname",
+		"mail": "email",
+		"ipauniqueid": "uuid"
+	},
+	"group": {
+		"uid": "username",
+		"cn": "fullname",
+		"dsplayname": "fullname",
+		"ipauniqueid": "uuid"
+	}
+}
+
+FILTER_OBJECT_CLASSES = {
+	"user": ["user"],
+	"group": ["group"]
+}
+
+#attributes that entities of this type have but that are not backed by a single column
+FILTER_OTHER_ATTRIBUTES = {
+	"user": ["sn", "memberof"],
+	"group": ["member"]
+}
+
+TRUE_CONDITION = ("1", [])
+FALSE_CONDITION = ("0", [])
+
+class FilterError(Exception):
+	pass
+
+def unescape_filter_value(raw):
+	output = bytearray()
+	position = 0
+	while position < len(raw):
+		if raw[position] == "\\":
+			try:
+				output.append(int(raw[position+1:position+3], 16))
+			except ValueError:
+				raise FilterError("invalid escape in filter value %s" % raw)
+			position += 3
+		else:
+			output += raw[position].encode("utf-8")
+			position += 1
+	try:
+		return output.decode("utf-8")
+	except UnicodeDecodeError:
+		raise FilterError("filter value %s is not utf-8" % raw)
+
+def parse_filter_item(text, position):
+	if position >= len(text) or text[position] != "(":
+		raise FilterError("expected ( at position %i" % position)
+	position += 1
+	if position >= len(text):
+		raise FilterError("unexpected end of filter")
+
+	if text[position] in "&|":
+		operator = "and" if text[position] == "&" else "or"
+		position += 1
+		children = []
+		while position < len(text) and text[position] == "(":
+			child, position = parse_filter_item(text, position)
+			children.append(child)
+		node = (operator, children)
+	elif text[position] == "!":
+		child, position = parse_filter_item(text, position + 1)
+		node = ("not", child)
+	else:
+		end = text.find(")", position)
+		if end == -1:
+			raise FilterError("unterminated filter item")
+		item = text[position:end]
+		position = end
+		node = parse_filter_comparison(item)
+
+	if position >= len(text) or text[position] != ")":
+		raise FilterError("expected ) at position %i" % position)
+	return node, position + 1
+
+def parse_filter_comparison(item):
+	for operator in ["~=", ">=", "<="]:
+		if operator in item:
+			return ("unsupported",)
+	if "=" not in item:
+		raise FilterError("filter item %s has no operator" % item)
+	attribute, raw_value = item.split("=", 1)
+	if len(attribute) == 0:
+		raise FilterError("filter item %s has no attribute" % item)
+	if ":" in attribute:
+		#extensible match
+		return ("unsupported",)
+	attribute = attribute.lower()
+
+	if raw_value == "*":
+		return ("present", attribute)
+	elif "*" in raw_value:
+		pieces = [unescape_filter_value(piece) for piece in raw_value.split("*")]
+		return ("substring", attribute, pieces[0], [piece for piece in pieces[1:-1] if piece != ""], pieces[-1])
+	else:
+		return ("equal", attribute, unescape_filter_value(raw_value))
+
+def parse_filter(text):
+	text = text.strip()
+	if not text.startswith("("):
+		#the bare item form, e.g. uid=alice
+		text = "(" + text + ")"
+	node, position = parse_filter_item(text, 0)
+	if position != len(text):
+		raise FilterError("trailing characters after filter")
+	return node
+
+def value_case_foldable(value):
+	#sqlite's NOCASE and LIKE only fold ascii, so anything else would not match what the frontend matches
+	return value.isascii()
+
+def escape_like(value):
+	return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def match_substring(value, initial, anys, final):
+	value = value.lower()
+	if not value.startswith(initial.lower()):
+		return False
+	position = len(initial)
+	for piece in anys:
+		found = value.find(piece.lower(), position)
+		if found == -1:
+			return False
+		position = found + len(piece)
+	return len(value) - position >= len(final) and value.endswith(final.lower())
+
+def constant_condition(value):
+	return TRUE_CONDITION if value else FALSE_CONDITION
+
+#returns an (sql, parameters) condition that selects exactly the matching rows, or None if that is not possible
+def compile_exact(node, entity_type):
+	kind = node[0]
+	if kind == "and" or kind == "or":
+		children = [compile_exact(child, entity_type) for child in node[1]]
+		if None in children:
+			return None
+		if len(children) == 0:
+			return constant_condition(kind == "and")
+		joiner = " AND " if kind == "and" else " OR "
+		return (joiner.join("(%s)" % child[0] for child in children), [parameter for child in children for parameter in child[1]])
+	elif kind == "not":
+		child = compile_exact(node[1], entity_type)
+		if child is None:
+			return None
+		return ("NOT (%s)" % child[0], child[1])
+	elif kind == "unsupported":
+		return None
+
+	attribute = node[1]
+	columns = FILTER_COLUMNS[entity_type]
+	if attribute == "objectclass":
+		classes = FILTER_OBJECT_CLASSES[entity_type]
+		if kind == "present":
+			return TRUE_CONDITION
+		elif kind == "equal":
+			return constant_condition(node[2].lower() in classes)
+		else:
+			return constant_condition(any(match_substring(object_class, node[2], node[3], node[4]) for object_class in classes))
+	elif attribute in FILTER_OTHER_ATTRIBUTES[entity_type]:
+		return None
+	elif attribute not in columns:
+		#the entity does not have this attribute at all, so nothing can match
+		return FALSE_CONDITION
+
+	column = columns[attribute]
+	if kind == "present":
+		return TRUE_CONDITION
+	elif kind == "equal":
+		if not value_case_foldable(node[2]):
+			return None
+		return ("%s = ? COLLATE NOCASE" % column, [node[2]])
+	else:
+		pieces = [node[2]] + node[3] + [node[4]]
+		if not all(value_case_foldable(piece) for piece in pieces):
+			return None
+		pattern = escape_like(node[2]) + "%" + "".join(escape_like(piece) + "%" for piece in node[3]) + escape_like(node[4])
+		return ("%s LIKE ? ESCAPE '\\'" % column, [pattern])
+
+#like compile_exact, but may drop uncompilable parts of a conjunction, giving a condition that selects a superset
+def compile_superset(node, entity_type):
+	exact = compile_exact(node, entity_type)
+	if exact is not None:
+		return exact
+
+	if node[0] == "and":
+		children = [compile_superset(child, entity_type) for child in node[1]]
+		children = [child for child in children if child is not None]
+		if len(children) == 0:
+			return None
+		return (" AND ".join("(%s)" % child[0] for child in children), [parameter for child in children for parameter in child[1]])
+	elif node[0] == "or":
+		children = [compile_superset(child, entity_type) for child in node[1]]
+		if None in children:
+			return None
+		return (" OR ".join("(%s)" % child[0] for child in children), [parameter for child in children for parameter in child[1]])
+	else:
+		return None
+
+def compile_filter(filter_string, entity_type):
+	if filter_string is None or filter_string.strip() == "":
+		return TRUE_CONDITION
+	try:
+		node = parse_filter(filter_string)
+	except FilterError:
+		return TRUE_CONDITION
+	condition = compile_superset(node, entity_type)
+	if condition is None:
+		return TRUE_CONDITION
+	return condition
+
+#lowercased names of every attribute the filter looks at, or None if that cannot be known
+def filter_attributes(filter_string):
+	if filter_string is None or filter_string.strip() == "":
+		return set()
+	try:
+		node = parse_filter(filter_string)
+	except FilterError:
+		return None
+
+	attributes = set()
+	nodes = [node]
+	while len(nodes) > 0:
+		node = nodes.pop()
+		if node[0] == "and" or node[0] == "or":
+			nodes.extend(node[1])
+		elif node[0] == "not":
+			nodes.append(node[1])
+		elif node[0] == "unsupported":
+			return None
+		else:
+			attributes.add(node[1])
+	return attributes
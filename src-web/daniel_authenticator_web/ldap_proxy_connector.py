@@ -1,296 +1,331 @@
-import os, json, time, random, re
-from flask import Flask, g, render_template, request, url_for, flash, redirect, session, send_from_directory
-from daniel_authenticator_web.database import Database
+import os, json, time, random, base64, logging
+from flask import Flask, Response, g, render_template, request, url_for, flash, redirect, session, send_from_directory
+from daniel_authenticator_web.database import Database, release_connection, ACCOUNT_LOCKED_MESSAGE
+from daniel_authenticator_web.metrics import metrics, instrument_app
+from daniel_authenticator_web.sql_trace import sql_tracer
+from daniel_authenticator_web.capture import capture
+from daniel_authenticator_web.event_log import log_event
+from daniel_authenticator_web.session_trace import session_traces
+from daniel_authenticator_web.ldap_entities import *
+from daniel_authenticator_web.ldap_dn import parse_dn, DN_ROOT, DN_SERVICE, DN_USERS_BASE, DN_GROUPS_BASE, DN_USER, DN_GROUP
+from daniel_authenticator_web.directory_cache import directory_cache
+from daniel_authenticator_web.search_cache import search_cache, CachedSearch
+from daniel_authenticator_web.ldap_filter import compile_filter, filter_attributes, TRUE_CONDITION, SCOPE_BASE_OBJECT, SCOPE_SINGLE_LEVEL, SCOPE_WHOLE_SUBTREE
 
-BASE_DN = "dc=daniel-authenticator"
+#paged searches continue after the username named by the cookie, so pages stay stable while entries are added or removed
+def make_page_cookie(username):
+	if username == "":
+		return ""
+	return base64.urlsafe_b64encode(username.encode("utf-8")).decode("ascii")
 
-SERVICES_BASE_DN = "ou=services," + BASE_DN
+def read_page_cookie(cookie):
+	try:
+		return base64.urlsafe_b64decode(cookie.encode("ascii")).decode("utf-8")
+	except (ValueError, UnicodeError):
+		return ""
 
-NEW_SERVICE_DN_REGEX = r"^ou=([a-zA-Z0-9_\-.@]+),%s$" % SERVICES_BASE_DN
-NEW_TRAILING_SERVICE_DN_REGEX = r".*ou=([a-zA-Z0-9_\-.@]+),%s$" % SERVICES_BASE_DN
+#the json response of /search; its size is bounded by the page size the ldap frontend asks for, not by the service
+def encode_search_response(result, entities, cookie, attribute_names):
+	return json.dumps({
+			"Result": result,
+			"Cookie": cookie,
+			"Entities": [select_attributes(entity, attribute_names) for entity in entities]
+		}).encode("utf-8")
 
-NEW_USERS_BASE_DN_REGEX = r"^ou=users,ou=([a-zA-Z0-9_\-.@]+),%s$" % SERVICES_BASE_DN
-NEW_GROUPS_BASE_DN_REGEX = r"^ou=groups,ou=([a-zA-Z0-9_\-.@]+),%s$" % SERVICES_BASE_DN
-
-NEW_USER_DN_REGEX = r"^uid=([a-zA-Z0-9_\-.@]+),ou=users,ou=([a-zA-Z0-9_\-.@]+),%s$" % SERVICES_BASE_DN
-NEW_GROUP_DN_REGEX = r"^uid=([a-zA-Z0-9_\-.@]+),ou=groups,ou=([a-zA-Z0-9_\-.@]+),%s$" % SERVICES_BASE_DN
-
-def make_null_entity():
-	return {
-		"DN": "",
-		"Attributes": {
-			"objectClass": ["top"],
-			"vendorName": ["Daniel Authenticator"],
-			"namingContexts": [BASE_DN],
-			"defaultnamingcontext": [BASE_DN] 
-		}
-	}
-
-"""
-def make_entity_from_user_info(db, service_id, user_info):
-	groups = db.get_user_group_memberships_for_service(user_info["user_id"], service_id)
-	memberOfs = []
-	for group in groups:
-		memberOfs.append("uid=%s,%s" % (group["username"], GROUPS_BASE_DN))
+#the decisions of /bind, shared by every way the ldap frontend can reach the proxy; returns the result
+def handle_bind(db, bindDN, bindSimplePw, boundDN, connection_number):
+	start_time = time.monotonic()
 	
-	return {
-		"DN": "uid=%s,%s" % (user_info["username"], USERS_BASE_DN),
-		"Attributes": {
-			"uid": [user_info["username"]],
-			"cn": [user_info["fullname"]],
-			"displayName": [user_info["fullname"]],
-			"mail": [user_info["email"]],
-			"ipaUniqueID": [user_info["uuid"]],
-			"objectClass": ["posixaccount"],
-			"memberOf": memberOfs
-		}
-	}
-
-def make_entity_from_group_info(db, service_id, group_info):
-	users = db.get_users_in_group_for_service(group_info["group_id"], service_id)
-	members = []
-	for user in users:
-		members.append("uid=%s,%s" % (user["username"], USERS_BASE_DN))
+	bind_dn = parse_dn(bindDN)
 	
-	return {
-		"DN": "uid=%s,%s" % (group_info["username"], GROUPS_BASE_DN),
-		"Attributes": {
-			"uid": [group_info["username"]],
-			"cn": [group_info["fullname"]],
-			"dsplayName": [group_info["fullname"]],
-			"ipaUniqueID": [group_info["uuid"]],
-			"objectClass": ["posixgroup"],
-			"member": members
-		}
-	}
-"""
-
-def new_make_entity_from_user_info(db, service_id, user_info):
-	service_info = db.get_service_info(service_id)
-	groups = db.get_user_group_memberships_for_service(user_info["user_id"], service_id)
-	memberOfs = []
-	for group in groups:
-		memberOfs.append("uid=%s,ou=groups,ou=%s,%s" % (group["username"], service_info['username'], SERVICES_BASE_DN))
+	result = False
+	outcome = ""
+	#the service label is only set for allowed binds, so made up DNs cannot create new series
+	if bind_dn.kind == DN_SERVICE:
+		service = db.attempt_service_login(bind_dn.service, bindSimplePw)
+		if service is not None:
+			outcome = "service login allowed"
+			result = True
+			metrics.increment("daniel_authenticator_binds_total", {"kind": "service", "outcome": "allowed", "service": bind_dn.service})
+		else:
+			outcome = "service login denied"
+			result = False
+			metrics.increment("daniel_authenticator_binds_total", {"kind": "service", "outcome": "denied", "service": ""})
+		
+	elif bind_dn.kind == DN_USER:
+		user, message = db.attempt_user_login_with_service(bind_dn.username, bindSimplePw, bind_dn.service)
+		if user is not None:
+			outcome = "user login allowed"
+			result = True
+			metrics.increment("daniel_authenticator_binds_total", {"kind": "user", "outcome": "allowed", "service": bind_dn.service})
+		else:
+			outcome = "user login denied"
+			result = False
+			metrics.increment("daniel_authenticator_binds_total", {"kind": "user", "outcome": "locked" if message == ACCOUNT_LOCKED_MESSAGE else "denied", "service": ""})
 	
-	return {
-		"DN": "uid=%s,ou=users,ou=%s,%s" % (user_info["username"], service_info['username'], SERVICES_BASE_DN),
-		"Attributes": {
-			"uid": [user_info["username"]],
-			"cn": [user_info["fullname"]],
-			"displayName": [user_info["fullname"]],
-			"givenName": [user_info["fullname"]],
-			"sn": [""],
-			"mail": [user_info["email"]],
-			"ipaUniqueID": [user_info["uuid"]],
-			"objectClass": ["user"],
-			"memberOf": memberOfs
-		}
-	}
-
-def new_make_entity_from_group_info(db, service_id, group_info):
-	service_info = db.get_service_info(service_id)
-	users = db.get_users_in_group_for_service(group_info["group_id"], service_id)
-	members = []
-	for user in users:
-		members.append("uid=%s,ou=users,ou=%s,%s" % (user["username"], service_info['username'], SERVICES_BASE_DN))
+	else:
+		outcome = "invalid DN denied"
+		result = False
+		metrics.increment("daniel_authenticator_binds_total", {"kind": "none", "outcome": "invalid_dn", "service": ""})
 	
-	return {
-		"DN": "uid=%s,ou=groups,ou=%s,%s" % (group_info["username"], service_info['username'], SERVICES_BASE_DN),
-		"Attributes": {
-			"uid": [group_info["username"]],
-			"cn": [group_info["fullname"]],
-			"dsplayName": [group_info["fullname"]],
-			"ipaUniqueID": [group_info["uuid"]],
-			"objectClass": ["group"],
-			"member": members
-		}
-	}
+	#the logins themselves are already logged by the database, this is the ldap side of them
+	log_event("ldap_bind", "allowed" if result else "denied", bindDN, duration=time.monotonic() - start_time, level=logging.DEBUG,
+		connection=connection_number, reason=outcome)
+	session_traces.record(connection_number, "bind(" + bindDN + " " + outcome + ")")
+	return result
 
-def create_ldap_app():
-	app = Flask(__name__)
+#the decisions of /search; returns the result, the entities found, the cookie of the next page, the names of the
+#attributes to return, or None for all of them, and, when serialize is set and the search cache is enabled, the json
+#response as bytes, otherwise None; when the response came from the search cache, no entities are returned with it
+def handle_search(db, boundDN, BaseDN, search_filter, scope, attributes, page_size, cookie, connection_number, serialize=False):
+	start_time = time.monotonic()
 	
-	@app.route('/bind', methods = ['POST'])
-	def bind_route():
-		db = Database()
-		bindDN = request.form.get('bindDN', type=str)
-		bindSimplePw = request.form.get('bindSimplePw', type=str)
-		boundDN = request.form.get('boundDN', type=str)
-		connection_number = request.form.get('connectionNumber', type=int)
-		strand = request.form.get('strand', type=str)
-		
-		strand = strand + "bind(" + bindDN + " "
-		
-		new_service_result = re.match(NEW_SERVICE_DN_REGEX, bindDN)
-		new_user_result = re.match(NEW_USER_DN_REGEX, bindDN)
+	attribute_names = select_attribute_names(attributes, filter_attributes(search_filter))
+	
+	bound_dn = parse_dn(boundDN)
+	base_dn = parse_dn(BaseDN)
+	
+	result = False
+	entities = []
+	next_cookie = ""
+	outcome = ""
+	body = None
+	cached = None
+	cache_key = None
+	cache_revision = None
+	
+	def do_search():
+		nonlocal result
+		nonlocal entities
+		nonlocal next_cookie
+		nonlocal outcome
+		nonlocal cached
+		nonlocal cache_key
+		nonlocal cache_revision
 		
-		result = False
-		if new_service_result is not None:
-			service = db.attempt_service_login(new_service_result.group(1), bindSimplePw)
-			if service is not None:
-				strand += "service login allowed"
-				result = True
-			else:
-				strand += "service login denied"
+		if base_dn.service is not None:
+			if bound_dn.kind == DN_SERVICE and base_dn.service != bound_dn.service:
+				outcome = "mismatched bound service and search base denied"
 				result = False
-			
-		elif new_user_result is not None:
-			user, message = db.attempt_user_login_with_service(new_user_result.group(1), bindSimplePw, new_user_result.group(2))
-			if user is not None:
-				strand += "user login allowed"
-				result = True
-			else:
-				strand += "user login denied"
+				entities = []
+				
+			elif bound_dn.kind == DN_USER and base_dn.service != bound_dn.service:
+				outcome = "mismatched bound user in service and search base denied"
 				result = False
-		
-		else:
-			strand += "invalid DN denied"
-			result = False
-		
-		strand = strand + ") -> "
-		
-		return json.dumps({
-				"Result": result,
-				"Strand": strand
-			})
-	
-	@app.route('/search', methods = ['POST'])
-	def search_route():
-		db = Database()
-		boundDN = request.form.get('boundDN', type=str)
-		BaseDN = request.form.get('BaseDN', type=str)
-		connection_number = request.form.get('connectionNumber', type=int)
-		strand = request.form.get('strand', type=str)
-		
-		strand = strand + "search(" + BaseDN + " "
-		
-		new_service_result = re.match(NEW_SERVICE_DN_REGEX, boundDN)
-		new_user_result = re.match(NEW_USER_DN_REGEX, boundDN)
-		
-		result = False
-		entities = []
-		
-		def do_search():
-			nonlocal result
-			nonlocal entities
-			nonlocal strand
-			nonlocal new_service_result
-			nonlocal new_user_result
-			new_base_service_result = re.match(NEW_TRAILING_SERVICE_DN_REGEX, BaseDN)
+				entities = []
 				
-			if new_base_service_result is not None:
-				if new_service_result is not None and new_base_service_result.group(1) != new_service_result.group(1):
-					strand += "mismatched bound service and search base denied"
-					result = False
-					entities = []
-					
-				elif new_user_result is not None and new_base_service_result.group(1) != new_user_result.group(2):
-					strand += "mismatched bound user in service and search base denied"
+			else:
+				service = db.get_service_by_username(base_dn.service)
+				
+				if service is None:
+					outcome = "service does not exist denied"
 					result = False
 					entities = []
-					
-				else:
-					service = db.get_service_by_username(new_base_service_result.group(1))
-					
-					new_users_base_result = re.match(NEW_USERS_BASE_DN_REGEX, BaseDN)
-					new_groups_base_result = re.match(NEW_GROUPS_BASE_DN_REGEX, BaseDN)
-					new_user_result = re.match(NEW_USER_DN_REGEX, BaseDN)
-					new_group_result = re.match(NEW_GROUP_DN_REGEX, BaseDN)
-					
-					if new_users_base_result is not None:
-						users = db.get_users_in_service(service["service_id"])
-						for user in users:
-							entities.append(new_make_entity_from_user_info(db, service["service_id"], user))
-						strand += "users allowed"
-						result = True
-						
-					elif new_groups_base_result is not None:
-						groups = db.get_groups_in_service(service["service_id"])
-						for group in groups:
-							entities.append(new_make_entity_from_group_info(db, service["service_id"], group))
-						strand += "groups allowed"
+					return
+				
+				#everything else the response depends on is part of the service's revision, which is read before any of it
+				if serialize and search_cache.enabled():
+					cache_key = (service["service_id"], service["username"], base_dn, search_filter, scope,
+						None if attribute_names is None else frozenset(attribute_names), page_size, cookie)
+					cache_revision = db.get_service_revision(service["service_id"])
+					cached = search_cache.get(cache_key, cache_revision)
+					if cached is not None:
+						outcome = cached.outcome
+						next_cookie = cached.next_cookie
 						result = True
-					
-					elif new_user_result is not None:
-						user_info = db.get_user_by_username(new_user_result.group(1))
-						if user_info is not None:
-							if service in db.get_user_service_memberships(user_info['user_id']):
-								entities = [new_make_entity_from_user_info(db, service["service_id"], user_info)]
-								strand += "specific user allowed"
-								result = True
-							else:
-								strand += "specific user not in service denied"
-								result = False
-								entities = []
+						return
+				
+				entity_type = {DN_USER: "user", DN_GROUP: "group"}.get(base_dn.kind)
+				snapshot = directory_cache.get_snapshot(db, service, attribute_names is None or "memberof" in attribute_names or "member" in attribute_names,
+					entity_type, base_dn.username)
+				
+				if base_dn.kind == DN_USERS_BASE:
+					#the base entry itself is never returned, so a base object search finds nothing
+					if scope != SCOPE_BASE_OBJECT:
+						#a filtered search is paged by the database, so each page only costs as much as the entries on it
+						condition = compile_filter(search_filter, "user")
+						if condition == TRUE_CONDITION:
+							entities, last_username = snapshot.get_users(read_page_cookie(cookie), page_size)
 						else:
-							strand += "specific user does not exist denied"
-							result = False
-							entities = []
+							user_ids, last_username = db.get_user_ids_in_service_matching(service["service_id"], condition, read_page_cookie(cookie), page_size)
+							entities = snapshot.get_users_by_id(user_ids)
+						next_cookie = make_page_cookie(last_username)
+					outcome = "users allowed"
+					result = True
 					
-					elif new_group_result is not None:
-						group_info = db.get_group_by_username(new_group_result.group(1))
-						if group_info is not None:
-							if service in db.get_group_service_memberships(group_info['group_id']):
-								entities = [new_make_entity_from_group_info(db, service["service_id"], group_info)]
-								strand += "specific group allowed"
-								result = True
-							else:
-								strand += "specific group not in service denied"
-								result = False
-								entities = []
+				elif base_dn.kind == DN_GROUPS_BASE:
+					if scope != SCOPE_BASE_OBJECT:
+						condition = compile_filter(search_filter, "group")
+						if condition == TRUE_CONDITION:
+							entities, last_username = snapshot.get_groups(read_page_cookie(cookie), page_size)
 						else:
-							strand += "specific group does not exist denied"
-							result = False
-							entities = []
-					
+							group_ids, last_username = db.get_group_ids_in_service_matching(service["service_id"], condition, read_page_cookie(cookie), page_size)
+							entities = snapshot.get_groups_by_id(group_ids)
+						next_cookie = make_page_cookie(last_username)
+					outcome = "groups allowed"
+					result = True
+				
+				elif base_dn.kind == DN_USER:
+					entity = snapshot.users.get(base_dn.username)
+					if entity is not None:
+						#a specific entry has no children, so a single level search finds nothing
+						if scope != SCOPE_SINGLE_LEVEL:
+							condition = compile_filter(search_filter, "user")
+							if condition == TRUE_CONDITION or db.user_matches(snapshot.user_ids_by_username[base_dn.username], condition):
+								entities = [entity]
+						outcome = "specific user allowed"
+						result = True
+					elif db.get_user_by_username(base_dn.username) is not None:
+						outcome = "specific user not in service denied"
+						result = False
+						entities = []
 					else:
-						strand += "invalid search base denied"
+						outcome = "specific user does not exist denied"
 						result = False
 						entities = []
-			else:
-				strand += "invalid search base denied"
-				result = False
-				entities = []
-			
-		
-		if BaseDN == "":
-			entities.append(make_null_entity())
-			strand += "null base allowed"
-			result = True
-		elif new_service_result is not None:
-			service = db.get_service_by_username(new_service_result.group(1))
-			
-			if service is not None:
-				do_search()
 				
-			else:
-				strand += "service does not exist denied"
-				result = False
-				entities = []
-			
-		elif new_user_result is not None:
-			user = db.get_user_by_username(new_user_result.group(1))
-			
-			if user is not None:
-				do_search()
+				elif base_dn.kind == DN_GROUP:
+					entity = snapshot.groups.get(base_dn.username)
+					if entity is not None:
+						if scope != SCOPE_SINGLE_LEVEL:
+							condition = compile_filter(search_filter, "group")
+							if condition == TRUE_CONDITION or db.group_matches(snapshot.group_ids_by_username[base_dn.username], condition):
+								entities = [entity]
+						outcome = "specific group allowed"
+						result = True
+					elif db.get_group_by_username(base_dn.username) is not None:
+						outcome = "specific group not in service denied"
+						result = False
+						entities = []
+					else:
+						outcome = "specific group does not exist denied"
+						result = False
+						entities = []
 				
-			else:
-				strand += "user does not exist denied"
-				result = False
-				entities = []
+				else:
+					outcome = "invalid search base denied"
+					result = False
+					entities = []
+		else:
+			outcome = "invalid search base denied"
+			result = False
+			entities = []
+		
+	
+	if base_dn.kind == DN_ROOT:
+		entities.append(make_null_entity())
+		outcome = "null base allowed"
+		result = True
+	elif bound_dn.kind == DN_SERVICE:
+		service = db.get_service_by_username(bound_dn.service)
+		
+		if service is not None:
+			do_search()
 			
 		else:
-			strand += "not bound denied"
+			outcome = "service does not exist denied"
 			result = False
 			entities = []
 		
-		strand = strand + ") -> "
+	elif bound_dn.kind == DN_USER:
+		user = db.get_user_by_username(bound_dn.username)
+		
+		if user is not None:
+			do_search()
+			
+		else:
+			outcome = "user does not exist denied"
+			result = False
+			entities = []
+		
+	else:
+		outcome = "not bound denied"
+		result = False
+		entities = []
+	
+	if cache_key is not None:
+		metrics.increment("daniel_authenticator_search_cache_total", {"outcome": "miss" if cached is None else "hit"})
+	if cached is not None:
+		body = cached.body
+		entity_count = cached.entity_count
+	else:
+		entity_count = len(entities)
+		#only allowed searches are kept, since whether a denied one is denied can depend on other services
+		if cache_key is not None:
+			body = encode_search_response(result, entities, next_cookie, attribute_names)
+			if result:
+				search_cache.put(cache_key, cache_revision, CachedSearch(body, outcome, entity_count, next_cookie))
+	
+	searched_service = ""
+	if result:
+		#the null base is readable without binding and belongs to no service
+		searched_service = base_dn.service or ""
+		metrics.increment("daniel_authenticator_searches_total", {"outcome": "allowed", "service": searched_service})
+		metrics.observe("daniel_authenticator_search_entities", entity_count, {"service": searched_service})
+	else:
+		metrics.increment("daniel_authenticator_searches_total", {"outcome": "denied", "service": ""})
+	
+	log_event("ldap_search", "allowed" if result else "denied", boundDN, searched_service or None, time.monotonic() - start_time,
+		logging.DEBUG if result else logging.INFO, connection=connection_number, base=BaseDN, entities=entity_count, reason=outcome)
+	session_traces.record(connection_number, "search(" + BaseDN + " " + outcome + ")")
+	return result, entities, next_cookie, attribute_names, body
+
+#the form fields the ldap frontend posts, read from a werkzeug MultiDict
+def handle_bind_form(db, form):
+	bindDN = form.get('bindDN', type=str)
+	bindSimplePw = form.get('bindSimplePw', type=str)
+	boundDN = form.get('boundDN', type=str)
+	connection_number = form.get('connectionNumber', type=int)
+	return handle_bind(db, bindDN, bindSimplePw, boundDN, connection_number)
+
+def handle_search_form(db, form, serialize=False):
+	boundDN = form.get('boundDN', type=str)
+	BaseDN = form.get('BaseDN', type=str)
+	search_filter = form.get('Filter', default="", type=str)
+	scope = form.get('Scope', default=SCOPE_WHOLE_SUBTREE, type=int)
+	attributes = form.getlist('Attributes', type=str)
+	page_size = form.get('PageSize', default=0, type=int)
+	cookie = form.get('Cookie', default="", type=str)
+	connection_number = form.get('connectionNumber', type=int)
+	return handle_search(db, boundDN, BaseDN, search_filter, scope, attributes, page_size, cookie, connection_number, serialize)
+
+def handle_close_form(form):
+	session_traces.close(form.get('connectionNumber', type=int))
+
+def create_ldap_app():
+	app = Flask(__name__)
+	instrument_app(app, "ldap")
+	sql_tracer.trace_requests(app)
+	capture.capture_requests(app)
+	
+	@app.route('/bind', methods = ['POST'])
+	def bind_route():
+		result = handle_bind_form(Database(), request.form)
 		
 		return json.dumps({
-				"Result": result,
-				"Entities": entities,
-				"Strand": strand
+				"Result": result
 			})
 	
+	@app.route('/search', methods = ['POST'])
+	def search_route():
+		result, entities, next_cookie, attribute_names, body = handle_search_form(Database(), request.form, True)
+		
+		if body is None:
+			body = encode_search_response(result, entities, next_cookie, attribute_names)
+		return Response(body, mimetype="application/json")
+	
+	@app.route('/close', methods = ['POST'])
+	def close_route():
+		handle_close_form(request.form)
+		
+		return json.dumps({
+				"Result": True
+			})
+	
+	@app.teardown_appcontext
+	def teardown_database(e):
+		release_connection()
+	
 	@app.errorhandler(404)
 	def page_not_found(e):
 		return "404", 404
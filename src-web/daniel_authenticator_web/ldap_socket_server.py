@@ -0,0 +1,206 @@
+import os, sys, stat, time, struct, logging, socketserver
+from daniel_authenticator_web.database import Database, release_connection
+from daniel_authenticator_web.metrics import metrics
+from daniel_authenticator_web.event_log import log_event
+from daniel_authenticator_web.session_trace import session_traces
+from daniel_authenticator_web.ldap_entities import select_attributes
+from daniel_authenticator_web.ldap_proxy_connector import handle_bind, handle_search
+
+#the ldap proxy over a unix domain socket instead of http, making the same decisions as /bind and /search
+#a client keeps its connections open and sends one request at a time on each, so an operation costs a round trip
+#and the encoding of its fields, with no http, form, or json parsing; requests carry the ldap session's connection
+#number like the http ones, so any open connection can serve any ldap session
+#
+#every request and response is a frame: a 4 byte big endian length, then that many bytes of payload
+#in a payload, an int is 4 bytes big endian and signed, a str is an int length then that many bytes of utf-8, a bool
+#is 1 byte, and a list is an int count then that many items
+#
+#request payloads start with 1 byte naming the operation:
+#  1 bind:   int connectionNumber, str bindDN, str bindSimplePw, str boundDN
+#  2 search: int connectionNumber, str boundDN, str BaseDN, str Filter, int Scope, list of str Attributes, int PageSize,
+#            str Cookie
+#  3 close:  int connectionNumber
+#response payloads start with 1 byte, 0 when the request was handled and 1 when it could not be, in which case a str
+#describing why follows; otherwise what follows depends on the operation:
+#  bind:   bool Result
+#  search: bool Result, str Cookie, list of entities, each a str DN then a list of attributes, each a
+#          str name then a list of str values
+#  close:  nothing
+
+OPERATION_BIND = 1
+OPERATION_SEARCH = 2
+OPERATION_CLOSE = 3
+OPERATION_NAMES = {OPERATION_BIND: "bind", OPERATION_SEARCH: "search", OPERATION_CLOSE: "close"}
+
+#larger requests are refused, no real bind or search comes anywhere near this
+MAX_REQUEST_SIZE = 1024 * 1024
+
+class FrameReader:
+	def __init__(self, payload):
+		self.payload = payload
+		self.offset = 0
+
+	def read(self, size):
+		if self.offset + size > len(self.payload):
+			raise ValueError("request ends early")
+		data = self.payload[self.offset:self.offset + size]
+		self.offset += size
+		return data
+
+	def read_byte(self):
+		return self.read(1)[0]
+
+	def read_int(self):
+		return struct.unpack(">i", self.read(4))[0]
+
+	def read_str(self):
+		length = self.read_int()
+		if length < 0:
+			raise ValueError("negative string length")
+		return self.read(length).decode("utf-8")
+
+	def read_str_list(self):
+		count = self.read_int()
+		if count < 0:
+			raise ValueError("negative list length")
+		return [self.read_str() for index in range(count)]
+
+class FrameWriter:
+	def __init__(self):
+		self.parts = []
+
+	def write_byte(self, value):
+		self.parts.append(bytes([value]))
+
+	def write_int(self, value):
+		self.parts.append(struct.pack(">i", value))
+
+	def write_str(self, value):
+		encoded = value.encode("utf-8")
+		self.write_int(len(encoded))
+		self.parts.append(encoded)
+
+	def write_str_list(self, values):
+		self.write_int(len(values))
+		for value in values:
+			self.write_str(value)
+
+	def frame(self):
+		payload = b"".join(self.parts)
+		return struct.pack(">I", len(payload)) + payload
+
+def write_entity(writer, entity):
+	writer.write_str(entity["DN"])
+	writer.write_int(len(entity["Attributes"]))
+	for name, values in entity["Attributes"].items():
+		writer.write_str(name)
+		writer.write_str_list(values)
+
+def handle_request(db, reader):
+	operation = reader.read_byte()
+	connection_number = reader.read_int()
+	writer = FrameWriter()
+
+	if operation == OPERATION_BIND:
+		bindDN = reader.read_str()
+		bindSimplePw = reader.read_str()
+		boundDN = reader.read_str()
+		result = handle_bind(db, bindDN, bindSimplePw, boundDN, connection_number)
+		writer.write_byte(0)
+		writer.write_byte(1 if result else 0)
+
+	elif operation == OPERATION_SEARCH:
+		boundDN = reader.read_str()
+		BaseDN = reader.read_str()
+		search_filter = reader.read_str()
+		scope = reader.read_int()
+		attributes = reader.read_str_list()
+		page_size = reader.read_int()
+		cookie = reader.read_str()
+		#entities are written in this protocol's own encoding, so the json body is never asked for
+		result, entities, next_cookie, attribute_names, body = handle_search(db, boundDN, BaseDN, search_filter, scope, attributes, page_size, cookie, connection_number)
+		writer.write_byte(0)
+		writer.write_byte(1 if result else 0)
+		writer.write_str(next_cookie)
+		writer.write_int(len(entities))
+		for entity in entities:
+			write_entity(writer, select_attributes(entity, attribute_names))
+
+	elif operation == OPERATION_CLOSE:
+		session_traces.close(connection_number)
+		writer.write_byte(0)
+
+	else:
+		raise ValueError("unknown operation %i" % operation)
+
+	return OPERATION_NAMES[operation], writer.frame()
+
+def error_frame(message):
+	writer = FrameWriter()
+	writer.write_byte(1)
+	writer.write_str(message)
+	return writer.frame()
+
+def read_exactly(file, size):
+	data = file.read(size)
+	if len(data) != size:
+		return None
+	return data
+
+class LdapConnectionHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		db = Database()
+		while True:
+			header = read_exactly(self.rfile, 4)
+			if header is None:
+				return
+			size = struct.unpack(">I", header)[0]
+			if size > MAX_REQUEST_SIZE:
+				self.wfile.write(error_frame("request of %i bytes is too large" % size))
+				return
+			payload = read_exactly(self.rfile, size)
+			if payload is None:
+				return
+
+			start_time = time.monotonic()
+			metrics.take_statement_count()
+			try:
+				operation, response = handle_request(db, FrameReader(payload))
+			except Exception as e:
+				#the whole frame has been read, so the connection can go on with the next request
+				log_event("ldap_socket_request", "failed", level=logging.ERROR, error="%s: %s" % (type(e).__name__, e))
+				operation, response = "invalid", error_frame("%s: %s" % (type(e).__name__, e))
+			finally:
+				release_connection()
+			self.wfile.write(response)
+			self.wfile.flush()
+			labels = {"app": "ldap_socket", "route": operation}
+			metrics.observe("daniel_authenticator_request_seconds", time.monotonic() - start_time, labels)
+			metrics.observe("daniel_authenticator_request_sql_statements", metrics.take_statement_count(), labels)
+
+#every connection gets its own thread, and so its own database connection, for as long as it stays open
+class LdapSocketServer(socketserver.ThreadingUnixStreamServer):
+	daemon_threads = True
+
+def serve(socket_path):
+	if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+		os.remove(socket_path)
+	#only the user running the proxy, and so the ldap frontend running alongside it, can connect
+	previous_umask = os.umask(0o177)
+	try:
+		server = LdapSocketServer(socket_path, LdapConnectionHandler)
+	finally:
+		os.umask(previous_umask)
+	print("LDAP proxy listening on %s" % socket_path)
+	sys.stdout.flush()
+	with server:
+		server.serve_forever()
+
+def main():
+	if len(sys.argv) != 2:
+		print("Usage: daniel-authenticator-ldap-socket SOCKET_PATH")
+		sys.exit(1)
+	serve(sys.argv[1])
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,265 @@
+import os, sys, time, base64, struct, secrets, sqlite3
+import concurrent.futures
+import daniel_authenticator_web.password as pswd
+from daniel_authenticator_web.ldap_dn import parse_rdns
+
+#imports users, groups, and user-group memberships from an LDIF export, e.g. from FreeIPA
+#records are read one at a time and written in batches, each batch being one transaction followed by a checkpoint,
+#so an interrupted import can be resumed; users and groups that already exist are left alone, so re-importing is safe
+
+IMPORT_BATCH_SIZE = 1000
+
+USER_OBJECT_CLASSES = ["person", "organizationalperson", "inetorgperson", "posixaccount", "inetuser"]
+GROUP_OBJECT_CLASSES = ["groupofnames", "groupofuniquenames", "posixgroup", "ipausergroup"]
+
+def read_ldif_lines(file):
+	line = None
+	for raw_line in file:
+		raw_line = raw_line.rstrip("\r\n")
+		if raw_line.startswith(" ") and line is not None:
+			#folded continuation of the previous line
+			line += raw_line[1:]
+			continue
+		if line is not None:
+			yield line
+		line = None if raw_line.startswith("#") else raw_line
+	if line is not None:
+		yield line
+
+#yields each record as a dict of lowercased attribute name (options dropped) -> list of values, with the dn under "dn"
+def read_ldif_records(file):
+	record = {}
+	for line in read_ldif_lines(file):
+		if line == "":
+			if len(record) > 0:
+				yield record
+			record = {}
+			continue
+		if ":" not in line:
+			raise ValueError("invalid LDIF line %s" % line)
+		attribute, value = line.split(":", 1)
+		attribute = attribute.split(";", 1)[0].lower()
+		if value.startswith(":"):
+			value = base64.b64decode(value[1:].strip()).decode("utf-8")
+		elif value.startswith("<"):
+			#values loaded from urls are not supported
+			continue
+		else:
+			value = value.lstrip(" ")
+		if attribute == "version" and len(record) == 0:
+			continue
+		record.setdefault(attribute, []).append(value)
+	if len(record) > 0:
+		yield record
+
+#the value of the first rdn of a dn, e.g. john for uid=john,cn=users,cn=accounts,dc=example,dc=com
+def dn_first_value(dn):
+	rdns = parse_rdns(dn)
+	if rdns is None or len(rdns) == 0:
+		return None
+	return rdns[0][1]
+
+#a dn in a form that compares equal for every way of writing the same entry, with attribute types and values
+#compared regardless of case, as they are for the uid and cn of FreeIPA entries; None if it is malformed
+def normalize_dn(dn):
+	rdns = parse_rdns(dn)
+	if rdns is None:
+		return None
+	return tuple((attribute_type, value.lower()) for attribute_type, value in rdns)
+
+def first_value(record, attribute, default=None):
+	values = record.get(attribute, [])
+	if len(values) == 0:
+		return default
+	return values[0]
+
+#run in the worker pool; turns a userPassword value into a password hash that check_password accepts, returned
+#with why the value could not be used, or None if it could
+def hash_imported_password(value):
+	if value is not None and value.startswith("{PBKDF2_SHA256}"):
+		#a malformed value must not take the whole batch down with it
+		try:
+			return pswd.decode_freeipa(base64.b64encode(value.encode("utf-8")).decode("ascii")), None
+		except (AssertionError, ValueError, struct.error) as e:
+			error = "malformed {PBKDF2_SHA256} value (%s)" % (str(e) or type(e).__name__)
+	elif value is not None and not value.startswith("{"):
+		return pswd.make_password_hash(value), None
+	elif value is not None and "}" in value:
+		error = "password in the unsupported scheme %s" % value[:value.index("}") + 1]
+	elif value is not None:
+		#no scheme to name, and the value itself may well be a password
+		error = "password in no scheme that can be told"
+	else:
+		error = None
+	#no password, or one we cannot verify; the account needs a password reset before it can log in
+	return pswd.make_password_hash(secrets.token_hex(32)), error
+
+def read_checkpoint(checkpoint_file):
+	if checkpoint_file is None or not os.path.exists(checkpoint_file):
+		return 0
+	with open(checkpoint_file) as file:
+		return int(file.read().strip() or "0")
+
+def write_checkpoint(checkpoint_file, records_done):
+	if checkpoint_file is None:
+		return
+	with open(checkpoint_file + ".tmp", "w") as file:
+		file.write("%i\n" % records_done)
+	os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+def format_reference(reference):
+	kind, value = reference
+	if kind == "username" or value is None:
+		return str(value)
+	return ",".join("%s=%s" % rdn for rdn in value)
+
+class LdifImport:
+	def __init__(self, db, executor):
+		self.db = db
+		self.executor = executor
+		#(user, group) pairs, applied once every user and group exists; each side is ("dn", normalized dn) or,
+		#for memberUid, ("username", username)
+		self.memberships = set()
+		#normalized dn -> username of every user and group record, and username -> the dns of the records with it,
+		#since only one of several records with the same username can be imported
+		self.user_usernames = {}
+		self.user_dns = {}
+		self.group_usernames = {}
+		self.group_dns = {}
+		self.users_created = 0
+		self.groups_created = 0
+		self.records_skipped = 0
+		self.memberships_skipped = 0
+		#users created with a password that was there but could not be used
+		self.unusable_passwords = 0
+
+	def collect_memberships(self, record):
+		object_classes = [object_class.lower() for object_class in record.get("objectclass", [])]
+		dn = normalize_dn(first_value(record, "dn", ""))
+		if any(object_class in USER_OBJECT_CLASSES for object_class in object_classes) and "uid" in record:
+			if dn is not None:
+				self.user_usernames[dn] = first_value(record, "uid")
+				self.user_dns.setdefault(first_value(record, "uid"), set()).add(dn)
+				for group_dn in record.get("memberof", []):
+					self.memberships.add((("dn", dn), ("dn", normalize_dn(group_dn))))
+		elif any(object_class in GROUP_OBJECT_CLASSES for object_class in object_classes) and dn is not None:
+			self.group_usernames[dn] = dn_first_value(first_value(record, "dn"))
+			self.group_dns.setdefault(self.group_usernames[dn], set()).add(dn)
+			for user_dn in record.get("member", []) + record.get("uniquemember", []):
+				self.memberships.add((("dn", normalize_dn(user_dn)), ("dn", dn)))
+			for user_username in record.get("memberuid", []):
+				self.memberships.add((("username", user_username), ("dn", dn)))
+
+	def import_batch(self, records):
+		users = []
+		groups = []
+		for record in records:
+			object_classes = [object_class.lower() for object_class in record.get("objectclass", [])]
+			if any(object_class in USER_OBJECT_CLASSES for object_class in object_classes) and "uid" in record:
+				if self.db.get_user_by_username(first_value(record, "uid")) is None:
+					users.append(record)
+			elif any(object_class in GROUP_OBJECT_CLASSES for object_class in object_classes) and dn_first_value(first_value(record, "dn", "")) is not None:
+				if self.db.get_group_by_username(dn_first_value(first_value(record, "dn"))) is None:
+					groups.append(record)
+			else:
+				self.records_skipped += 1
+
+		password_hashes = self.executor.map(hash_imported_password, [first_value(record, "userpassword") for record in users], chunksize=16)
+
+		with self.db.transaction():
+			for record, (password_hash, password_error) in zip(users, password_hashes):
+				username = first_value(record, "uid")
+				if password_error is not None:
+					print("User %s (%s) has a %s, importing it without a usable password" % (username, first_value(record, "dn"), password_error))
+				email = first_value(record, "mail")
+				if email is None:
+					email = "%s@invalid" % username
+					print("User %s has no mail attribute, using %s" % (username, email))
+				fullname = first_value(record, "displayname", first_value(record, "cn", username))
+				try:
+					user_id = self.db.create_user_using_password_hash(username, fullname, email, password_hash, True, False)
+				except sqlite3.IntegrityError:
+					print("Skipping user %s, its username or email is already taken" % username)
+					self.records_skipped += 1
+					continue
+				if password_error is not None:
+					self.unusable_passwords += 1
+				if "ipauniqueid" in record:
+					self.db.set_user_uuid(user_id, first_value(record, "ipauniqueid"))
+				self.users_created += 1
+
+			for record in groups:
+				username = dn_first_value(first_value(record, "dn"))
+				if self.db.get_group_by_username(username) is not None:
+					print("Skipping group %s, its username is already taken" % username)
+					self.records_skipped += 1
+					continue
+				group_id = self.db.create_group(username, first_value(record, "description", first_value(record, "cn", username)))
+				if "ipauniqueid" in record:
+					self.db.set_group_uuid(group_id, first_value(record, "ipauniqueid"))
+				self.groups_created += 1
+
+	#the username a side of a membership refers to, or None with the reason it cannot be told
+	def resolve_member(self, reference, usernames, dns):
+		kind, value = reference
+		if kind == "username":
+			return value, None
+		if value not in usernames:
+			return None, "is not an imported entry of that kind"
+		if len(dns[usernames[value]]) > 1:
+			return None, "shares its username with another imported entry"
+		return usernames[value], None
+
+	def import_memberships(self):
+		users = {user["username"]: user["user_id"] for user in self.db.get_all_users_info()}
+		groups = {group["username"]: group["group_id"] for group in self.db.get_all_groups_info()}
+		added = 0
+		with self.db.transaction():
+			for user_reference, group_reference in sorted(self.memberships, key=str):
+				user_username, user_error = self.resolve_member(user_reference, self.user_usernames, self.user_dns)
+				group_username, group_error = self.resolve_member(group_reference, self.group_usernames, self.group_dns)
+				if user_error is not None or group_error is not None:
+					print("Skipping membership of %s in %s, the %s %s" % (format_reference(user_reference), format_reference(group_reference),
+						"member" if user_error is not None else "group", user_error or group_error))
+					self.memberships_skipped += 1
+				elif user_username in users and group_username in groups:
+					self.db.add_user_to_group(users[user_username], groups[group_username])
+					added += 1
+		return added
+
+def import_ldif(db, ldif_file, checkpoint_file=None):
+	records_done = read_checkpoint(checkpoint_file)
+	if records_done > 0:
+		print("Resuming after %i records" % records_done)
+
+	start_time = time.monotonic()
+	imported_records = 0
+	with concurrent.futures.ProcessPoolExecutor() as executor, open(ldif_file, encoding="utf-8") as file:
+		importer = LdifImport(db, executor)
+		batch = []
+		for index, record in enumerate(read_ldif_records(file)):
+			#records before the checkpoint are still read, since their memberships are only applied at the end
+			importer.collect_memberships(record)
+			if index < records_done:
+				continue
+			batch.append(record)
+			if len(batch) == IMPORT_BATCH_SIZE:
+				importer.import_batch(batch)
+				imported_records += len(batch)
+				records_done += len(batch)
+				batch = []
+				write_checkpoint(checkpoint_file, records_done)
+				elapsed = time.monotonic() - start_time
+				print("Imported %i records (%.0f records/s)" % (records_done, imported_records / elapsed))
+				sys.stdout.flush()
+		if len(batch) > 0:
+			importer.import_batch(batch)
+			imported_records += len(batch)
+			records_done += len(batch)
+			write_checkpoint(checkpoint_file, records_done)
+
+	memberships_applied = importer.import_memberships()
+	elapsed = time.monotonic() - start_time
+	print("Import finished: %i users (%i without a usable password) and %i groups created, %i group memberships applied, %i skipped, %i records skipped, %i records in %.1fs (%.0f records/s)" %
+		(importer.users_created, importer.unusable_passwords, importer.groups_created, memberships_applied, importer.memberships_skipped, importer.records_skipped,
+		imported_records, elapsed, imported_records / elapsed if elapsed > 0 else 0))
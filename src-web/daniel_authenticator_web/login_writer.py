@@ -0,0 +1,61 @@
+import os, threading, time, atexit, logging
+from datetime import datetime, timezone
+from daniel_authenticator_web.event_log import log_event
+
+#collects the last_login_time of successful logins and writes them from a background thread in one transaction
+#every interval, so that a burst of binds does not take sqlite's write lock once per bind just to record a timestamp
+#only timestamps are ever delayed; attempt counters and lockouts are always written straight away
+class LoginWriter:
+	def __init__(self, interval):
+		self.interval = interval
+		self.write = None
+		self.pending = {}
+		self.lock = threading.Lock()
+		self.pid = None
+
+	def enabled(self):
+		return self.interval > 0 and self.write is not None
+
+	#write is called from the background thread with a dict of user_id -> last login time
+	def set_write_function(self, write):
+		self.write = write
+
+	def record_successful_login(self, user_id):
+		#same format as sqlite's datetime()
+		login_time = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+		with self.lock:
+			self.start()
+			self.pending[user_id] = login_time
+
+	#called with the lock held; the thread is (re)started lazily so that forked workers each get their own
+	def start(self):
+		if self.pid != os.getpid():
+			self.pid = os.getpid()
+			self.pending = {}
+			thread = threading.Thread(target=self.run, daemon=True)
+			thread.start()
+			atexit.register(self.flush)
+
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			self.flush()
+
+	def flush(self):
+		with self.lock:
+			pending = self.pending
+			self.pending = {}
+		if len(pending) == 0:
+			return
+		try:
+			self.write(pending)
+		except Exception as e:
+			log_event("last_login_write", "failed", level=logging.ERROR, message="Could not write last login times, retrying", count=len(pending), error=str(e))
+			with self.lock:
+				#a login recorded while this write was failing is newer, so it wins
+				pending.update(self.pending)
+				self.pending = pending
+
+#writes every login immediately when the interval is 0
+login_writer = LoginWriter(
+	float(os.getenv('DANIEL_AUTHENTICATOR_LOGIN_WRITE_INTERVAL', "250")) / 1000)
@@ -0,0 +1,204 @@
+import os, json, time, threading, atexit
+from flask import g, request
+
+#counters and histograms in prometheus' text format, shared by every gunicorn worker of both apps
+#each process keeps its own values in memory and a background thread regularly writes them to its own file in a shared
+#directory, and /metrics adds up the files of every process that is still running; a process removes its file when it
+#exits and the files of ones that were killed are removed by the next /metrics, so the totals drop by what an exited
+#worker counted, which prometheus takes as a counter reset
+#metrics are off unless a directory is given, since counting sql statements needs a callback on every statement
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+METRICS = {
+	"daniel_authenticator_request_seconds": ("histogram", LATENCY_BUCKETS, "Time spent handling a request, by app and route"),
+	"daniel_authenticator_request_sql_statements": ("histogram", COUNT_BUCKETS, "SQL statements run while handling a request, by app and route"),
+	"daniel_authenticator_binds_total": ("counter", None, "LDAP binds, by kind of account, outcome, and service"),
+	"daniel_authenticator_searches_total": ("counter", None, "LDAP searches, by outcome and service"),
+	"daniel_authenticator_search_entities": ("histogram", COUNT_BUCKETS, "Entities returned per LDAP search, by service"),
+	"daniel_authenticator_search_cache_total": ("counter", None, "LDAP search responses looked up in the search cache, by outcome"),
+	"daniel_authenticator_password_verify_seconds": ("histogram", LATENCY_BUCKETS, "Time spent verifying a password hash"),
+}
+
+#seconds between writes of a process' metrics file
+METRICS_WRITE_INTERVAL = 1
+
+class Metrics:
+	def __init__(self, directory):
+		self.directory = directory
+		self.lock = threading.Lock()
+		self.values = {}
+		self.pid = None
+		#held while the file is written or removed, so increments never wait on the disk
+		self.file_lock = threading.Lock()
+		self.exited = False
+		self.statements = threading.local()
+
+	def enabled(self):
+		return self.directory != ""
+
+	#called with the lock held; a forked child starts from nothing instead of repeating its parent's counts, and gets
+	#its own writer thread, which is started lazily like the login writer's
+	def check_process(self):
+		if self.pid != os.getpid():
+			self.pid = os.getpid()
+			self.values = {}
+			self.file_lock = threading.Lock()
+			self.exited = False
+			thread = threading.Thread(target=self.run, daemon=True)
+			thread.start()
+			atexit.register(self.remove)
+
+	def run(self):
+		while True:
+			time.sleep(METRICS_WRITE_INTERVAL)
+			self.write()
+
+	def increment(self, name, labels={}, value=1):
+		if not self.enabled():
+			return
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.check_process()
+			self.values[key] = self.values.get(key, 0) + value
+
+	def observe(self, name, value, labels={}):
+		if not self.enabled():
+			return
+		buckets = METRICS[name][1]
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.check_process()
+			histogram = self.values.get(key)
+			if histogram is None:
+				histogram = {"buckets": [0] * len(buckets), "sum": 0, "count": 0}
+				self.values[key] = histogram
+			for index, bound in enumerate(buckets):
+				if value <= bound:
+					histogram["buckets"][index] += 1
+			histogram["sum"] += value
+			histogram["count"] += 1
+
+	def write(self):
+		with self.lock:
+			if self.pid != os.getpid():
+				return
+			entries = [[name, labels, value] for (name, labels), value in self.values.items()]
+		with self.file_lock:
+			if self.exited:
+				return
+			os.makedirs(self.directory, exist_ok=True)
+			path = os.path.join(self.directory, "metrics-%i.json" % os.getpid())
+			with open(path + ".tmp", "w") as file:
+				json.dump(entries, file)
+			os.replace(path + ".tmp", path)
+
+	#the writer thread may still be running while the process exits, so it is stopped from writing the file again
+	def remove(self):
+		with self.file_lock:
+			if self.pid != os.getpid():
+				return
+			self.exited = True
+			try:
+				os.remove(os.path.join(self.directory, "metrics-%i.json" % os.getpid()))
+			except FileNotFoundError:
+				pass
+
+	#sql statements are counted per thread by the connection's trace callback and read back at the end of each request
+	def count_statement(self, statement):
+		self.statements.count = getattr(self.statements, "count", 0) + 1
+
+	def take_statement_count(self):
+		count = getattr(self.statements, "count", 0)
+		self.statements.count = 0
+		return count
+
+	def render(self):
+		self.write()
+		totals = {}
+		for file_name in sorted(os.listdir(self.directory)):
+			if not file_name.startswith("metrics-") or not file_name.endswith(".json"):
+				continue
+			pid = file_name[len("metrics-"):-len(".json")]
+			if pid.isdigit() and not process_running(int(pid)):
+				#a worker that was killed before it could remove its own file
+				try:
+					os.remove(os.path.join(self.directory, file_name))
+				except FileNotFoundError:
+					pass
+				continue
+			try:
+				with open(os.path.join(self.directory, file_name)) as file:
+					entries = json.load(file)
+			except (OSError, ValueError):
+				continue
+			for name, labels, value in entries:
+				if name not in METRICS:
+					continue
+				key = (name, tuple(tuple(label) for label in labels))
+				if isinstance(value, dict):
+					total = totals.setdefault(key, {"buckets": [0] * len(value["buckets"]), "sum": 0, "count": 0})
+					total["buckets"] = [a + b for a, b in zip(total["buckets"], value["buckets"])]
+					total["sum"] += value["sum"]
+					total["count"] += value["count"]
+				else:
+					totals[key] = totals.get(key, 0) + value
+
+		lines = []
+		for name, (kind, buckets, help_text) in METRICS.items():
+			lines.append("# HELP %s %s" % (name, help_text))
+			lines.append("# TYPE %s %s" % (name, kind))
+			for (total_name, labels), value in sorted(totals.items()):
+				if total_name != name:
+					continue
+				if kind == "counter":
+					lines.append("%s%s %s" % (name, format_labels(labels), value))
+				else:
+					for bound, bucket_count in zip(buckets, value["buckets"]):
+						lines.append("%s_bucket%s %i" % (name, format_labels(labels + (("le", str(bound)),)), bucket_count))
+					lines.append("%s_bucket%s %i" % (name, format_labels(labels + (("le", "+Inf"),)), value["count"]))
+					lines.append("%s_sum%s %s" % (name, format_labels(labels), value["sum"]))
+					lines.append("%s_count%s %i" % (name, format_labels(labels), value["count"]))
+		return "\n".join(lines) + "\n"
+
+def process_running(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		#running, as another user
+		return True
+	return True
+
+def format_labels(labels):
+	if len(labels) == 0:
+		return ""
+	return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels)
+
+#times every request of the app by route, and adds the /metrics endpoint, which only answers direct local requests
+def instrument_app(app, app_name):
+	@app.before_request
+	def start_request_metrics():
+		g.metrics_start_time = time.monotonic()
+		metrics.take_statement_count()
+
+	@app.after_request
+	def finish_request_metrics(response):
+		start_time = g.pop("metrics_start_time", None)
+		if start_time is not None:
+			labels = {"app": app_name, "route": request.url_rule.rule if request.url_rule is not None else "unmatched"}
+			metrics.observe("daniel_authenticator_request_seconds", time.monotonic() - start_time, labels)
+			metrics.observe("daniel_authenticator_request_sql_statements", metrics.take_statement_count(), labels)
+		return response
+
+	@app.route('/metrics', methods = ['GET'])
+	def metrics_route():
+		#a request passed on by a reverse proxy also comes from localhost, but always carries a forwarding header
+		if not metrics.enabled() or request.remote_addr not in ["127.0.0.1", "::1"] or "X-Forwarded-For" in request.headers or "Forwarded" in request.headers:
+			return "404", 404
+		return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+#disabled when empty, which is the default
+metrics = Metrics(os.getenv('DANIEL_AUTHENTICATOR_METRICS_DIRECTORY', ""))
@@ -1,5 +1,10 @@
+import os
+import time
+import hmac
 import base64
 import struct
+import hashlib
+import secrets
 
 from passlib.hash import pbkdf2_sha256
 from passlib.utils.binary import ab64_encode
@@ -16,10 +21,80 @@ def decode_freeipa(raw):
 	
 	return "$pbkdf2-sha256$%i$%s$%s" % (iterations, ab64_encode(salt).decode("utf-8"), ab64_encode(hash).decode("utf-8"))
 
+USER_PASSWORD = "user"
+SERVICE_PASSWORD = "service"
+
+def configured_rounds(name):
+	value = os.getenv(name, "")
+	return int(value) if value != "" else None
+
+#PBKDF2 rounds that new password hashes are made with, separately for users and for services, which bind for every
+#search they make, or None when not configured, in which case passlib's default is used and stored hashes are left
+#alone; once configured, a stored hash with fewer rounds is rehashed the next time it is used to log in successfully,
+#and one with more, like one imported from FreeIPA, only when lowering rounds is asked for as well
+HASH_ROUNDS = {
+	USER_PASSWORD: configured_rounds('DANIEL_AUTHENTICATOR_USER_HASH_ROUNDS'),
+	SERVICE_PASSWORD: configured_rounds('DANIEL_AUTHENTICATOR_SERVICE_HASH_ROUNDS'),
+}
+LOWER_HASH_ROUNDS = os.getenv('DANIEL_AUTHENTICATOR_LOWER_HASH_ROUNDS', "") not in ["", "0"]
+HASHERS = {kind: pbkdf2_sha256 if rounds is None else pbkdf2_sha256.using(rounds=rounds) for kind, rounds in HASH_ROUNDS.items()}
+
 def check_password(password, hash):
 	return pbkdf2_sha256.verify(password, hash)
 
-def make_password_hash(password):
-	return pbkdf2_sha256.hash(password)
+def make_password_hash(password, kind=USER_PASSWORD):
+	return HASHERS[kind].hash(password)
+
+#services can also bind with a token made here instead of their password; a token is 256 random bits, so unlike a
+#password it needs no slow hash to be safe to store, and a keyed sha256 of it is checked in microseconds
+SERVICE_TOKEN_PREFIX = "datoken_"
+#the key of that sha256, or None when it is not set, in which case the database keeps a random one of its own
+SERVICE_TOKEN_KEY = os.getenv('DANIEL_AUTHENTICATOR_SERVICE_TOKEN_KEY', "").encode("utf-8") or None
+
+def make_service_token():
+	return SERVICE_TOKEN_PREFIX + secrets.token_urlsafe(32)
+
+def is_service_token(password):
+	return password.startswith(SERVICE_TOKEN_PREFIX)
+
+def service_token_digest(token, key):
+	return hmac.new(key, token.encode("utf-8"), hashlib.sha256).hexdigest()
+
+#compares against every digest, so how long it takes does not depend on which one matched
+def check_service_token(token, digests, key):
+	digest = service_token_digest(token, key)
+	matched = False
+	for stored_digest in digests:
+		matched = hmac.compare_digest(digest, stored_digest) or matched
+	return matched
+
+#the rounds of a stored hash, or None if it is not a pbkdf2_sha256 hash
+def hash_rounds(hash):
+	parts = hash.split("$")
+	if len(parts) != 5 or parts[1] != "pbkdf2-sha256" or not parts[2].isdigit():
+		return None
+	return int(parts[2])
+
+def needs_rehash(hash, kind=USER_PASSWORD):
+	rounds = HASH_ROUNDS[kind]
+	stored_rounds = hash_rounds(hash)
+	if rounds is None or stored_rounds is None:
+		return False
+	return stored_rounds < rounds or (LOWER_HASH_ROUNDS and stored_rounds > rounds)
+
+#seconds one verify takes on this machine with the given rounds, the median of a few tries
+def time_verify(rounds, tries=5):
+	hash = pbkdf2_sha256.using(rounds=rounds).hash("calibration")
+	timings = []
+	for index in range(tries):
+		start_time = time.perf_counter()
+		pbkdf2_sha256.verify("calibration", hash)
+		timings.append(time.perf_counter() - start_time)
+	return sorted(timings)[len(timings) // 2]
+
+#the rounds, rounded to a thousand, that make one verify on this machine take about target_seconds
+def calibrate_rounds(target_seconds, sample_rounds=100000):
+	seconds_per_round = time_verify(sample_rounds) / sample_rounds
+	return max(1000, round(target_seconds / seconds_per_round / 1000) * 1000)
   
   
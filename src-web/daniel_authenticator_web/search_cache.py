@@ -0,0 +1,72 @@
+import os, threading
+from collections import OrderedDict, namedtuple
+
+#an allowed search's json response exactly as it was sent, with what the search's log and metrics need to know about it
+CachedSearch = namedtuple("CachedSearch", ["body", "outcome", "entity_count", "next_cookie"])
+
+#keeps the responses of recent searches, so a service that repeats a search gets back the bytes it got last time
+#without its entities being looked up, filtered, or encoded again; the entries of a service are all for one revision
+#of it, which the database moves on every write that changes what the service can see, so that write drops those
+#entries and no others; the least recently used entries are evicted once their bytes go over the limit
+class SearchCache:
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		#key -> CachedSearch, least recently used first
+		self.entries = OrderedDict()
+		self.total_bytes = 0
+		#service_id -> the revision its entries are for and the keys of those entries
+		self.revisions = {}
+		self.keys = {}
+		self.lock = threading.Lock()
+
+	def enabled(self):
+		return self.max_bytes > 0
+
+	#keys start with the service_id, which is how the entries of one service are found
+	def get(self, key, revision):
+		with self.lock:
+			self.move_to_revision(key[0], revision)
+			cached = self.entries.get(key)
+			if cached is not None:
+				self.entries.move_to_end(key)
+			return cached
+
+	#a response read at an older revision than the entries already kept for its service is not kept
+	def put(self, key, revision, cached):
+		if len(cached.body) > self.max_bytes:
+			return
+		with self.lock:
+			if revision < self.revisions.get(key[0], revision):
+				return
+			self.move_to_revision(key[0], revision)
+			self.remove(key)
+			self.entries[key] = cached
+			self.keys[key[0]].add(key)
+			self.total_bytes += len(cached.body)
+			while self.total_bytes > self.max_bytes:
+				self.remove(next(iter(self.entries)))
+
+	def move_to_revision(self, service_id, revision):
+		if self.revisions.get(service_id) == revision:
+			return
+		for key in list(self.keys.get(service_id, [])):
+			self.remove(key)
+		self.revisions[service_id] = revision
+		self.keys[service_id] = set()
+
+	def remove(self, key):
+		cached = self.entries.pop(key, None)
+		if cached is not None:
+			self.total_bytes -= len(cached.body)
+			self.keys[key[0]].discard(key)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.total_bytes = 0
+			self.revisions.clear()
+			self.keys.clear()
+
+#shared by every thread of a worker process
+search_cache = SearchCache(
+	int(os.getenv('DANIEL_AUTHENTICATOR_SEARCH_CACHE_SIZE', "16777216")))
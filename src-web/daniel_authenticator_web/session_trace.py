@@ -0,0 +1,115 @@
+import os, time, threading, atexit
+from collections import OrderedDict, deque
+from daniel_authenticator_web.event_log import event_log, log_event
+
+#what each ldap session (one connection to the ldap frontend, named by its connection number) has done, kept here
+#instead of being sent back and forth with every request; each session keeps only its latest operations, so
+#recording one costs the same however long the session has been open
+#a session's trace is logged as an ldap_session event when the frontend closes it, when it has been idle too long,
+#when too many sessions are open and it is the least recently used, and every flush interval for those still open
+#with several workers, each logs the part of a session it saw, and only the one handling the close sees it close
+
+class SessionTrace:
+	def __init__(self, connection_number, length, opened):
+		self.connection_number = connection_number
+		self.operations = deque(maxlen=length)
+		#operations recorded since the trace was last taken, including those that no longer fit
+		self.count = 0
+		#whether the operations since the trace was last taken go back to the session opening
+		self.opened = opened
+		self.last_used = time.monotonic()
+
+	def record(self, operation):
+		self.operations.append(operation)
+		self.count += 1
+		self.last_used = time.monotonic()
+
+	#the fields of the ldap_session event for what was recorded since last time, which is then forgotten
+	def take(self):
+		dropped = self.count - len(self.operations)
+		operations = list(self.operations)
+		if self.opened and dropped == 0:
+			operations.insert(0, "open[%i]" % self.connection_number)
+		fields = {"connection": self.connection_number, "operations": self.count, "dropped": dropped, "trace": " -> ".join(operations)}
+		self.operations.clear()
+		self.count = 0
+		self.opened = False
+		return fields
+
+class SessionTraces:
+	def __init__(self, length, max_sessions, idle_seconds, flush_seconds):
+		self.length = length
+		self.max_sessions = max_sessions
+		self.idle_seconds = idle_seconds
+		self.flush_seconds = flush_seconds
+		#least recently used first
+		self.sessions = OrderedDict()
+		self.last_flush = time.monotonic()
+		self.lock = threading.Lock()
+		self.pid = None
+
+	def enabled(self):
+		return self.length > 0
+
+	#the traces still held at exit are logged before the event log's thread stops, since atexit runs the
+	#functions registered last first
+	def start(self):
+		if self.pid == os.getpid():
+			return
+		event_log.start()
+		atexit.register(self.flush_all, "exited")
+		self.pid = os.getpid()
+
+	#takes the traces that are due to be logged, which is done outside the lock
+	def take_due(self, now):
+		forgotten = []
+		while len(self.sessions) > self.max_sessions:
+			forgotten.append(("evicted", self.sessions.popitem(last=False)[1]))
+		while len(self.sessions) > 0 and now - next(iter(self.sessions.values())).last_used > self.idle_seconds:
+			forgotten.append(("idle", self.sessions.popitem(last=False)[1]))
+		if now - self.last_flush > self.flush_seconds:
+			self.last_flush = now
+			forgotten.extend(("open", session) for session in self.sessions.values())
+		#sessions whose trace was already logged by a flush have nothing new to log
+		return [(outcome, session.take()) for outcome, session in forgotten if session.count > 0]
+
+	def record(self, connection_number, operation):
+		if not self.enabled():
+			return
+		now = time.monotonic()
+		with self.lock:
+			self.start()
+			session = self.sessions.get(connection_number)
+			if session is None:
+				session = SessionTrace(connection_number, self.length, True)
+				self.sessions[connection_number] = session
+			else:
+				self.sessions.move_to_end(connection_number)
+			session.record(operation)
+			due = self.take_due(now)
+		for outcome, fields in due:
+			log_event("ldap_session", outcome, **fields)
+
+	def close(self, connection_number):
+		if not self.enabled():
+			return
+		with self.lock:
+			#another worker may have handled all of the session's operations
+			session = self.sessions.pop(connection_number, None) or SessionTrace(connection_number, self.length, False)
+			session.record("close")
+			fields = session.take()
+		log_event("ldap_session", "closed", **fields)
+
+	def flush_all(self, outcome):
+		with self.lock:
+			due = [(outcome, session.take()) for session in self.sessions.values() if session.count > 0]
+			self.sessions.clear()
+		for outcome, fields in due:
+			log_event("ldap_session", outcome, **fields)
+
+#disabled when the length is 0
+session_traces = SessionTraces(
+	int(os.getenv('DANIEL_AUTHENTICATOR_SESSION_TRACE_LENGTH', "100")),
+	int(os.getenv('DANIEL_AUTHENTICATOR_SESSION_TRACE_SESSIONS', "10000")),
+	float(os.getenv('DANIEL_AUTHENTICATOR_SESSION_TRACE_IDLE_SECONDS', "600")),
+	float(os.getenv('DANIEL_AUTHENTICATOR_SESSION_TRACE_FLUSH_SECONDS', "60")))
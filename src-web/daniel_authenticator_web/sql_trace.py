@@ -0,0 +1,151 @@
+import os, re, time, threading, sqlite3, logging
+from collections import Counter
+from flask import g, request
+from daniel_authenticator_web.metrics import metrics
+from daniel_authenticator_web.event_log import log_event
+
+#opt-in recording of every sql statement a request runs, with its time and row count, kept in g.sql_trace
+#statements slower than the threshold are logged with the route that ran them, and so is any request
+#whose statements add up to more than the threshold, along with the statement it repeated most, which is where
+#one-query-per-entity loops show up
+
+#sqlite_statements counts what sqlite's trace callback reported while the statement ran, which is more than one
+#when it opened a transaction or fired triggers
+class TracedStatement:
+	def __init__(self, sql):
+		self.sql = sql
+		self.rows = 0
+		self.seconds = 0
+		self.sqlite_statements = 0
+
+class RequestTrace:
+	def __init__(self, operation):
+		self.operation = operation
+		self.statements = []
+
+	def statement_count(self):
+		return len(self.statements)
+
+	def total_rows(self):
+		return sum(statement.rows for statement in self.statements)
+
+	def total_seconds(self):
+		return sum(statement.seconds for statement in self.statements)
+
+current = threading.local()
+
+def normalize_sql(sql):
+	return re.sub(r"\s+", " ", sql).strip()
+
+#only statements run during a traced request are recorded, so the cli and background threads pay nothing
+class TracedCursor(sqlite3.Cursor):
+	def execute(self, sql, parameters=()):
+		trace = getattr(current, "trace", None)
+		if trace is None:
+			return super().execute(sql, parameters)
+		statement = TracedStatement(normalize_sql(sql))
+		trace.statements.append(statement)
+		self.traced_statement = statement
+		current.running = statement
+		start_time = time.monotonic()
+		try:
+			return super().execute(sql, parameters)
+		finally:
+			current.running = None
+			statement.seconds += time.monotonic() - start_time
+			if self.rowcount > 0:
+				statement.rows += self.rowcount
+
+	def executemany(self, sql, parameters):
+		trace = getattr(current, "trace", None)
+		if trace is None:
+			return super().executemany(sql, parameters)
+		statement = TracedStatement(normalize_sql(sql))
+		trace.statements.append(statement)
+		self.traced_statement = statement
+		current.running = statement
+		start_time = time.monotonic()
+		try:
+			return super().executemany(sql, parameters)
+		finally:
+			current.running = None
+			statement.seconds += time.monotonic() - start_time
+			if self.rowcount > 0:
+				statement.rows += self.rowcount
+
+	#a select only runs up to its first row in execute, the rest of its time is spent fetching
+	def fetchone(self):
+		return self.timed_fetch(super().fetchone, lambda row: 0 if row is None else 1)
+
+	def fetchall(self):
+		return self.timed_fetch(super().fetchall, len)
+
+	def timed_fetch(self, fetch, count_rows):
+		statement = getattr(self, "traced_statement", None)
+		if statement is None or getattr(current, "trace", None) is None:
+			return fetch()
+		start_time = time.monotonic()
+		rows = fetch()
+		statement.seconds += time.monotonic() - start_time
+		statement.rows += count_rows(rows)
+		return rows
+
+class TracedConnection(sqlite3.Connection):
+	def cursor(self, factory=TracedCursor):
+		return super().cursor(factory)
+
+	def execute(self, sql, parameters=()):
+		return self.cursor().execute(sql, parameters)
+
+	def executemany(self, sql, parameters):
+		return self.cursor().executemany(sql, parameters)
+
+class SqlTracer:
+	def __init__(self, enabled, slow_seconds):
+		self.tracing = enabled
+		self.slow_seconds = slow_seconds
+
+	def enabled(self):
+		return self.tracing
+
+	def connection_factory(self):
+		return TracedConnection if self.enabled() else sqlite3.Connection
+
+	#set on every connection when metrics or tracing are on
+	def trace_callback(self, statement):
+		metrics.count_statement(statement)
+		running = getattr(current, "running", None)
+		if running is not None:
+			running.sqlite_statements += 1
+
+	def log_request(self, trace):
+		for statement in trace.statements:
+			if statement.seconds >= self.slow_seconds:
+				log_event("slow_query", "slow", duration=statement.seconds, level=logging.WARNING, operation=trace.operation,
+					rows=statement.rows, sqlite_statements=statement.sqlite_statements, sql=statement.sql)
+		if trace.total_seconds() >= self.slow_seconds:
+			most_repeated_sql, repeats = Counter(statement.sql for statement in trace.statements).most_common(1)[0]
+			log_event("slow_request_queries", "slow", duration=trace.total_seconds(), level=logging.WARNING, operation=trace.operation,
+				statements=trace.statement_count(), rows=trace.total_rows(), most_repeated_sql=most_repeated_sql, most_repeated_count=repeats)
+
+	#records every statement of each request of the app into g.sql_trace, named after the request's method and route
+	def trace_requests(self, app):
+		if not self.enabled():
+			return
+
+		@app.before_request
+		def start_sql_trace():
+			operation = "%s %s" % (request.method, request.url_rule.rule if request.url_rule is not None else "unmatched")
+			current.trace = RequestTrace(operation)
+			g.sql_trace = current.trace
+
+		@app.teardown_request
+		def finish_sql_trace(e):
+			trace = getattr(current, "trace", None)
+			current.trace = None
+			if trace is not None:
+				self.log_request(trace)
+
+sql_tracer = SqlTracer(
+	os.getenv('DANIEL_AUTHENTICATOR_SQL_TRACE', "") not in ["", "0"],
+	float(os.getenv('DANIEL_AUTHENTICATOR_SLOW_QUERY_THRESHOLD', "100")) / 1000)
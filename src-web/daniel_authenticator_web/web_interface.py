@@ -1,7 +1,15 @@
 import os, json, time, random, re, sys
-from flask import Flask, render_template, request, url_for, flash, redirect, session, send_from_directory
+from flask import Flask, Response, stream_with_context, render_template, request, url_for, flash, redirect, session, send_from_directory
 from flask_wtf.csrf import CSRFProtect
-from daniel_authenticator_web.database import Database, declarative
+from daniel_authenticator_web.database import Database, release_connection, declarative
+from daniel_authenticator_web.metrics import instrument_app
+from daniel_authenticator_web.sql_trace import sql_tracer
+
+#how many of the users, groups, or services that could be added are listed at once on the user, group, and service pages
+ADMIN_PAGE_SIZE = 100
+
+#number of rendered template pieces sent together when a page is streamed, a few table rows worth
+OVERVIEW_STREAM_BUFFER = 256
 
 def username_valid(username):
 	return re.match(r"^[a-zA-Z0-9_\-.@]+$", username) is not None
@@ -27,6 +35,9 @@ def create_interface_app():
 	csrf = CSRFProtect()
 	csrf.init_app(app)
 	
+	instrument_app(app, "web")
+	sql_tracer.trace_requests(app)
+	
 	def is_logged_in(user_info):
 		return user_info is not None
 	
@@ -45,6 +56,12 @@ def create_interface_app():
 		else:
 			return None, db
 	
+	def stream_template(template_name, **context):
+		app.update_template_context(context)
+		stream = app.jinja_env.get_template(template_name).stream(context)
+		stream.enable_buffering(OVERVIEW_STREAM_BUFFER)
+		return stream
+	
 	@app.route('/', methods = ['GET'])
 	def index_route():
 		user_info, db = handle_session()
@@ -64,23 +81,20 @@ def create_interface_app():
 			services=db.get_all_services_info()
 			groups=db.get_all_groups_info()
 			users=db.get_all_users_info()
+			user_service_memberships = set((row['user_id'], row['service_id']) for row in db.get_all_user_service_memberships())
+			user_group_memberships = set((row['user_id'], row['group_id']) for row in db.get_all_user_group_memberships())
+			group_service_memberships = set((row['group_id'], row['service_id']) for row in db.get_all_group_service_memberships())
+			
 			for user in users:
-				service_memberships = db.get_user_service_memberships(user['user_id'])
-				user['service_matrix'] = []
-				for service in services:
-					user['service_matrix'].append(service in service_memberships)
-				
-				group_memberships = db.get_user_group_memberships(user['user_id'])
-				user['group_matrix'] = []
-				for group in groups:
-					user['group_matrix'].append(group in group_memberships)
+				user['service_matrix'] = [(user['user_id'], service['service_id']) in user_service_memberships for service in services]
+				user['group_matrix'] = [(user['user_id'], group['group_id']) in user_group_memberships for group in groups]
 			
 			for group in groups:
-				service_memberships = db.get_group_service_memberships(group['group_id'])
-				group['service_matrix'] = []
-				for service in services:
-					group['service_matrix'].append(service in service_memberships)
-				
+				group['service_matrix'] = [(group['group_id'], service['service_id']) in group_service_memberships for service in services]
+			
+			#?stream=1 sends the page a block of rows at a time instead of rendering all of it first
+			if request.args.get('stream', default=0, type=int):
+				return Response(stream_with_context(stream_template("overview.html", user_info=user_info, users=users, groups=groups, services=services)))
 			return render_template("overview.html", user_info=user_info, users=users, groups=groups, services=services)
 		else:
 			return render_template("404.html", user_info=user_info), 404
@@ -134,10 +148,13 @@ def create_interface_app():
 				return render_template("404.html", user_info=user_info), 404
 			else:
 				group_memberships = db.get_user_group_memberships(target_user_info["user_id"])
-				groups = db.get_all_groups_info()
+				groups_after = request.args.get('groups_after', default="", type=str)
+				groups, groups_next = db.get_groups_page_without_user(target_user_info["user_id"], groups_after, ADMIN_PAGE_SIZE)
 				service_memberships = db.get_user_service_memberships(target_user_info["user_id"])
-				services = db.get_all_services_info()
-				return render_template("user.html", user_info=user_info, target_user_info=target_user_info, group_memberships=group_memberships, service_memberships=service_memberships, groups=groups, services=services)
+				services_after = request.args.get('services_after', default="", type=str)
+				services, services_next = db.get_services_page_without_user(target_user_info["user_id"], services_after, ADMIN_PAGE_SIZE)
+				return render_template("user.html", user_info=user_info, target_user_info=target_user_info, group_memberships=group_memberships, service_memberships=service_memberships, groups=groups, services=services,
+									groups_after=groups_after, groups_next=groups_next, services_after=services_after, services_next=services_next)
 		else:
 			return render_template("404.html", user_info=None), 404
 	
@@ -152,10 +169,13 @@ def create_interface_app():
 				return render_template("404.html", user_info=user_info), 404
 			else:
 				user_memberships = db.get_users_in_group(target_group_info["group_id"])
-				users = db.get_all_users_info()
+				users_after = request.args.get('users_after', default="", type=str)
+				users, users_next = db.get_users_page_not_in_group(target_group_info["group_id"], users_after, ADMIN_PAGE_SIZE)
 				service_memberships = db.get_group_service_memberships(target_group_info["group_id"])
-				services = db.get_all_services_info()
-				return render_template("group.html", user_info=user_info, target_group_info=target_group_info, user_memberships=user_memberships, service_memberships=service_memberships, users=users, services=services)
+				services_after = request.args.get('services_after', default="", type=str)
+				services, services_next = db.get_services_page_without_group(target_group_info["group_id"], services_after, ADMIN_PAGE_SIZE)
+				return render_template("group.html", user_info=user_info, target_group_info=target_group_info, user_memberships=user_memberships, service_memberships=service_memberships, users=users, services=services,
+									users_after=users_after, users_next=users_next, services_after=services_after, services_next=services_next)
 	
 	@app.route('/services/<service_id>', methods = ['GET'])
 	def service_route(service_id):
@@ -167,11 +187,18 @@ def create_interface_app():
 			if target_service_info is None:
 				return render_template("404.html", user_info=None), 404
 			else:
-				group_memberships = db.get_groups_in_service(target_service_info["service_id"])
-				groups = db.get_all_groups_info()
-				user_memberships = db.get_users_in_service(target_service_info["service_id"])
-				users = db.get_all_users_info()
-				return render_template("service.html", user_info=user_info, target_service_info=target_service_info, group_memberships=group_memberships, user_memberships=user_memberships, groups=groups, users=users)
+				return render_service_page(user_info, db, target_service_info)
+	
+	def render_service_page(user_info, db, target_service_info, new_token=None):
+		group_memberships = db.get_groups_in_service(target_service_info["service_id"])
+		groups_after = request.args.get('groups_after', default="", type=str)
+		groups, groups_next = db.get_groups_page_not_in_service(target_service_info["service_id"], groups_after, ADMIN_PAGE_SIZE)
+		user_memberships = db.get_users_in_service(target_service_info["service_id"])
+		users_after = request.args.get('users_after', default="", type=str)
+		users, users_next = db.get_users_page_not_in_service(target_service_info["service_id"], users_after, ADMIN_PAGE_SIZE)
+		service_tokens = db.get_service_tokens(target_service_info["service_id"])
+		return render_template("service.html", user_info=user_info, target_service_info=target_service_info, group_memberships=group_memberships, user_memberships=user_memberships, groups=groups, users=users,
+							groups_after=groups_after, groups_next=groups_next, users_after=users_after, users_next=users_next, service_tokens=service_tokens, new_token=new_token)
 	
 	@app.route('/new_user', methods = ['POST'])
 	def new_user_post_route():
@@ -577,6 +604,53 @@ def create_interface_app():
 			else:
 				return render_template("404.html", user_info=user_info), 404
 	
+	@app.route('/rotate_service_token', methods = ['POST'])
+	def rotate_service_token_post_route():
+		user_info, db = handle_session()
+		if declarative:
+			return render_template("error.html", user_info=user_info, error="Database error, cannot edit database while in declarative database mode")
+		else:
+			if user_info is None:
+				return redirect(url_for("login_route"))
+			elif user_info['superuser']:
+				target_service_info = db.get_service_info(request.form.get("service_id"))
+				if target_service_info is None:
+					return render_template("404.html", user_info=user_info), 404
+				grace_hours = request.form.get("grace_hours", default=24, type=int)
+				if grace_hours is None or grace_hours < 0:
+					return render_template("error.html", user_info=user_info, error="Grace period must be a number of hours")
+				
+				try:
+					new_token = db.rotate_service_token(target_service_info["service_id"], grace_hours * 60 * 60)
+				except:
+					return render_template("error.html", user_info=user_info, error="Database error when making service token")
+				if new_token is None:
+					return render_template("error.html", user_info=user_info, error="No key to store service tokens with is set")
+				#the token is only ever in this response, never in the session cookie, which is signed but readable
+				return render_service_page(user_info, db, target_service_info, new_token), 200, {"Cache-Control": "no-store"}
+			else:
+				return render_template("404.html", user_info=user_info), 404
+	
+	@app.route('/revoke_service_tokens', methods = ['POST'])
+	def revoke_service_tokens_post_route():
+		user_info, db = handle_session()
+		if declarative:
+			return render_template("error.html", user_info=user_info, error="Database error, cannot edit database while in declarative database mode")
+		else:
+			if user_info is None:
+				return redirect(url_for("login_route"))
+			elif user_info['superuser']:
+				target_service_info = db.get_service_info(request.form.get("service_id"))
+				if target_service_info is None:
+					return render_template("404.html", user_info=user_info), 404
+				try:
+					db.revoke_service_tokens(target_service_info["service_id"])
+					return redirect(url_for("service_route", service_id=target_service_info["service_id"]))
+				except:
+					return render_template("error.html", user_info=user_info, error="Database error when revoking service tokens")
+			else:
+				return render_template("404.html", user_info=user_info), 404
+	
 	@app.route('/set_user_email', methods = ['POST'])
 	def set_user_email_post_route():
 		user_info, db = handle_session()
@@ -699,6 +773,10 @@ def create_interface_app():
 	def robots_route():
 		return "User-agent: *\nDisallow: /\n"
 	
+	@app.teardown_appcontext
+	def teardown_database(e):
+		release_connection()
+	
 	@app.errorhandler(404)
 	def page_not_found(e):
 		user_info, db = handle_session()
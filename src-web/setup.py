@@ -5,7 +5,7 @@ setup(
 	version='0.0',
 	url='Not public',
 	license='AGPL',
-	packages=['daniel_authenticator_web'],
+	packages=['daniel_authenticator_web', 'daniel_authenticator_web.benchmarks'],
 	package_data={'daniel_authenticator_web': ['templates/*', 'static/*']},
 	include_package_data=True,
 	scripts = [
@@ -14,6 +14,8 @@ setup(
 	entry_points = {
 		'console_scripts': [
 			'daniel-authenticator-cli = daniel_authenticator_web.cli_interface:main',
+			'daniel-authenticator-ldap-socket = daniel_authenticator_web.ldap_socket_server:main',
+			'daniel-authenticator-ldap-async = daniel_authenticator_web.ldap_async_server:main',
 		]
 	}
 )
@@ -0,0 +1,24 @@
+import os
+
+#the background writers and metrics files are left off, so every test sees its writes right away and leaves nothing behind
+os.environ['DANIEL_AUTHENTICATOR_LOGIN_WRITE_INTERVAL'] = "0"
+os.environ['DANIEL_AUTHENTICATOR_METRICS_DIRECTORY'] = ""
+os.environ['DANIEL_AUTHENTICATOR_SESSION_TRACE_LENGTH'] = "0"
+
+import pytest
+from daniel_authenticator_web import database
+from daniel_authenticator_web.database import Database
+from daniel_authenticator_web.directory_cache import directory_cache
+from daniel_authenticator_web.search_cache import search_cache
+
+#a Database on a new file of its own, with this thread's connection reopened for it and the worker caches emptied,
+#since a new database starts its ids and service revisions over
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+	monkeypatch.setattr(database, "database_file", str(tmp_path / "test.sqlite3"))
+	database.connections.pid = None
+	directory_cache.clear()
+	search_cache.clear()
+	yield Database()
+	database.connections.conn.close()
+	database.connections.pid = None
@@ -0,0 +1,140 @@
+import sqlite3
+import pytest
+from passlib.hash import pbkdf2_sha256
+from daniel_authenticator_web import database
+from daniel_authenticator_web import credential_cache as credential_cache_module
+from daniel_authenticator_web.database import Database, MAX_INCORRECT_LOGIN_ATTEMPTS, ACCOUNT_LOCKED_MESSAGE
+
+PASSWORD_HASH = pbkdf2_sha256.using(rounds=1000).hash("password")
+
+def test_another_database_keeps_an_open_transaction(db):
+	with db.transaction():
+		db.create_group("first", "First")
+		#a helper making its own Database must neither throw away nor commit the batch so far
+		Database().create_group("second", "Second")
+		assert db.conn.in_transaction
+	assert db.get_group_by_username("first") is not None
+	assert db.get_group_by_username("second") is not None
+
+def test_transaction_rolls_back_every_database(db):
+	with pytest.raises(RuntimeError):
+		with db.transaction():
+			db.create_group("first", "First")
+			Database().create_group("second", "Second")
+			raise RuntimeError("failed")
+	assert db.get_group_by_username("first") is None
+	assert db.get_group_by_username("second") is None
+
+def test_lockout_after_too_many_attempts(db):
+	db.create_user_using_password_hash("alice", "Alice", "alice@example.com", PASSWORD_HASH, True, False)
+	for attempt in range(MAX_INCORRECT_LOGIN_ATTEMPTS):
+		assert db.attempt_user_login("alice", "wrong")[0] is None
+	assert db.attempt_user_login("alice", "password") == (None, ACCOUNT_LOCKED_MESSAGE)
+
+def test_successful_login_resets_attempts(db):
+	db.create_user_using_password_hash("alice", "Alice", "alice@example.com", PASSWORD_HASH, True, False)
+	for attempt in range(MAX_INCORRECT_LOGIN_ATTEMPTS - 1):
+		db.attempt_user_login("alice", "wrong")
+	assert db.attempt_user_login("alice", "password")[0] is not None
+	assert db.get_user_by_username("alice")["incorrect_login_attempts"] == 0
+
+#binds verified through an enabled credential cache, with the number of full password hash checks counted
+@pytest.fixture
+def hash_checks(db, monkeypatch):
+	monkeypatch.setattr(credential_cache_module.credential_cache, "ttl", 60)
+	credential_cache_module.credential_cache.clear()
+	checks = []
+	timed_check_password = credential_cache_module.timed_check_password
+	def counted_check_password(password, password_hash):
+		checks.append(password)
+		return timed_check_password(password, password_hash)
+	monkeypatch.setattr(credential_cache_module, "timed_check_password", counted_check_password)
+	yield checks
+	credential_cache_module.credential_cache.clear()
+
+def test_cached_bind_skips_the_hash(db, hash_checks):
+	db.create_user_using_password_hash("alice", "Alice", "alice@example.com", PASSWORD_HASH, True, False)
+	assert db.attempt_user_login("alice", "password")[0] is not None
+	assert db.attempt_user_login("alice", "password")[0] is not None
+	assert len(hash_checks) == 1
+
+def test_cached_bind_fails_after_password_change(db, hash_checks):
+	alice = db.create_user_using_password_hash("alice", "Alice", "alice@example.com", PASSWORD_HASH, True, False)
+	assert db.attempt_user_login("alice", "password")[0] is not None
+	db.set_user_password(alice, "new password")
+	assert db.attempt_user_login("alice", "password")[0] is None
+	assert db.attempt_user_login("alice", "new password")[0] is not None
+
+def test_cached_bind_fails_after_password_change_elsewhere(db, hash_checks):
+	#another worker changing the hash never touches this worker's cache, so the stored hash is what stops it
+	alice = db.create_user_using_password_hash("alice", "Alice", "alice@example.com", PASSWORD_HASH, True, False)
+	assert db.attempt_user_login("alice", "password")[0] is not None
+	db.conn.execute("UPDATE users SET password_hash=? WHERE user_id=?", (pbkdf2_sha256.using(rounds=1000).hash("new password"), alice))
+	db.conn.commit()
+	assert db.attempt_user_login("alice", "password")[0] is None
+
+def test_cached_bind_fails_after_deactivation(db, hash_checks):
+	alice = db.create_user_using_password_hash("alice", "Alice", "alice@example.com", PASSWORD_HASH, True, False)
+	assert db.attempt_user_login("alice", "password")[0] is not None
+	db.set_user_active(alice, False)
+	assert db.attempt_user_login("alice", "password")[0] is None
+	db.set_user_active(alice, True)
+	assert db.attempt_user_login("alice", "password")[0] is not None
+
+def test_cached_bind_fails_after_lockout(db, hash_checks):
+	db.create_user_using_password_hash("alice", "Alice", "alice@example.com", PASSWORD_HASH, True, False)
+	assert db.attempt_user_login("alice", "password")[0] is not None
+	for attempt in range(MAX_INCORRECT_LOGIN_ATTEMPTS):
+		db.attempt_user_login("alice", "wrong")
+	assert db.attempt_user_login("alice", "password") == (None, ACCOUNT_LOCKED_MESSAGE)
+
+def test_cached_service_bind_fails_after_password_change_or_deactivation(db, hash_checks):
+	service = db.create_service_using_password_hash("wiki", "Wiki", "", PASSWORD_HASH, True)
+	assert db.attempt_service_login("wiki", "password") is not None
+	db.set_service_password(service, "new password")
+	assert db.attempt_service_login("wiki", "password") is None
+	assert db.attempt_service_login("wiki", "new password") is not None
+	db.set_service_active(service, False)
+	assert db.attempt_service_login("wiki", "new password") is None
+
+#a database from before login_states, with the login bookkeeping in users and a user who is locked out
+def make_old_database(path):
+	conn = sqlite3.connect(path)
+	conn.executescript("""
+		CREATE TABLE users(user_id INTEGER PRIMARY KEY NOT NULL, username TEXT NOT NULL, fullname TEXT NOT NULL, email TEXT NOT NULL,
+			uuid TEXT NOT NULL, password_hash TEXT NOT NULL, active BOOLEAN NOT NULL, incorrect_login_attempts INTEGER NOT NULL,
+			locked BOOLEAN NOT NULL, last_login_time TEXT NOT NULL, creation_time TEXT NOT NULL, superuser BOOLEAN NOT NULL);
+		CREATE TABLE services(service_id INTEGER PRIMARY KEY NOT NULL, username TEXT NOT NULL, fullname TEXT NOT NULL,
+			hyperlink TEXT NOT NULL, password_hash TEXT NOT NULL, active BOOLEAN NOT NULL);
+		CREATE TABLE user_service_memberships(user_service_membership_id INTEGER PRIMARY KEY NOT NULL, user_id INTEGER, service_id INTEGER);
+		CREATE TABLE groups(group_id INTEGER PRIMARY KEY NOT NULL, username TEXT NOT NULL, fullname TEXT NOT NULL, uuid TEXT NOT NULL);
+		CREATE TABLE user_group_memberships(user_group_membership_id INTEGER PRIMARY KEY NOT NULL, user_id INTEGER, group_id INTEGER);
+		CREATE TABLE group_service_memberships(group_service_membership_id INTEGER PRIMARY KEY NOT NULL, group_id INTEGER, service_id INTEGER);
+		INSERT INTO users VALUES(1, 'alice', 'Alice', 'alice@example.com', 'uuid', 'hash', 1, 5, 1, '2020-01-01 00:00:00', '2020-01-01 00:00:00', 0);
+	""")
+	conn.commit()
+	conn.close()
+
+def test_login_states_are_migrated_once(tmp_path, monkeypatch):
+	path = str(tmp_path / "old.sqlite3")
+	make_old_database(path)
+	monkeypatch.setattr(database, "database_file", path)
+	database.connections.pid = None
+	try:
+		db = Database()
+		user = db.get_user_by_username("alice")
+		assert (user["incorrect_login_attempts"], user["locked"], user["last_login_time"]) == (5, 1, "2020-01-01 00:00:00")
+		columns = [row["name"] for row in db.conn.execute("PRAGMA table_info(users)").fetchall()]
+		assert "locked" not in columns and "incorrect_login_attempts" not in columns and "last_login_time" not in columns
+		assert db.conn.execute("PRAGMA user_version").fetchone()["user_version"] == len(database.database_migrations)
+		#users created afterwards get their login state from the new trigger
+		bob = db.create_user_using_password_hash("bob", "Bob", "bob@example.com", PASSWORD_HASH, True, False)
+		assert db.get_user_info(bob)["locked"] == 0
+		db.unlock_user(1)
+		#opening the database again must not copy anything over again
+		database.connections.conn.close()
+		database.connections.pid = None
+		assert Database().get_user_by_username("alice")["locked"] == 0
+	finally:
+		database.connections.conn.close()
+		database.connections.pid = None
@@ -0,0 +1,158 @@
+import json
+from passlib.hash import pbkdf2_sha256
+from daniel_authenticator_web.directory_cache import DirectoryCache, ServiceSnapshot
+from daniel_authenticator_web.ldap_filter import compile_filter, SCOPE_WHOLE_SUBTREE
+from daniel_authenticator_web.ldap_proxy_connector import handle_search
+
+PASSWORD_HASH = pbkdf2_sha256.using(rounds=1000).hash("password")
+
+#two services, with alice and the admins group in the first and bob in the second
+def make_directory(db):
+	first = db.create_service_using_password_hash("first", "First", "", PASSWORD_HASH, True)
+	second = db.create_service_using_password_hash("second", "Second", "", PASSWORD_HASH, True)
+	alice = db.create_user_using_password_hash("alice", "Alice", "alice@example.com", PASSWORD_HASH, True, False)
+	bob = db.create_user_using_password_hash("bob", "Bob", "bob@example.com", PASSWORD_HASH, True, False)
+	admins = db.create_group("admins", "Admins")
+	db.add_user_to_service(alice, first)
+	db.add_user_to_service(bob, second)
+	db.add_group_to_service(admins, first)
+	db.add_user_to_group(alice, admins)
+	return first, second, alice, bob, admins
+
+def test_revision_moves_only_for_services_that_can_see_the_change(db):
+	first, second, alice, bob, admins = make_directory(db)
+	before = (db.get_service_revision(first), db.get_service_revision(second))
+	db.set_user_fullname(alice, "Alice Changed")
+	assert db.get_service_revision(first) > before[0]
+	assert db.get_service_revision(second) == before[1]
+
+def test_revision_moves_on_memberships(db):
+	first, second, alice, bob, admins = make_directory(db)
+	revision = db.get_service_revision(second)
+	db.add_group_to_service(admins, second)
+	assert db.get_service_revision(second) > revision
+	revision = db.get_service_revision(second)
+	db.add_user_to_group(bob, admins)
+	assert db.get_service_revision(second) > revision
+
+def test_revision_ignores_login_bookkeeping(db):
+	first, second, alice, bob, admins = make_directory(db)
+	revision = db.get_service_revision(first)
+	db.attempt_user_login("alice", "wrong")
+	db.attempt_user_login("alice", "password")
+	assert db.get_service_revision(first) == revision
+
+def test_single_entry_snapshot_matches_full_snapshot(db):
+	first, second, alice, bob, admins = make_directory(db)
+	service = db.get_service_info(first)
+	full = ServiceSnapshot(service, db.get_service_directory(first))
+	cache = DirectoryCache(0)
+	user_snapshot = cache.get_snapshot(db, service, True, "user", "alice")
+	assert list(user_snapshot.users) == ["alice"]
+	assert user_snapshot.users["alice"] == full.users["alice"]
+	group_snapshot = cache.get_snapshot(db, service, True, "group", "admins")
+	assert group_snapshot.groups["admins"] == full.groups["admins"]
+	#bob is not part of the first service
+	assert len(cache.get_snapshot(db, service, True, "user", "bob").users) == 0
+
+def test_cached_snapshot_is_used_for_single_entries(db):
+	first, second, alice, bob, admins = make_directory(db)
+	service = db.get_service_info(first)
+	cache = DirectoryCache(1000)
+	full = cache.get_snapshot(db, service)
+	assert cache.get_snapshot(db, service, True, "user", "alice") is full
+	db.set_user_fullname(alice, "Alice Changed")
+	assert cache.get_snapshot(db, service, True, "user", "alice").users["alice"]["Attributes"]["cn"] == ["Alice Changed"]
+
+def test_filtered_pages_are_read_from_the_database(db):
+	first, second, alice, bob, admins = make_directory(db)
+	for name in ["carol", "dave", "erin", "frank"]:
+		db.add_user_to_service(db.create_user_using_password_hash(name, name.title(), "%s@example.com" % name, PASSWORD_HASH, True, False), first)
+	service = db.get_service_info(first)
+	snapshot = DirectoryCache(0).get_snapshot(db, service)
+	condition = compile_filter("(mail=*@example.com)", "user")
+	usernames = []
+	after = ""
+	while True:
+		user_ids, after = db.get_user_ids_in_service_matching(first, condition, after, 2)
+		assert len(user_ids) <= 2 and len(snapshot.get_users_by_id(user_ids)) == len(user_ids)
+		usernames += [snapshot.user_ids[user_id] for user_id in user_ids]
+		if after == "":
+			break
+	assert usernames == ["alice", "carol", "dave", "erin", "frank"]
+	user_ids, after = db.get_user_ids_in_service_matching(first, condition)
+	assert len(user_ids) == 5 and after == ""
+
+def test_unfiltered_pages_cover_the_snapshot(db):
+	first, second, alice, bob, admins = make_directory(db)
+	for name in ["carol", "dave"]:
+		db.add_user_to_service(db.create_user_using_password_hash(name, name.title(), "%s@example.com" % name, PASSWORD_HASH, True, False), first)
+	snapshot = DirectoryCache(0).get_snapshot(db, db.get_service_info(first))
+	page, after = snapshot.get_users("", 2)
+	assert len(page) == 2 and after == "carol"
+	page, after = snapshot.get_users(after, 2)
+	assert len(page) == 1 and after == ""
+	page, after = snapshot.get_users("", 3)
+	assert len(page) == 3 and after == ""
+
+
+FIRST_DN = "ou=first,ou=services,dc=daniel-authenticator"
+
+#the raw response body of a whole subtree search by the first service under the given base
+def search_body(db, base):
+	result, entities, next_cookie, attribute_names, body = handle_search(db, FIRST_DN, base + "," + FIRST_DN, "", SCOPE_WHOLE_SUBTREE, [], 0, "", 1, True)
+	assert result
+	return body
+
+#a repeated search is answered with the very bytes kept in the search cache, until the change is made, after which
+#the search has to be answered anew and show it
+def check_invalidated(db, base, change, shows_change):
+	cached = search_body(db, base)
+	assert search_body(db, base) is cached
+	assert not shows_change(json.loads(cached))
+	change()
+	body = search_body(db, base)
+	assert body is not cached
+	assert shows_change(json.loads(body))
+
+def entity(body, uid):
+	return [entity["Attributes"] for entity in body["Entities"] if entity["Attributes"]["uid"] == [uid]]
+
+def test_search_cache_user_rename(db):
+	first, second, alice, bob, admins = make_directory(db)
+	def rename():
+		db.conn.execute("UPDATE users SET username='alicia' WHERE user_id=?", (alice,))
+		db.conn.commit()
+	check_invalidated(db, "ou=users", rename, lambda body: len(entity(body, "alicia")) == 1)
+
+def test_search_cache_user_email(db):
+	first, second, alice, bob, admins = make_directory(db)
+	check_invalidated(db, "ou=users", lambda: db.set_user_email(alice, "alice@example.org"),
+		lambda body: entity(body, "alice")[0]["mail"] == ["alice@example.org"])
+
+def test_search_cache_group_membership_add(db):
+	first, second, alice, bob, admins = make_directory(db)
+	db.add_user_to_service(bob, first)
+	check_invalidated(db, "ou=groups", lambda: db.add_user_to_group(bob, admins),
+		lambda body: any(member.startswith("uid=bob,") for member in entity(body, "admins")[0]["member"]))
+
+def test_search_cache_group_membership_remove(db):
+	first, second, alice, bob, admins = make_directory(db)
+	check_invalidated(db, "ou=users", lambda: db.remove_user_from_group(alice, admins),
+		lambda body: entity(body, "alice")[0]["memberOf"] == [])
+
+def test_search_cache_group_rename(db):
+	first, second, alice, bob, admins = make_directory(db)
+	def rename():
+		db.conn.execute("UPDATE groups SET username='wheel' WHERE group_id=?", (admins,))
+		db.conn.commit()
+	check_invalidated(db, "ou=users", rename,
+		lambda body: entity(body, "alice")[0]["memberOf"] == ["uid=wheel,ou=groups," + FIRST_DN])
+	check_invalidated(db, "ou=groups", lambda: db.set_group_fullname(admins, "Wheel"),
+		lambda body: entity(body, "wheel")[0]["cn"] == ["Wheel"])
+
+def test_search_cache_service_membership(db):
+	first, second, alice, bob, admins = make_directory(db)
+	check_invalidated(db, "ou=users", lambda: db.add_user_to_service(bob, first), lambda body: len(entity(body, "bob")) == 1)
+	check_invalidated(db, "ou=users", lambda: db.remove_user_from_service(alice, first), lambda body: len(entity(body, "alice")) == 0)
+	check_invalidated(db, "ou=groups", lambda: db.remove_group_from_service(admins, first), lambda body: len(entity(body, "admins")) == 0)
@@ -0,0 +1,25 @@
+import asyncio
+from daniel_authenticator_web.ldap_async_server import LdapAsyncServer
+
+#sends each body as a POST to /close on one connection and returns the status of every response
+def post_bodies(bodies):
+	async def run():
+		server = LdapAsyncServer(1, 1)
+		listener = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+		reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname())
+		statuses = []
+		for body in bodies:
+			writer.write(b"POST /close HTTP/1.1\r\nContent-Length: %i\r\n\r\n" % len(body) + body)
+			await writer.drain()
+			head = await reader.readuntil(b"\r\n\r\n")
+			length = [int(line.split(b":")[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length:")][0]
+			await reader.readexactly(length)
+			statuses.append(int(head.split(b" ")[1]))
+		writer.close()
+		listener.close()
+		return statuses
+	return asyncio.run(run())
+
+def test_malformed_bodies_get_a_bad_request():
+	#the connection stays usable after each of them
+	assert post_bodies([b"connectionNumber=\xff", b"connectionNumber=%ff", b"connectionNumber", b"connectionNumber=1"]) == [400, 400, 400, 200]
@@ -0,0 +1,41 @@
+from daniel_authenticator_web.ldap_dn import parse_dn, parse_rdns, ParsedDn, DN_ROOT, DN_SERVICE, DN_USERS_BASE, DN_GROUPS_BASE, DN_USER, DN_GROUP, DN_IN_SERVICE, DN_INVALID
+
+def test_kinds():
+	assert parse_dn("") == ParsedDn(DN_ROOT, None, None)
+	assert parse_dn("ou=wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_SERVICE, "wiki", None)
+	assert parse_dn("ou=users,ou=wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_USERS_BASE, "wiki", None)
+	assert parse_dn("ou=groups,ou=wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_GROUPS_BASE, "wiki", None)
+	assert parse_dn("uid=alice,ou=users,ou=wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_USER, "wiki", "alice")
+	assert parse_dn("uid=admins,ou=groups,ou=wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_GROUP, "wiki", "admins")
+	assert parse_dn("cn=other,ou=wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_IN_SERVICE, "wiki", None)
+
+def test_fixed_parts_ignore_case_and_spaces():
+	assert parse_dn("UID=alice, OU=Users ,ou=wiki,OU=Services,DC=Daniel-Authenticator") == ParsedDn(DN_USER, "wiki", "alice")
+	#usernames and service names are kept as given
+	assert parse_dn("uid=Alice,ou=users,ou=Wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_USER, "Wiki", "Alice")
+
+def test_escapes():
+	assert parse_rdns("cn=a\\,b,dc=x") == [("cn", "a,b"), ("dc", "x")]
+	assert parse_rdns("cn=\\c3\\a9,dc=x") == [("cn", "é"), ("dc", "x")]
+	assert parse_rdns("cn=a\\ ,dc=x") == [("cn", "a "), ("dc", "x")]
+	assert parse_dn("uid=al\\69ce,ou=users,ou=wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_USER, "wiki", "alice")
+
+def test_invalid():
+	for dn in [
+		"dc=daniel-authenticator",
+		"ou=services,dc=daniel-authenticator",
+		"ou=wiki,ou=services,dc=other",
+		"cn=wiki,ou=services,dc=daniel-authenticator",
+		"ou=wi ki,ou=services,dc=daniel-authenticator",
+		"uid=alice+cn=x,ou=users,ou=wiki,ou=services,dc=daniel-authenticator",
+		"uid=alice,,ou=users,ou=wiki,ou=services,dc=daniel-authenticator",
+		"uid=#616c696365,ou=users,ou=wiki,ou=services,dc=daniel-authenticator",
+		"uid=\\ff,ou=users,ou=wiki,ou=services,dc=daniel-authenticator",
+		"uid=alice\\",
+		"not a dn",
+	]:
+		assert parse_dn(dn).kind == DN_INVALID, dn
+
+def test_unusable_usernames_are_not_entries():
+	assert parse_dn("uid=a b,ou=users,ou=wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_IN_SERVICE, "wiki", None)
+	assert parse_dn("uid=alice,ou=other,ou=wiki,ou=services,dc=daniel-authenticator") == ParsedDn(DN_IN_SERVICE, "wiki", None)
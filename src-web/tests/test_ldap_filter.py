@@ -0,0 +1,76 @@
+from passlib.hash import pbkdf2_sha256
+from daniel_authenticator_web.ldap_filter import compile_filter, filter_attributes, TRUE_CONDITION, FALSE_CONDITION
+
+PASSWORD_HASH = pbkdf2_sha256.using(rounds=1000).hash("password")
+
+#one service with alice, bob, and an underscored user, and the admins group
+def make_service(db):
+	service = db.create_service_using_password_hash("wiki", "Wiki", "", PASSWORD_HASH, True)
+	for username, fullname, email in [("alice", "Alice Smith", "alice@example.com"), ("bob", "Bob Jones", "bob@example.org"), ("a_b", "A B", "a_b@example.com")]:
+		db.add_user_to_service(db.create_user_using_password_hash(username, fullname, email, PASSWORD_HASH, True, False), service)
+	db.add_group_to_service(db.create_group("admins", "Administrators"), service)
+	return service
+
+def matching_users(db, service, search_filter):
+	user_ids, last_username = db.get_user_ids_in_service_matching(service, compile_filter(search_filter, "user"))
+	return sorted(db.get_user_info(user_id)["username"] for user_id in user_ids)
+
+def test_equality_ignores_case(db):
+	service = make_service(db)
+	assert matching_users(db, service, "(uid=ALICE)") == ["alice"]
+	assert matching_users(db, service, "(mail=bob@EXAMPLE.org)") == ["bob"]
+	assert matching_users(db, service, "uid=bob") == ["bob"]
+
+def test_substrings_escape_like_wildcards(db):
+	service = make_service(db)
+	assert matching_users(db, service, "(cn=*smith)") == ["alice"]
+	assert matching_users(db, service, "(mail=*@example.com)") == ["a_b", "alice"]
+	#_ is a literal here, not LIKE's any character
+	assert matching_users(db, service, "(uid=a_*)") == ["a_b"]
+	assert matching_users(db, service, "(uid=a*i*e)") == ["alice"]
+
+def test_boolean_operators(db):
+	service = make_service(db)
+	assert matching_users(db, service, "(|(uid=alice)(uid=bob))") == ["alice", "bob"]
+	assert matching_users(db, service, "(&(mail=*@example.com)(!(uid=alice)))") == ["a_b"]
+	assert matching_users(db, service, "(&)") == ["a_b", "alice", "bob"]
+	assert matching_users(db, service, "(|)") == []
+
+def test_object_class_and_unknown_attributes_are_constant():
+	assert compile_filter("(objectClass=*)", "user") == TRUE_CONDITION
+	assert compile_filter("(objectClass=user)", "user") == TRUE_CONDITION
+	assert compile_filter("(objectClass=USER)", "group") == FALSE_CONDITION
+	assert compile_filter("(objectClass=gr*)", "group") == TRUE_CONDITION
+	assert compile_filter("(description=anything)", "user") == FALSE_CONDITION
+
+def test_uncompilable_parts_give_a_superset(db):
+	service = make_service(db)
+	#memberOf has no column, so it is dropped from the conjunction and the frontend filters the rest
+	assert matching_users(db, service, "(&(uid=alice)(memberOf=uid=admins,ou=groups,ou=wiki,ou=services,dc=daniel-authenticator))") == ["alice"]
+	assert compile_filter("(|(uid=alice)(memberOf=x))", "user") == TRUE_CONDITION
+	assert compile_filter("(!(memberOf=x))", "user") == TRUE_CONDITION
+	assert compile_filter("(uid~=alice)", "user") == TRUE_CONDITION
+	#NOCASE only folds ascii, so other values are left to the frontend
+	assert compile_filter("(cn=Élodie)", "user") == TRUE_CONDITION
+
+def test_malformed_filters_select_everything():
+	for search_filter in [None, "", "(uid=alice", "(uid=\\zz)", "(=alice)", "(uid=alice)x"]:
+		assert compile_filter(search_filter, "user") == TRUE_CONDITION
+
+def test_escaped_values(db):
+	service = make_service(db)
+	assert compile_filter("(cn=a\\2ab)", "user") == ("fullname = ? COLLATE NOCASE", ["a*b"])
+	assert matching_users(db, service, "(uid=\\61lice)") == ["alice"]
+
+def test_group_filters(db):
+	service = make_service(db)
+	group_ids, last_username = db.get_group_ids_in_service_matching(service, compile_filter("(cn=admin*)", "group"))
+	assert len(group_ids) == 1
+	group_ids, last_username = db.get_group_ids_in_service_matching(service, compile_filter("(mail=*)", "group"))
+	assert group_ids == []
+
+def test_filter_attributes():
+	assert filter_attributes("") == set()
+	assert filter_attributes("(&(uid=alice)(|(objectClass=user)(!(memberOf=*))))") == {"uid", "objectclass", "memberof"}
+	assert filter_attributes("(cn:dn:=alice)") is None
+	assert filter_attributes("(uid=alice") is None
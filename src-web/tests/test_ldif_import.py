@@ -0,0 +1,88 @@
+import io, base64, struct
+import concurrent.futures
+import daniel_authenticator_web.password as pswd
+from daniel_authenticator_web.ldif_import import LdifImport, read_ldif_records, hash_imported_password, normalize_dn
+
+def freeipa_value(rounds):
+	packed = struct.pack(">i", rounds) + b"s" * 64 + b"h" * 256
+	return "{PBKDF2_SHA256}" + base64.b64encode(packed).decode("ascii")
+
+LDIF = """version: 1
+
+dn: uid=alice,cn=users,cn=accounts,dc=example,dc=com
+objectClass: inetorgperson
+uid: alice
+mail: alice@example.com
+userPassword: {PBKDF2_SHA256}bm90IGEgaGFzaA==
+memberOf: cn=admins,cn=groups,cn=accounts,dc=example,dc=com
+
+dn: uid=bob,cn=users,cn=accounts,dc=example,dc=com
+objectClass: inetorgperson
+uid: bob
+mail: bob@example.com
+userPassword: %s
+
+dn: cn=bob,cn=groups,cn=accounts,dc=example,dc=com
+objectClass: groupofnames
+cn: bob
+
+dn: cn=admins,cn=groups,cn=accounts,dc=example,dc=com
+objectClass: groupofnames
+cn: admins
+member: UID=Bob, cn=users,cn=accounts,dc=example,dc=com
+member: cn=bob,cn=groups,cn=accounts,dc=example,dc=com
+
+dn: cn=admins,cn=groups,cn=other,dc=example,dc=com
+objectClass: groupofnames
+cn: admins
+""" % freeipa_value(1000)
+
+def run_import(db, ldif):
+	with concurrent.futures.ThreadPoolExecutor() as executor:
+		importer = LdifImport(db, executor)
+		records = list(read_ldif_records(io.StringIO(ldif)))
+		for record in records:
+			importer.collect_memberships(record)
+		importer.import_batch(records)
+		return importer, importer.import_memberships()
+
+def test_malformed_freeipa_hash_does_not_stop_the_import():
+	password_hash, error = hash_imported_password("{PBKDF2_SHA256}bm90IGEgaGFzaA==")
+	assert error is not None
+	assert not pswd.check_password("", password_hash)
+	password_hash, error = hash_imported_password(freeipa_value(1000))
+	assert error is None and pswd.hash_rounds(password_hash) == 1000
+
+def test_unsupported_schemes_are_reported():
+	for value, scheme in [("{SSHA}c2FsdGVkaGFzaA==", "{SSHA}"), ("{CRYPT}$6$salt$hash", "{CRYPT}"), ("{SSHA512}abc", "{SSHA512}")]:
+		password_hash, error = hash_imported_password(value)
+		assert error is not None and scheme in error
+		assert not pswd.check_password(value, password_hash)
+	#without a closing brace the value is not repeated, it may be a plain password
+	password_hash, error = hash_imported_password("{secret")
+	assert error is not None and "secret" not in error
+	assert hash_imported_password(None)[1] is None
+
+def test_import_keeps_going_past_bad_passwords(db):
+	importer, added = run_import(db, LDIF)
+	assert importer.users_created == 2
+	assert importer.unusable_passwords == 1
+	assert db.get_user_by_username("alice") is not None
+	assert pswd.hash_rounds(db.get_user_by_username("bob")["password_hash"]) == 1000
+
+def test_memberships_match_whole_dns(db):
+	importer, added = run_import(db, LDIF)
+	#uid=bob is a member of admins, but the group named bob is not a user, and there are two groups named admins
+	#so neither membership can be told apart and both are skipped
+	assert importer.memberships_skipped == 3
+	assert added == 0
+
+def test_memberships_with_one_group_per_name(db):
+	importer, added = run_import(db, LDIF.rsplit("\n\ndn: cn=admins,cn=groups,cn=other", 1)[0] + "\n")
+	assert added == 2
+	admins = db.get_group_by_username("admins")
+	assert sorted(user["username"] for user in db.get_users_in_group(admins["group_id"])) == ["alice", "bob"]
+
+def test_normalize_dn():
+	assert normalize_dn("UID=Bob, cn=users,dc=example") == normalize_dn("uid=bob,cn=users,dc=example")
+	assert normalize_dn("uid=bob,cn=users,dc=example") != normalize_dn("uid=bob,cn=staged,dc=example")
@@ -0,0 +1,26 @@
+import os, json, subprocess, sys
+from daniel_authenticator_web.metrics import Metrics
+
+def dead_pid():
+	process = subprocess.Popen([sys.executable, "-c", "pass"])
+	process.wait()
+	return process.pid
+
+def test_files_of_exited_workers_are_dropped(tmp_path):
+	metrics = Metrics(str(tmp_path))
+	metrics.increment("daniel_authenticator_searches_total", {"outcome": "allowed", "service": "wiki"})
+	#a worker that was killed and never removed its file
+	with open(tmp_path / ("metrics-%i.json" % dead_pid()), "w") as file:
+		json.dump([["daniel_authenticator_searches_total", [["outcome", "allowed"], ["service", "wiki"]], 5]], file)
+	rendered = metrics.render()
+	assert 'daniel_authenticator_searches_total{outcome="allowed",service="wiki"} 1\n' in rendered
+	assert os.listdir(tmp_path) == ["metrics-%i.json" % os.getpid()]
+
+def test_exiting_removes_the_file(tmp_path):
+	metrics = Metrics(str(tmp_path))
+	metrics.increment("daniel_authenticator_searches_total", {"outcome": "allowed", "service": "wiki"})
+	metrics.write()
+	metrics.remove()
+	#the writer thread can still run once more while the process exits
+	metrics.write()
+	assert os.listdir(tmp_path) == []
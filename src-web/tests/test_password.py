@@ -0,0 +1,39 @@
+from passlib.hash import pbkdf2_sha256
+import daniel_authenticator_web.password as pswd
+
+def configure_rounds(monkeypatch, rounds, lower=False):
+	monkeypatch.setitem(pswd.HASH_ROUNDS, pswd.USER_PASSWORD, rounds)
+	monkeypatch.setitem(pswd.HASHERS, pswd.USER_PASSWORD, pbkdf2_sha256 if rounds is None else pbkdf2_sha256.using(rounds=rounds))
+	monkeypatch.setattr(pswd, "LOWER_HASH_ROUNDS", lower)
+
+def login_with_rounds(db, rounds):
+	db.create_user_using_password_hash("alice", "Alice", "alice@example.com", pbkdf2_sha256.using(rounds=rounds).hash("hunter2"), True, False)
+	user, message = db.attempt_user_login("alice", "hunter2")
+	assert user is not None, message
+	return pswd.hash_rounds(db.get_user_by_username("alice")["password_hash"])
+
+def test_hash_rounds():
+	assert pswd.hash_rounds(pbkdf2_sha256.using(rounds=1234).hash("x")) == 1234
+	assert pswd.hash_rounds("not a hash") is None
+
+def test_no_rehash_without_configured_rounds(db, monkeypatch):
+	configure_rounds(monkeypatch, None)
+	assert login_with_rounds(db, 1000) == 1000
+
+def test_rehash_raises_rounds(db, monkeypatch):
+	configure_rounds(monkeypatch, 2000)
+	assert login_with_rounds(db, 1000) == 2000
+
+def test_rehash_never_lowers_rounds_by_default(db, monkeypatch):
+	configure_rounds(monkeypatch, 2000)
+	assert login_with_rounds(db, 5000) == 5000
+
+def test_rehash_lowers_rounds_when_asked(db, monkeypatch):
+	configure_rounds(monkeypatch, 2000, lower=True)
+	assert login_with_rounds(db, 5000) == 2000
+
+def test_failed_login_does_not_rehash(db, monkeypatch):
+	configure_rounds(monkeypatch, 2000)
+	db.create_user_using_password_hash("alice", "Alice", "alice@example.com", pbkdf2_sha256.using(rounds=1000).hash("hunter2"), True, False)
+	assert db.attempt_user_login("alice", "wrong")[0] is None
+	assert pswd.hash_rounds(db.get_user_by_username("alice")["password_hash"]) == 1000
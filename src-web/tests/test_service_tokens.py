@@ -0,0 +1,82 @@
+import os
+from passlib.hash import pbkdf2_sha256
+import daniel_authenticator_web.password as pswd
+from daniel_authenticator_web import database, create_interface_app
+
+def create_service(db, password="service password"):
+	return db.create_service_using_password_hash("nextcloud", "Nextcloud", "", pbkdf2_sha256.using(rounds=1000).hash(password), True)
+
+def test_token_binds(db):
+	service_id = create_service(db)
+	token = db.rotate_service_token(service_id, 0)
+	assert pswd.is_service_token(token)
+	assert db.attempt_service_login("nextcloud", token) is not None
+	assert db.attempt_service_login("nextcloud", token + "x") is None
+	assert db.attempt_service_login("nextcloud", "service password") is not None
+
+def test_rotation_grace_period(db):
+	service_id = create_service(db)
+	first = db.rotate_service_token(service_id, 0)
+	second = db.rotate_service_token(service_id, 3600)
+	#the token a rotation replaces works for the grace period given to that rotation
+	assert db.attempt_service_login("nextcloud", second) is not None
+	assert db.attempt_service_login("nextcloud", first) is not None
+	third = db.rotate_service_token(service_id, 0)
+	assert db.attempt_service_login("nextcloud", third) is not None
+	assert db.attempt_service_login("nextcloud", second) is None
+	assert db.attempt_service_login("nextcloud", first) is None
+
+def test_revoke(db):
+	service_id = create_service(db)
+	token = db.rotate_service_token(service_id, 3600)
+	db.revoke_service_tokens(service_id)
+	assert db.attempt_service_login("nextcloud", token) is None
+
+def test_password_with_token_prefix_still_binds(db):
+	service_id = create_service(db, "datoken_not really a token")
+	db.rotate_service_token(service_id, 0)
+	assert db.attempt_service_login("nextcloud", "datoken_not really a token") is not None
+
+def test_key_is_kept_next_to_the_database(db, monkeypatch):
+	monkeypatch.setattr(pswd, "SERVICE_TOKEN_KEY", None)
+	key = database.get_service_token_key()
+	path = os.path.join(os.path.dirname(database.database_file), "daniel-authenticator-service-token-key")
+	assert len(key) == 64
+	with open(path) as file:
+		assert file.read().encode("utf-8") == key
+	database.service_token_keys.clear()
+	assert database.get_service_token_key() == key
+
+def test_declarative_needs_a_key(db, monkeypatch):
+	monkeypatch.setattr(pswd, "SERVICE_TOKEN_KEY", None)
+	monkeypatch.setattr(database, "declarative", True)
+	service_id = create_service(db)
+	assert db.rotate_service_token(service_id, 0) is None
+	db.set_service_token_digest(service_id, pswd.service_token_digest("datoken_x", b""))
+	assert db.attempt_service_login("nextcloud", "datoken_x") is None
+
+def test_new_token_is_shown_once_and_never_in_the_session(db, monkeypatch):
+	monkeypatch.setenv("DANIEL_AUTHENTICATOR_SECRET_KEY", "test")
+	app = create_interface_app()
+	app.config["WTF_CSRF_ENABLED"] = False
+	client = app.test_client()
+	admin_id = db.create_user_using_password_hash("admin", "Admin", "admin@example.com", pbkdf2_sha256.hash("x"), True, True)
+	with client.session_transaction() as session:
+		session["user_id"] = admin_id
+	service_id = create_service(db)
+
+	response = client.post("/rotate_service_token", data={"service_id": service_id, "grace_hours": 1})
+	assert response.status_code == 200
+	assert response.headers["Cache-Control"] == "no-store"
+	page = response.get_data(as_text=True)
+	assert "shown only this once" in page
+	token = page.split("<code>", 1)[1].split("</code>", 1)[0]
+	assert db.attempt_service_login("nextcloud", token) is not None
+	#the token never goes into the session cookie, which is signed but not encrypted
+	with client.session_transaction() as session:
+		assert token not in str(dict(session))
+	assert token not in response.headers.get("Set-Cookie", "")
+	assert "shown only this once" not in client.get("/services/%i" % service_id).get_data(as_text=True)
+	assert len(db.get_service_tokens(service_id)) == 1
+
+	assert client.post("/revoke_service_tokens", data={"service_id": 12345}).status_code == 404